@@ -1,40 +1,50 @@
-import json
 import time
 import sqlite3
 import paho.mqtt.client as mqtt
 
+import ingest
+import partitions
+import rollups
+import schema
+from db_writer import BatchWriter
+from retention import RetentionJob
+
 BROKER = "10.215.255.119"
 PORT = 1883
 
-TOPIC_IN = "cx/iotbox01/sensors"
+TOPIC_IN = "cx/+/sensors"  # every box; device id comes from the topic
 DB_FILE = "sensor.db"
+ARCHIVE_ROOT = "archive"  # expired days go here as .npy columns (archive.py)
+# Set to e.g. 2 to store days closed that long as compressed chunks (chunk_store.py)
+COMPACT_AFTER_DAYS = None
+
+# Group commit: flush every BATCH_SIZE rows or FLUSH_INTERVAL_MS, whichever first
+BATCH_SIZE = 200
+FLUSH_INTERVAL_MS = 500
+STATS_INTERVAL_SEC = 60
 
-# establish SQL data base
+writer = BatchWriter(
+    DB_FILE,
+    batch_size=BATCH_SIZE,
+    flush_interval_ms=FLUSH_INTERVAL_MS,
+    on_flush=[rollups.apply_rows],  # keep 1m/1h aggregates current
+)
+# Archives, then drops expired day partitions / rollup rows hourly (policy in retention.py)
+retention_job = RetentionJob(DB_FILE, archive_root=ARCHIVE_ROOT, compact_after_days=COMPACT_AFTER_DAYS)
+holds = ingest.HoldState()
+last_stats_ts = 0.0
+
+# establish SQL data base (creates or upgrades sensor_log, see schema.py)
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS sensor_log (
-        time INTEGER,
-        temperature REAL,
-        humidity REAL,
-        window REAL,
-        co2_ppm REAL,
-        tvoc_ppb REAL
-    )
-    """)
-    conn.commit()
-    conn.close()
+    applied = schema.ensure_schema(DB_FILE)
+    if applied:
+        print("Schema migrated:", applied)
 
-# Data Record
-def insert_row(t, temp, hum, win, co2, tvoc):
+# Data Record (unbatched; kept for one-off scripts)
+def insert_row(t, temp, hum, win, co2, tvoc, device_id=schema.DEFAULT_DEVICE_ID):
     conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO sensor_log (time, temperature, humidity, window, co2_ppm, tvoc_ppb) VALUES (?, ?, ?, ?, ?, ?)",
-        (t, temp, hum, win, co2, tvoc)
-    )
-    conn.commit()
+    with conn:
+        partitions.insert_rows(conn, [(device_id, t, temp, hum, win, co2, tvoc)])
     conn.close()
 
 def on_connect(client, userdata, flags, rc):
@@ -43,17 +53,27 @@ def on_connect(client, userdata, flags, rc):
     print("Subscribed to", TOPIC_IN)
 
 def on_message(client, userdata, msg):
+    global last_stats_ts
     try:
-        data = json.loads(msg.payload.decode("utf-8"))
-        t = int(data.get("timestamp", time.time()))
-        temp = float(data["temperature"])
-        hum = float(data["humidity"])
-        win = float(data["window"])
-        co2 = float(data["co2_ppm"]) if data.get("co2_ppm") is not None else None
-        tvoc = float(data["tvoc_ppb"]) if data.get("tvoc_ppb") is not None else None
+        # JSON or binary batch (wire_format.py); same decoder as PC_server
+        samples = ingest.decode_samples(msg.topic, msg.payload)
+        if samples is None:
+            print("Error parsing/logging: undecodable payload on", msg.topic)
+            return
+
+        for sample in samples:
+            # Deadband payloads leave unchanged fields out; store the held values
+            holds.apply(sample)
+            if not sample.loggable():
+                print("Skipped (no readings):", sample.time)
+                continue
+            writer.submit(sample.row())
+            print("Logged:", *sample.row()[1:])
 
-        insert_row(t, temp, hum, win, co2, tvoc)
-        print("Logged:", t, temp, hum, win, co2, tvoc)
+        now = time.time()
+        if now - last_stats_ts >= STATS_INTERVAL_SEC:
+            last_stats_ts = now
+            print("Writer stats:", writer.stats())
 
     except Exception as e:
         print("Error parsing/logging:", e)
@@ -64,4 +84,14 @@ if __name__ == "__main__":
     client.on_connect = on_connect
     client.on_message = on_message
     client.connect(BROKER, PORT, 60)
-    client.loop_forever()
+    writer.start()
+    retention_job.start()
+    try:
+        client.loop_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.disconnect()
+        retention_job.stop(5)
+        writer.close()
+        print("Writer stats:", writer.stats())
@@ -1,8 +1,10 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, g, render_template, jsonify, request
 import paho.mqtt.client as mqtt
 import threading
+import atexit
 import time
 import json
+import math
 import os
 import sys
 import sqlite3
@@ -12,6 +14,20 @@ CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "code")
 if CODE_DIR not in sys.path:
     sys.path.append(CODE_DIR)
 
+import fleet
+import history
+import metrics
+import profiler
+import rollups
+import schema
+from db_writer import BatchWriter
+from decision_engine import heater_decision, trimmed_mean, window_state
+from dispatch import Dispatcher
+from ingest import IngestPipeline
+from live_push import ALL_DEVICES, Broadcaster, parse_stream_args, sse_frame
+from retention import RetentionJob
+from sensor_cache import SensorCache
+
 
 app = Flask(__name__)
 
@@ -20,14 +36,20 @@ app = Flask(__name__)
 # ======================
 MQTT_BROKER = "10.215.255.119"
 MQTT_PORT = 1883
-TOPIC_SENSOR = "cx/iotbox01/sensors"
-TOPIC_HEATER = "cx/iotbox01/heater"
-TOPIC_ALERT = "cx/iotbox01/alert"
+# Every box publishes on cx/<device>/...; the server listens to all of them
+TOPIC_SENSOR = fleet.wildcard_topic("sensors")
+TOPIC_HEATER = fleet.wildcard_topic("heater")
+# Default box for the dashboard and for HTTP requests without a device
+DEVICE_ID = "iotbox01"
 
 # ======================
 # Control thresholds / tuning
 # ======================
 WINDOW_OPEN_THRESHOLD = 20
+# Samples without a window reading (no usable echo) reuse the last good ones
+# for this long; after that the window counts as open, so the heater fails
+# safe to OFF (an open window often returns no echo at all)
+WINDOW_HOLD_SEC = 10
 TEMP_OFF_HYSTERESIS = 3.0
 CO2_ALERT_THRESHOLD = 500
 CO2_ALERT_COOLDOWN_SEC = 60 * 60
@@ -42,11 +64,6 @@ TEMP_BAD_HIGH = 28.0
 HUM_BAD_LOW = 30.0
 HUM_BAD_HIGH = 70.0
 
-last_co2_alert_ts = 0.0
-last_hum_alert_ts = 0.0
-last_tvoc_alert_ts = 0.0
-last_heater_alert_ts = 0.0
-
 DEFAULT_THRESHOLDS = {
     "T_cold": 18.0,
     "H_dry": 30.0,
@@ -57,99 +74,52 @@ LOG_MOVING_AVG = False
 LOG_SENSOR_DATA = False
 LOG_AUTO_MODE = False
 
+# Persist samples from this process (decode once, no separate PC_logger).
+# Leave False while PC_logger is still running against the same database.
+INGEST_PERSIST = False
+
+# Decisions run on a worker pool instead of paho's network thread.
+# One lane per worker; a device always maps to the same lane (ordered).
+# DISPATCH_WORKERS = 0 runs decisions inline on the network thread.
+DISPATCH_WORKERS = 4
+DISPATCH_LANE_CAPACITY = 256
+DISPATCH_POLICY = "coalesce"  # or "drop_oldest"
+
+# /admin/* endpoints: with no token only loopback clients may call them,
+# otherwise the X-Admin-Token header (or ?token=) must match
+ADMIN_TOKEN = None
+LOOPBACK_ADDRS = ("127.0.0.1", "::1")
+
+# /api/stream (SSE). Each open dashboard holds one Flask thread here.
+LIVE_MAX_CLIENTS = 200
+LIVE_KEEPALIVE_SEC = 15
+LIVE_RETRY_MS = 3000
+
 DB_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "sensor.db"))
 
 # ----------------------
-# Local decision-engine helpers (mirror code/decision_engine.py)
+# Local decision-engine helpers (rules shared with backtest.py live in decision_engine.py)
 # ----------------------
-def load_recent(minutes=30, db_file=None):
+# load_recent / compute_thresholds are no longer on the message path
+# (sensor_cache + threshold_engine replaced them). They stay as the
+# DB-backed reference that threshold_engine is checked against and that
+# testing/benchmark.py times.
+def load_recent(minutes=30, db_file=None, device_id=DEVICE_ID):
     db_file = db_file or DB_FILE
     since = int(time.time()) - minutes * 60
     conn = sqlite3.connect(db_file)
     cur = conn.cursor()
     cur.execute(
-        "SELECT temperature, humidity, window FROM sensor_log WHERE time >= ?",
-        (since,)
+        "SELECT temperature, humidity, window FROM sensor_log WHERE device_id = ? AND time >= ? "
+        # Same rows ThresholdEngine.add() counts (sensor_log may hold partial rows)
+        "AND temperature IS NOT NULL AND humidity IS NOT NULL AND window IS NOT NULL",
+        (device_id, since)
     )
     rows = cur.fetchall()
     conn.close()
     return rows
 
 
-def load_recent_window_values(limit=10, db_file=None):
-    db_file = db_file or DB_FILE
-    conn = sqlite3.connect(db_file)
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT window FROM sensor_log ORDER BY time DESC LIMIT ?",
-        (limit,)
-    )
-    rows = cur.fetchall()
-    conn.close()
-
-    values = []
-    for (win,) in rows:
-        try:
-            if win is not None:
-                values.append(float(win))
-        except (TypeError, ValueError):
-            continue
-    return values
-
-def load_recent_CO2_values(limit=10, db_file=None):
-    db_file = db_file or DB_FILE
-    conn = sqlite3.connect(db_file)
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT co2_ppm FROM sensor_log ORDER BY time DESC LIMIT ?",
-        (limit,)
-    )
-    rows = cur.fetchall()
-    conn.close()
-
-    values = []
-    for (co2,) in rows:
-        try:
-            if co2 is not None:
-                values.append(float(co2))
-        except (TypeError, ValueError):
-            continue
-    return values
-
-def load_recent_TVOC_values(limit=10, db_file=None):
-    db_file = db_file or DB_FILE
-    conn = sqlite3.connect(db_file)
-    cur = conn.cursor()
-    try:
-        cur.execute(
-            "SELECT tvoc_ppb FROM sensor_log ORDER BY time DESC LIMIT ?",
-            (limit,)
-        )
-        rows = cur.fetchall()
-    except sqlite3.OperationalError:
-        rows = []
-    conn.close()
-
-    values = []
-    for (tvoc,) in rows:
-        try:
-            if tvoc is not None:
-                values.append(float(tvoc))
-        except (TypeError, ValueError):
-            continue
-    return values
-
-
-def trimmed_mean(values):
-    if not values:
-        return None
-    if len(values) < 3:
-        return sum(values) / len(values)
-    vals = sorted(values)
-    core = vals[1:-1]
-    return sum(core) / len(core)
-
-
 def compute_thresholds(rows):
     if len(rows) < 20:
         return dict(DEFAULT_THRESHOLDS)
@@ -169,30 +139,7 @@ def heater_decision_local(temp, hum, win, thresholds=None, last_state=None):
     th = dict(DEFAULT_THRESHOLDS)
     if thresholds:
         th.update(thresholds)
-
-    if win is None:
-        return "OFF", "No window data"
-
-    if win >= th["W_open"]:
-        return "OFF", "Window open – heating disabled"
-
-    if temp is None or hum is None:
-        return "OFF", "Missing temperature/humidity data"
-
-    if temp < th["T_cold"] and hum >= th["H_dry"]:
-        return "ON", "Temperature below adaptive threshold"
-
-    if temp < th["T_cold"] and hum < th["H_dry"]:
-        return "OFF", "Air too dry – heating not recommended"
-
-    if (
-        last_state == "ON"
-        and hum >= th["H_dry"]
-        and temp < th["T_cold"] + TEMP_OFF_HYSTERESIS
-    ):
-        return "ON", "Within hysteresis band"
-
-    return "OFF", "Temperature comfortable"
+    return heater_decision(temp, hum, win, th, last_state, TEMP_OFF_HYSTERESIS)
 
 # Health alert cooldown so you don't get spammed
 HEALTH_ALERT_COOLDOWN_SEC = 15 * 60
@@ -200,6 +147,9 @@ HEALTH_ALERT_COOLDOWN_SEC = 15 * 60
 # ======================
 # Server state (thread-safe)
 # ======================
+# state_lock only serialises settings updates. The dict is replaced, never
+# mutated, so the message path reads it without locking. Per-device state
+# (heater, alert cooldowns) lives in `devices`, each with its own lock.
 state_lock = threading.Lock()
 
 settings = {
@@ -210,8 +160,41 @@ settings = {
     "open_window_health_alert": "OFF",
 }
 
-last_published_heater = None  # "ON"/"OFF"
-last_health_alert_ts = 0.0
+devices = fleet.DeviceRegistry()
+
+# Rolling per-device sample store; replaces the per-message sensor_log reads
+sensor_cache = SensorCache(recent_limit=10, history_minutes=30)
+
+# ======================
+# Metrics (GET /metrics, see metrics.py)
+# ======================
+MQTT_MESSAGES = metrics.Counter("pc_mqtt_messages_total", "MQTT messages received by topic kind", ("kind",))
+DECODE_ERRORS = metrics.Counter(
+    "pc_heater_decode_errors_total", "Heater topic payloads not understood (sensor decode errors: pc_ingest_dropped_total)"
+)
+HEATER_PUBLISHES = metrics.Counter("pc_heater_publishes_total", "Heater commands published", ("command",))
+HEATER_DEDUPED = metrics.Counter(
+    "pc_heater_publishes_suppressed_total", "Heater commands not sent because the state is already set"
+)
+LATE_SAMPLES = metrics.Counter(
+    "pc_late_samples_total", "Sensor samples older than the newest seen for their device (not acted on)"
+)
+ALERTS_FIRED = metrics.Counter("pc_alerts_total", "Alerts sent, by type", ("type",))
+DECIDE_STAGE_SECONDS = metrics.Histogram(
+    "pc_decide_stage_seconds", "Time per decide_sample stage", ("stage",)
+)
+MQTT_CONNECTS = metrics.Counter("pc_mqtt_connects_total", "Successful MQTT (re)connects")
+MQTT_RECONNECTS = metrics.Counter("pc_mqtt_reconnects_total", "MQTT connects after the first one")
+MQTT_DISCONNECTS = metrics.Counter("pc_mqtt_disconnects_total", "MQTT connections lost")
+HTTP_SECONDS = metrics.Histogram(
+    "pc_http_request_seconds", "Time to the start of the HTTP response, by route", ("route", "method")
+)
+HTTP_REQUESTS = metrics.Counter("pc_http_requests_total", "HTTP responses", ("route", "method", "status"))
+
+# Bound once: these run for every sample
+_MSG_SENSORS = MQTT_MESSAGES.labels("sensors")
+_MSG_HEATER = MQTT_MESSAGES.labels("heater")
+_STAGE = {s: DECIDE_STAGE_SECONDS.labels(s) for s in ("cache_read", "alerts", "thresholds", "decision", "publish")}
 
 # ======================
 # MQTT Client
@@ -226,32 +209,37 @@ def _normalize_cmd(cmd) -> str | None:
     return c if c in ("ON", "OFF") else None
 
 
-def publish_heater(cmd: str, reason: str = ""):
+def publish_heater(cmd: str, reason: str = "", device_id: str = DEVICE_ID):
     """
-    Publish heater command to MQTT (JSON payload).
+    Publish heater command to MQTT (JSON payload) on cx/<device_id>/heater.
     cmd: "ON" or "OFF"
     """
-    global last_published_heater
-
     cmd = _normalize_cmd(cmd)
     if cmd is None:
         return
 
     # Avoid spamming the same value repeatedly
-    with state_lock:
-        if last_published_heater == cmd:
+    dev = devices.get(device_id)
+    with dev.lock:
+        if dev.last_published_heater == cmd:
+            HEATER_DEDUPED.inc()
             return
-        last_published_heater = cmd
+        dev.last_published_heater = cmd
 
+    HEATER_PUBLISHES.labels(cmd).inc()
+    topic = fleet.topic_for(device_id, "heater")
     payload = json.dumps({"command": cmd, "source": "server", "reason": reason})
-    mqtt_client.publish(TOPIC_HEATER, payload)
-    print(f"[MQTT] publish {TOPIC_HEATER} {payload}")
+    mqtt_client.publish(topic, payload)
+    print(f"[MQTT] publish {topic} {payload}")
+    live.publish(device_id, "heater", {"state": cmd, "reason": reason})
 
-def publish_alert(cmd: str, reason: str = ""):
+def publish_alert(cmd: str, reason: str = "", device_id: str = DEVICE_ID):
 
+    topic = fleet.topic_for(device_id, "alert")
     payload = json.dumps({"command": cmd, "reason": reason})
-    mqtt_client.publish(TOPIC_ALERT, payload)
-    print(f"[MQTT] publish {TOPIC_ALERT} {payload}")
+    mqtt_client.publish(topic, payload)
+    print(f"[MQTT] publish {topic} {payload}")
+    live.publish(device_id, "alert", {"command": cmd, "reason": reason, "time": int(time.time())})
 
 
 def send_phone_notification(title: str, message: str):
@@ -264,37 +252,40 @@ def send_phone_notification(title: str, message: str):
     print(f"[ALERT] {title}: {message}")
 
 
-def maybe_send_health_alert(temp: float | None, hum: float | None, window_is_open: bool):
-    global last_health_alert_ts
-
-    with state_lock:
-        enabled = (settings["open_window_health_alert"] == "ON")
+def maybe_send_health_alert(temp: float | None, hum: float | None, window_is_open: bool,
+                            device_id: str = DEVICE_ID):
+    enabled = (settings["open_window_health_alert"] == "ON")
 
     if not enabled:
         return
 
+    dev = devices.get(device_id)
     now = time.time()
-    if now - last_health_alert_ts < HEALTH_ALERT_COOLDOWN_SEC:
-        return
 
     # Only alert if conditions are "bad" AND window is NOT open (so "open window" makes sense)
     temp_bad = (temp is not None) and (temp < TEMP_BAD_LOW or temp > TEMP_BAD_HIGH)
     hum_bad = (hum is not None) and (hum < HUM_BAD_LOW or hum > HUM_BAD_HIGH)
 
-    if (temp_bad or hum_bad) and (not window_is_open):
-        last_health_alert_ts = now
-
-        parts = []
-        if temp is not None:
-            parts.append(f"Temp={temp:.1f}°C")
-        if hum is not None:
-            parts.append(f"Humidity={hum:.1f}%")
+    if not ((temp_bad or hum_bad) and (not window_is_open)):
+        return
 
-        msg = " / ".join(parts) if parts else "Unhealthy conditions detected"
-        send_phone_notification(
-            "Health alert: open window",
-            f"{msg}. Consider opening a window to improve comfort/air."
-        )
+    with dev.lock:
+        if now - dev.last_health_alert_ts < HEALTH_ALERT_COOLDOWN_SEC:
+            return
+        dev.last_health_alert_ts = now
+    ALERTS_FIRED.labels("health").inc()
+
+    parts = []
+    if temp is not None:
+        parts.append(f"Temp={temp:.1f}°C")
+    if hum is not None:
+        parts.append(f"Humidity={hum:.1f}%")
+
+    msg = " / ".join(parts) if parts else "Unhealthy conditions detected"
+    send_phone_notification(
+        "Health alert: open window",
+        f"{msg}. Consider opening a window to improve comfort/air."
+    )
 
 
 def _parse_json_or_text(payload: str) -> dict | None:
@@ -320,10 +311,20 @@ def pick_cmd(cmds):
 
 def on_message(client, userdata, msg):
     topic = msg.topic
-    raw = msg.payload.decode(errors="ignore").strip()
+    device_id, kind = fleet.parse_topic(topic)
+    if device_id is None:
+        MQTT_MESSAGES.labels("unknown").inc()
+        return
+    if kind == "sensors":
+        _MSG_SENSORS.inc()
+    elif kind == "heater":
+        _MSG_HEATER.inc()
+    else:
+        MQTT_MESSAGES.labels("other").inc()
 
     # --- Heater topic: accept raw "ON"/"OFF" or JSON {"command":"ON", ...}
-    if topic == TOPIC_HEATER:
+    if kind == "heater":
+        raw = msg.payload.decode(errors="ignore").strip()
         cmd = _normalize_cmd(raw)
         source = None
 
@@ -334,141 +335,162 @@ def on_message(client, userdata, msg):
                 source = obj.get("source")
 
         if cmd is None:
+            DECODE_ERRORS.inc()
             print("[MQTT] heater payload not understood:", raw)
             return
 
 
         # Track latest state to reduce server spam later
-        global last_published_heater
-        with state_lock:
-            last_published_heater = cmd
+        dev = devices.get(device_id)
+        with dev.lock:
+            dev.last_published_heater = cmd
+        live.publish(device_id, "heater", {"state": cmd})
 
-        print(f"[MQTT] heater state observed: {cmd} (source={source})")
+        print(f"[MQTT] {device_id} heater state observed: {cmd} (source={source})")
         return
 
-    # --- Sensor topic: JSON expected
-    if topic != TOPIC_SENSOR:
+    # --- Sensor topic: JSON, or the binary batch format (wire_format.py)
+    if kind != "sensors":
         return
 
     if(LOG_SENSOR_DATA):
-        print("Received Sensor Data:", raw)
+        print("Received Sensor Data:", msg.payload)
 
-    try:
-        data = json.loads(raw)
-    except json.JSONDecodeError:
-        print("Invalid JSON")
-        return
+    # decode -> validate -> persist (optional) -> handle_sample, per sample
+    ingest.process(topic, msg.payload)
 
-    window = data.get("window")
-    temperature = data.get("temperature")
-    humidity = data.get("humidity")
-    co2_ppm = data.get("co2_ppm")
-    tvoc_ppb = data.get("tvoc_ppb")
 
-    def to_float(x):
-        try:
-            return float(x) if x is not None else None
-        except (TypeError, ValueError):
-            return None
-
-    window_val = to_float(window)
-    temp_val = to_float(temperature)
-    hum_val = to_float(humidity)
-    co2_val = to_float(co2_ppm)
-    tvoc_val = to_float(tvoc_ppb)
-
-    if window_val is None:
-        print("No valid window value in payload")
+def handle_sample(sample):
+    """
+    Runs on the network thread: record the sample in the cache (cheap), then
+    queue the decision. Coalesced or shed decisions still leave every sample
+    in the moving averages and thresholds.
+    """
+    if not sensor_cache.append(sample.device_id, sample.time, sample.values()):
+        # Late (RP1 backlog after an outage): persisted and in the threshold
+        # window, but too old to push live or to drive the heater
+        LATE_SAMPLES.inc()
         return
-
-    # window average from DB: last 10 values, drop min/max
-    win_values = load_recent_window_values(limit=10, db_file="sensor.db")
-    avg_window = trimmed_mean(win_values)
-    if avg_window is None:
-        avg_window = window_val
-
-    window_is_open = avg_window > WINDOW_OPEN_THRESHOLD
+    frame = {"time": sample.time, **sample.values()}
+    if sample.window_quality is not None:
+        frame["window_quality"] = sample.window_quality
+    live.publish(sample.device_id, "sensors", frame)
+    if dispatcher is None:
+        decide_sample(sample)
+    else:
+        dispatcher.submit(sample.device_id, sample)
+
+
+def decide_sample(sample):
+    """Decision logic for one decoded, validated SensorSample."""
+    device_id = sample.device_id
+    dev = devices.get(device_id)
+    cfg = settings  # immutable snapshot, see state_lock
+
+    window_val = sample.window
+    temp_val = sample.temperature
+    hum_val = sample.humidity
+    co2_val = sample.co2_ppm
+    tvoc_val = sample.tvoc_ppb
+
+    t0 = time.perf_counter()
+    # window average from cache: last 10 values, drop min/max; no window
+    # reading for WINDOW_HOLD_SEC fails safe, as if open
+    last_window_t = sensor_cache.last_seen_time(device_id, "window")
+    avg_window, window_is_open = window_state(
+        window_val,
+        sensor_cache.recent_values(device_id, "window", limit=10),
+        None if last_window_t is None else sample.time - last_window_t,
+        WINDOW_OPEN_THRESHOLD,
+        WINDOW_HOLD_SEC,
+    )
     if(LOG_MOVING_AVG):
-        print("Moving Average window:", avg_window, "window_is_open:", window_is_open)
+        print(device_id, "Moving Average window:", avg_window, "window_is_open:", window_is_open)
 
+    t1 = time.perf_counter()
     # health alert hook
-    maybe_send_health_alert(temp_val, hum_val, window_is_open)
+    maybe_send_health_alert(temp_val, hum_val, window_is_open, device_id)
 
-    co2_values = load_recent_CO2_values(limit=10, db_file="sensor.db")
+    t2 = time.perf_counter()
+    co2_values = sensor_cache.recent_values(device_id, "co2_ppm", limit=10)
     avg_co2 = trimmed_mean(co2_values)
     if avg_co2 is None:
         avg_co2 = co2_val
 
-    
-    global last_co2_alert_ts
-    now_ts = time.time()
-    with state_lock:
-        window_alert_enabled = (settings["open_window_health_alert"] == "ON")
-
-    co2_condition = (
-        window_alert_enabled
-        and avg_co2 is not None
-        and avg_co2 > CO2_ALERT_THRESHOLD
-        and not window_is_open
-        and (now_ts - last_co2_alert_ts) >= CO2_ALERT_COOLDOWN_SEC
-    )
-
-    if co2_condition:
-        last_co2_alert_ts = now_ts
-        publish_alert("Please consider opening your window", "Unhealthy CO2 Level.")
-
-    global last_hum_alert_ts
-    hum_condition = (
-        window_alert_enabled
-        and hum_val is not None
-        and hum_val > HUM_BAD_HIGH
-        and not window_is_open
-        and (now_ts - last_hum_alert_ts) >= HUM_ALERT_COOLDOWN_SEC
-    )
-    if hum_condition:
-        last_hum_alert_ts = now_ts
-        publish_alert("Please consider opening your window", "High humidity detected.")
-
-    tvoc_values = load_recent_TVOC_values(limit=10, db_file="sensor.db")
+    tvoc_values = sensor_cache.recent_values(device_id, "tvoc_ppb", limit=10)
     avg_tvoc = trimmed_mean(tvoc_values)
     if avg_tvoc is None:
         avg_tvoc = tvoc_val
 
-    global last_tvoc_alert_ts
-    tvoc_condition = (
-        window_alert_enabled
-        and avg_tvoc is not None
-        and avg_tvoc > TVOC_ALERT_THRESHOLD
-        and not window_is_open
-        and (now_ts - last_tvoc_alert_ts) >= TVOC_ALERT_COOLDOWN_SEC
-    )
-    if tvoc_condition:
-        last_tvoc_alert_ts = now_ts
-        publish_alert("Please consider opening your window", "High TVOC detected.")
-    
+    t3 = time.perf_counter()
+    _STAGE["cache_read"].observe((t1 - t0) + (t3 - t2))
+
+    now_ts = time.time()
+    window_alert_enabled = (cfg["open_window_health_alert"] == "ON")
+    alerts = []
+
+    with dev.lock:
+        co2_condition = (
+            window_alert_enabled
+            and avg_co2 is not None
+            and avg_co2 > CO2_ALERT_THRESHOLD
+            and not window_is_open
+            and (now_ts - dev.last_co2_alert_ts) >= CO2_ALERT_COOLDOWN_SEC
+        )
+        if co2_condition:
+            dev.last_co2_alert_ts = now_ts
+            alerts.append(("co2", "Unhealthy CO2 Level."))
+
+        hum_condition = (
+            window_alert_enabled
+            and hum_val is not None
+            and hum_val > HUM_BAD_HIGH
+            and not window_is_open
+            and (now_ts - dev.last_hum_alert_ts) >= HUM_ALERT_COOLDOWN_SEC
+        )
+        if hum_condition:
+            dev.last_hum_alert_ts = now_ts
+            alerts.append(("humidity", "High humidity detected."))
+
+        tvoc_condition = (
+            window_alert_enabled
+            and avg_tvoc is not None
+            and avg_tvoc > TVOC_ALERT_THRESHOLD
+            and not window_is_open
+            and (now_ts - dev.last_tvoc_alert_ts) >= TVOC_ALERT_COOLDOWN_SEC
+        )
+        if tvoc_condition:
+            dev.last_tvoc_alert_ts = now_ts
+            alerts.append(("tvoc", "High TVOC detected."))
+
+        current_heater_state = dev.last_published_heater
+        last_co2_alert_ts = dev.last_co2_alert_ts
+
+    # Publish outside the device lock
+    for alert_type, alert_reason in alerts:
+        ALERTS_FIRED.labels(alert_type).inc()
+        publish_alert("Please consider opening your window", alert_reason, device_id)
+    t4 = time.perf_counter()
+    _STAGE["alerts"].observe((t2 - t1) + (t4 - t3))
 
     # Read settings (no manual override timer anymore)
-    with state_lock:
-        auto_off_mode = settings["auto_off_mode"]
-        auto_on_mode = settings["auto_on_mode"]
+    auto_off_mode = cfg["auto_off_mode"]
+    auto_on_mode = cfg["auto_on_mode"]
 
-    # Adaptive thresholds from last 30 minutes (DB-backed)
+    # Adaptive thresholds from last 30 minutes (streaming, cache-backed)
     try:
-        rows = load_recent(minutes=30, db_file="sensor.db")
-        th = compute_thresholds(rows)
+        th = sensor_cache.thresholds(device_id, defaults=DEFAULT_THRESHOLDS)
     except Exception as e:
         print("Threshold compute failed:", e)
         th = dict(DEFAULT_THRESHOLDS)
     th["W_open"] = WINDOW_OPEN_THRESHOLD
-    with state_lock:
-        current_heater_state = last_published_heater
+    t5 = time.perf_counter()
+    _STAGE["thresholds"].observe(t5 - t4)
 
     # Auto logic based on settings
     cmds = []
     reason = None
 
-    global last_heater_alert_ts
-    now_ts = time.time()
     # Automatic window-based actions
     if window_is_open:
         if auto_off_mode == "Automatic":
@@ -478,9 +500,10 @@ def on_message(client, userdata, msg):
             send_alert = (time.time()-last_co2_alert_ts >= HEATER_ALERT_COOLDOWN_SEC
                           and current_heater_state == "ON")
             if(send_alert):
-                publish_alert("Please consider turning off you heater", "Window is Opened")
+                ALERTS_FIRED.labels("heater_window_open").inc()
+                publish_alert("Please consider turning off you heater", "Window is Opened", device_id)
                 send_phone_notification(
-                    "Window open",
+                    f"Window open ({device_id})",
                     "Window appears open. Heater NOT auto-turned off (Alert mode)."
                 )
     else:
@@ -491,9 +514,10 @@ def on_message(client, userdata, msg):
             send_alert = (time.time()-last_co2_alert_ts >= HEATER_ALERT_COOLDOWN_SEC
                 and current_heater_state == "OFF")
             if(send_alert):
-                publish_alert("Please consider turning on you heater", "Window is Shut")
+                ALERTS_FIRED.labels("heater_window_shut").inc()
+                publish_alert("Please consider turning on you heater", "Window is Shut", device_id)
                 send_phone_notification(
-                    "Window shut",
+                    f"Window shut ({device_id})",
                     "Window appears shut. Heater NOT auto-turned on (Alert mode)."
                 )
 
@@ -515,67 +539,122 @@ def on_message(client, userdata, msg):
             reason = reason_engine
 
     final_cmd = pick_cmd(cmds)
+    t6 = time.perf_counter()
+    _STAGE["decision"].observe(t6 - t5)
     if final_cmd:
-        publish_heater(final_cmd, reason=reason or "Auto decision")
+        publish_heater(final_cmd, reason=reason or "Auto decision", device_id=device_id)
+        _STAGE["publish"].observe(time.perf_counter() - t6)
     if(LOG_AUTO_MODE):
         print("Off Mode: ", auto_off_mode, ", On Mode: ", auto_on_mode)
 
 
+ingest_writer = BatchWriter(DB_FILE, on_flush=[rollups.apply_rows]) if INGEST_PERSIST else None
+# Whoever writes the database also expires old partitions (PC_logger otherwise)
+retention_job = RetentionJob(DB_FILE) if INGEST_PERSIST else None
+ingest = IngestPipeline(writer=ingest_writer, decide=handle_sample)
+# Dashboard clients share the server's MQTT subscription via /api/stream
+live = Broadcaster(max_clients=LIVE_MAX_CLIENTS)
+dispatcher = (
+    Dispatcher(decide_sample, DISPATCH_WORKERS, DISPATCH_LANE_CAPACITY, DISPATCH_POLICY)
+    if DISPATCH_WORKERS > 0 else None
+)
+
+
+# Read at scrape time, nothing to update per message
+metrics.Gauge("pc_live_clients", "Connected /api/stream clients", fn=lambda: live.client_count())
+metrics.Gauge("pc_devices", "Devices seen since start", fn=lambda: len(devices))
+metrics.Gauge("pc_dispatch_queue_depth", "Decisions waiting in the dispatcher",
+              fn=lambda: dispatcher.stats()["queue_depth"] if dispatcher is not None else 0)
+metrics.Counter("pc_dispatch_shed_total", "Decisions shed by the dispatcher", ("action",),
+                fn=lambda: _dispatch_shed())
+
+
+def _dispatch_shed():
+    if dispatcher is None:
+        return {}
+    stats = dispatcher.stats()
+    return {"dropped": stats["dropped"], "coalesced": stats["coalesced"]}
+
+
+def record_mqtt_connect():
+    if MQTT_CONNECTS.value() >= 1:
+        MQTT_RECONNECTS.inc()
+    MQTT_CONNECTS.inc()
+
+
+def on_connect(client, userdata, flags, rc):
+    if rc != 0:
+        print(f"[MQTT] connect refused (rc={rc})")
+        return
+    record_mqtt_connect()
+    # Subscribing here (not once before the loop) restores the
+    # subscriptions after paho reconnects with a clean session
+    client.subscribe([(TOPIC_SENSOR, 0), (TOPIC_HEATER, 0)])
+
+
+def on_disconnect(client, userdata, rc):
+    if rc != 0:
+        MQTT_DISCONNECTS.inc()
+        print(f"[MQTT] connection lost (rc={rc}), reconnecting")
 
 
 def mqtt_loop():
-    mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-    mqtt_client.subscribe([(TOPIC_SENSOR, 0), (TOPIC_HEATER, 0)])
+    applied = schema.ensure_schema(DB_FILE)
+    if applied:
+        print(f"[DB] migrated {DB_FILE} to schema {applied[-1]}")
+    if dispatcher is not None:
+        dispatcher.start()
+    if ingest_writer is not None:
+        ingest_writer.start()
+        atexit.register(ingest_writer.close, 5)
+    if retention_job is not None:
+        retention_job.start()
+        atexit.register(retention_job.stop, 5)
+    warmed = sensor_cache.warm_all_from_db(DB_FILE)
+    print(f"[CACHE] warmed {len(warmed)} device(s) with {sum(warmed.values())} rows from {DB_FILE}")
+    mqtt_client.on_connect = on_connect
+    mqtt_client.on_disconnect = on_disconnect
     mqtt_client.on_message = on_message
+    mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
     mqtt_client.loop_forever()
 
 
-threading.Thread(target=mqtt_loop, daemon=True).start()
+def start_mqtt():
+    threading.Thread(target=mqtt_loop, name="mqtt-loop", daemon=True).start()
 
-# ======================
-# Flask Routes
-# ======================
-@app.route("/")
-def index():
-    with state_lock:
-        current_state = last_published_heater
-    return render_template("index.html", current_heater_state=current_state)
 
+# ----------------------
+# HTTP handlers shared by the Flask routes and PC_server_async
+# ----------------------
+def valid_device_id(device_id: str) -> bool:
+    return bool(device_id.strip()) and not any(c in device_id for c in "/+#")
 
-@app.route("/api/heater", methods=["POST"])
-def api_heater():
-    """
-    Receives heater command from UI (HTTP), publishes MQTT from server.
-    JSON: { "command": "ON" | "OFF" }
-    """
-    data = request.get_json(silent=True) or {}
+
+def heater_state(device_id: str = DEVICE_ID) -> str | None:
+    dev = devices.get(device_id)
+    with dev.lock:
+        return dev.last_published_heater
+
+
+def heater_command(data: dict) -> tuple[dict, int]:
     cmd = _normalize_cmd(data.get("command"))
 
     if cmd is None:
-        return jsonify({"error": "command must be ON or OFF"}), 400
+        return {"error": "command must be ON or OFF"}, 400
 
-    publish_heater(cmd, reason="manual http")
+    device_id = str(data.get("device") or DEVICE_ID)
+    if not valid_device_id(device_id):
+        return {"error": "invalid device"}, 400
 
-    with state_lock:
-        current_settings = dict(settings)
+    publish_heater(cmd, reason="manual http", device_id=device_id)
 
-    return jsonify({"ok": True, "state": cmd, "settings": current_settings})
+    current_settings = dict(settings)
 
+    return {"ok": True, "state": cmd, "settings": current_settings}, 200
 
-@app.route("/api/settings", methods=["GET", "POST"])
-def api_settings():
-    """
-    GET returns current settings
-    POST accepts partial updates:
-      - auto_off_mode:        "Automatic" | "Smart" | "Alert" | "Off"
-      - auto_on_mode:         "Automatic" | "Smart" | "Alert" | "Off"
-      - open_window_health_alert: "ON" | "OFF"
-    """
-    if request.method == "GET":
-        with state_lock:
-            return jsonify(settings)
 
-    data = request.get_json(silent=True) or {}
+def update_settings(data: dict) -> tuple[dict, int]:
+    global settings
 
     def valid_mode(v): return v in ("Automatic", "Smart", "Alert", "Off")
     def valid_onoff(v): return v in ("ON", "OFF")
@@ -585,29 +664,204 @@ def api_settings():
     if "auto_off_mode" in data:
         v = str(data["auto_off_mode"])
         if not valid_mode(v):
-            return jsonify({"error": "auto_off_mode must be Automatic, Smart, Alert, or Off"}), 400
+            return {"error": "auto_off_mode must be Automatic, Smart, Alert, or Off"}, 400
         patch["auto_off_mode"] = v
 
     if "auto_on_mode" in data:
         v = str(data["auto_on_mode"])
         if not valid_mode(v):
-            return jsonify({"error": "auto_on_mode must be Automatic, Smart, Alert, or Off"}), 400
+            return {"error": "auto_on_mode must be Automatic, Smart, Alert, or Off"}, 400
         patch["auto_on_mode"] = v
 
     if "open_window_health_alert" in data:
         v = str(data["open_window_health_alert"]).upper()
         if not valid_onoff(v):
-            return jsonify({"error": "open_window_health_alert must be ON or OFF"}), 400
+            return {"error": "open_window_health_alert must be ON or OFF"}, 400
         patch["open_window_health_alert"] = v
 
     with state_lock:
-        settings.update(patch)
+        settings = {**settings, **patch}
         updated = dict(settings)
 
-    return jsonify({"ok": True, "settings": updated})
+    return {"ok": True, "settings": updated}, 200
+
+
+def ingest_stats() -> dict:
+    stats = ingest.stats()
+    if dispatcher is not None:
+        stats["dispatch"] = dispatcher.stats()
+    if retention_job is not None:
+        stats["retention"] = retention_job.stats()
+    stats["live_clients"] = live.client_count()
+    return stats
+
+
+def admin_allowed(remote_addr: str | None, token: str | None) -> bool:
+    if ADMIN_TOKEN is None:
+        return remote_addr in LOOPBACK_ADDRS
+    return token == ADMIN_TOKEN
+
+
+def profile_request(args) -> tuple[str | dict, int]:
+    """
+    Runs a time-boxed sampling profile of this process (blocks for its duration).
+    Returns (collapsed-stack text, 200), or a JSON-able error / stats body.
+    """
+    try:
+        seconds = float(args.get("seconds", profiler.SECONDS))
+        hz = float(args.get("hz", profiler.HZ))
+    except ValueError:
+        return {"error": "seconds and hz must be numbers"}, 400
+    if not (math.isfinite(seconds) and math.isfinite(hz)):
+        return {"error": "seconds and hz must be finite"}, 400
+    fmt = args.get("format", "collapsed")
+    if fmt not in ("collapsed", "json"):
+        return {"error": "format must be collapsed or json"}, 400
+
+    print(f"[PROFILE] sampling all threads for {seconds}s at {hz} Hz")
+    result = profiler.run(seconds, hz)
+    if result is None:
+        return {"error": "a profile is already running"}, 409
+    print(f"[PROFILE] done: {result.stats()}")
+    if fmt == "json":
+        return {**result.stats(), "stacks": dict(result.stacks.most_common())}, 200
+    return result.collapsed(), 200
+
+
+def record_http(route: str, method: str, status: int, seconds: float):
+    HTTP_SECONDS.labels(route, method).observe(seconds)
+    HTTP_REQUESTS.labels(route, method, status).inc()
+
+
+# ======================
+# Flask Routes
+# ======================
+@app.before_request
+def _http_timer_start():
+    g.request_t0 = time.perf_counter()
+
+
+@app.after_request
+def _http_timer_stop(response):
+    t0 = g.get("request_t0")
+    if t0 is not None:
+        # Rule pattern, not the raw path, keeps label cardinality bounded
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        record_http(route, request.method, response.status_code, time.perf_counter() - t0)
+    return response
+
+
+@app.route("/")
+def index():
+    device_id = request.args.get("device") or DEVICE_ID
+    if not valid_device_id(device_id):
+        device_id = DEVICE_ID
+    return render_template("index.html", current_heater_state=heater_state(device_id))
+
+
+@app.route("/api/heater", methods=["POST"])
+def api_heater():
+    """
+    Receives heater command from UI (HTTP), publishes MQTT from server.
+    JSON: { "command": "ON" | "OFF", "device": optional, defaults to DEVICE_ID }
+    """
+    data = request.get_json(silent=True) or {}
+    if "device" not in data and request.args.get("device"):
+        data["device"] = request.args.get("device")
+    body, status = heater_command(data)
+    return jsonify(body), status
+
+
+@app.route("/api/settings", methods=["GET", "POST"])
+def api_settings():
+    """
+    GET returns current settings
+    POST accepts partial updates:
+      - auto_off_mode:        "Automatic" | "Smart" | "Alert" | "Off"
+      - auto_on_mode:         "Automatic" | "Smart" | "Alert" | "Off"
+      - open_window_health_alert: "ON" | "OFF"
+    """
+    if request.method == "GET":
+        return jsonify(settings)
+
+    data = request.get_json(silent=True) or {}
+    body, status = update_settings(data)
+    return jsonify(body), status
+
+
+@app.route("/api/history", methods=["GET"])
+def api_history():
+    """
+    Columnar, downsampled history for one device and metric.
+    Query: device, metric, from, to (epoch seconds), points, resolution (raw|1m|1h, optional)
+    """
+    body, status = history.history_request(DB_FILE, request.args, time.time(), DEVICE_ID)
+    return jsonify(body), status
+
+
+@app.route("/api/stream", methods=["GET"])
+def api_stream():
+    """
+    Server-Sent Events: live "sensors" / "heater" / "alert" frames.
+    Query: device (default DEVICE_ID, "*" for all), rate (frames/s, default 1),
+    delta (1 = only changed fields, default; 0 = full state every frame)
+    """
+    try:
+        device_id, rate, deltas = parse_stream_args(request.args, DEVICE_ID)
+    except ValueError:
+        return jsonify({"error": "rate must be a positive, finite number"}), 400
+    if device_id != ALL_DEVICES and not valid_device_id(device_id):
+        return jsonify({"error": "invalid device"}), 400
+    sub = live.subscribe(device_id, rate, deltas)
+    if sub is None:
+        return jsonify({"error": "too many live clients"}), 503
+
+    def events():
+        try:
+            yield f"retry: {LIVE_RETRY_MS}\n\n"
+            while True:
+                frames = sub.wait(LIVE_KEEPALIVE_SEC)
+                if not frames:
+                    yield ": keepalive\n\n"
+                for event, data in frames:
+                    yield sse_frame(event, data)
+        finally:
+            sub.close()
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/api/ingest/stats", methods=["GET"])
+def api_ingest_stats():
+    """Per-stage ingestion timings, writer counters and dispatch queue/drop counts."""
+    return jsonify(ingest_stats())
+
+
+@app.route("/admin/profile", methods=["GET"])
+def api_admin_profile():
+    """
+    Samples every thread (paho loop, dispatcher workers, request threads) for
+    a while and returns collapsed stacks for flamegraph.pl / speedscope.
+    Query: seconds (default 10, max 60), hz (default 100, max 250), format (collapsed|json)
+    """
+    token = request.headers.get("X-Admin-Token") or request.args.get("token")
+    if not admin_allowed(request.remote_addr, token):
+        return jsonify({"error": "forbidden"}), 403
+    body, status = profile_request(request.args)
+    if isinstance(body, dict):
+        return jsonify(body), status
+    return Response(body, content_type="text/plain; charset=utf-8"), status
+
+
+@app.route("/metrics", methods=["GET"])
+def api_metrics():
+    """Prometheus text format (see metrics.py)."""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
 
 
 if __name__ == "__main__":
+    start_mqtt()
     app.run(
         host="0.0.0.0",
         port=8000,
@@ -0,0 +1,341 @@
+"""
+Asyncio entry point for the heater server.
+
+Runs MQTT consumption, the decision logic and the HTTP API on one event loop
+instead of Flask's dev server + a paho loop thread + a worker pool. The
+decision code, settings and device state are the ones in PC_server; only the
+transport differs. HTTP routes keep the contract used by
+templates/index.html:
+
+    GET  /                   dashboard
+    POST /api/heater         {"command": "ON"|"OFF", "device"?: str}
+    GET  /api/settings
+    POST /api/settings       partial settings update
+    GET  /api/history
+    GET  /api/stream         Server-Sent Events (see live_push.py)
+    GET  /api/ingest/stats
+    GET  /metrics            Prometheus text format (see metrics.py)
+    GET  /admin/profile      sampling profile, collapsed stacks (see profiler.py)
+
+Blocking sqlite work (schema migration, cache warm-up) goes through the
+loop's default executor; sample persistence uses the BatchWriter thread when
+PC_server.INGEST_PERSIST is set.
+
+Extra dependencies: aiomqtt (>= 2.0) and uvicorn.
+
+    python PC_server_async.py
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl
+
+CODE_DIR = os.path.abspath(os.path.dirname(__file__))
+if CODE_DIR not in sys.path:
+    sys.path.append(CODE_DIR)
+
+try:
+    import aiomqtt
+    import uvicorn
+except ImportError as e:
+    raise SystemExit(f"PC_server_async needs aiomqtt and uvicorn ({e})")
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+import PC_server as core
+import history
+import live_push
+import metrics
+import schema
+
+HTTP_HOST = "0.0.0.0"
+HTTP_PORT = 8000
+MQTT_RECONNECT_SEC = 5
+
+templates = Environment(
+    loader=FileSystemLoader(os.path.join(CODE_DIR, "templates")),
+    autoescape=select_autoescape(["html"]),
+)
+
+
+class LoopPublisher:
+    """
+    Stands in for PC_server.mqtt_client so publish_heater / publish_alert
+    send through the aiomqtt client. Safe to call from any thread.
+    """
+
+    def __init__(self, loop):
+        # Must be created on the loop's own thread
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.client = None
+        self._tasks = set()
+
+    def publish(self, topic, payload, qos=0):
+        if self.client is None:
+            print(f"[MQTT] not connected, dropped publish to {topic}")
+            return
+        coro = self.client.publish(topic, payload, qos=qos)
+        if threading.get_ident() == self.loop_thread_id:
+            task = self.loop.create_task(coro)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+async def mqtt_consumer(publisher):
+    while True:
+        try:
+            async with aiomqtt.Client(core.MQTT_BROKER, core.MQTT_PORT, keepalive=60) as client:
+                publisher.client = client
+                await client.subscribe(core.TOPIC_SENSOR)
+                await client.subscribe(core.TOPIC_HEATER)
+                core.record_mqtt_connect()
+                print(f"[MQTT] connected to {core.MQTT_BROKER}:{core.MQTT_PORT}")
+                async for message in client.messages:
+                    msg = _Message(str(message.topic), message.payload)
+                    try:
+                        core.on_message(None, None, msg)
+                    except Exception as e:
+                        print("Message handling failed:", e)
+        except aiomqtt.MqttError as e:
+            if publisher.client is not None:
+                core.MQTT_DISCONNECTS.inc()
+            publisher.client = None
+            print(f"[MQTT] connection lost ({e}); retrying in {MQTT_RECONNECT_SEC}s")
+            await asyncio.sleep(MQTT_RECONNECT_SEC)
+
+
+class _Message:
+    """Minimal paho-style message so PC_server.on_message can be reused."""
+
+    __slots__ = ("topic", "payload")
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload if isinstance(payload, (bytes, bytearray)) else str(payload).encode()
+
+
+# ======================
+# ASGI app
+# ======================
+async def _read_body(receive):
+    chunks = []
+    while True:
+        event = await receive()
+        chunks.append(event.get("body", b""))
+        if not event.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _send(send, status, body, content_type):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_json(send, obj, status=200):
+    await _send(send, status, json.dumps(obj).encode(), b"application/json")
+
+
+def _json_body(body):
+    try:
+        data = json.loads(body or b"{}")
+    except json.JSONDecodeError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def _stream(send, receive, sub):
+    """
+    SSE response for one subscriber. Polls the subscription at its frame
+    rate instead of parking a thread per client; stops on http.disconnect.
+    """
+    disconnected = asyncio.Event()
+
+    async def watch():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        disconnected.set()
+
+    watcher = asyncio.create_task(watch())
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")],
+        })
+        await send({"type": "http.response.body", "body": f"retry: {core.LIVE_RETRY_MS}\n\n".encode(),
+                    "more_body": True})
+        idle = 0.0
+        while not disconnected.is_set():
+            frames = sub.poll()
+            if frames:
+                body = "".join(live_push.sse_frame(event, data) for event, data in frames)
+                idle = 0.0
+            elif idle >= core.LIVE_KEEPALIVE_SEC:
+                body = ": keepalive\n\n"
+                idle = 0.0
+            else:
+                body = None
+            if body:
+                await send({"type": "http.response.body", "body": body.encode(), "more_body": True})
+            try:
+                await asyncio.wait_for(disconnected.wait(), sub.interval)
+            except asyncio.TimeoutError:
+                idle += sub.interval
+    except OSError:
+        pass
+    finally:
+        watcher.cancel()
+        sub.close()
+
+
+def _query(scope):
+    return dict(parse_qsl(scope.get("query_string", b"").decode()))
+
+
+ROUTES = {"/", "/api/heater", "/api/settings", "/api/history", "/api/stream", "/api/ingest/stats", "/metrics",
+          "/admin/profile"}
+
+
+async def app(scope, receive, send):
+    """Times every request to the start of its response (streams are not timed to the end)."""
+    if scope["type"] != "http":
+        return
+    t0 = time.perf_counter()
+    route = scope["path"] if scope["path"] in ROUTES else "unmatched"
+
+    async def timed_send(event):
+        if event["type"] == "http.response.start":
+            core.record_http(route, scope["method"], event["status"], time.perf_counter() - t0)
+        await send(event)
+
+    await _route(scope, receive, timed_send)
+
+
+async def _route(scope, receive, send):
+    path = scope["path"]
+    method = scope["method"]
+    query = _query(scope)
+
+    if path == "/" and method == "GET":
+        device_id = query.get("device") or core.DEVICE_ID
+        if not core.valid_device_id(device_id):
+            device_id = core.DEVICE_ID
+        html = templates.get_template("index.html").render(
+            current_heater_state=core.heater_state(device_id)
+        )
+        await _send(send, 200, html.encode(), b"text/html; charset=utf-8")
+        return
+
+    if path == "/api/heater" and method == "POST":
+        data = _json_body(await _read_body(receive))
+        if "device" not in data and query.get("device"):
+            data["device"] = query["device"]
+        body, status = core.heater_command(data)
+        await _send_json(send, body, status)
+        return
+
+    if path == "/api/settings" and method == "GET":
+        await _send_json(send, core.settings)
+        return
+
+    if path == "/api/settings" and method == "POST":
+        body, status = core.update_settings(_json_body(await _read_body(receive)))
+        await _send_json(send, body, status)
+        return
+
+    if path == "/api/history" and method == "GET":
+        loop = asyncio.get_running_loop()
+        body, status = await loop.run_in_executor(
+            None, history.history_request, core.DB_FILE, query, time.time(), core.DEVICE_ID
+        )
+        await _send_json(send, body, status)
+        return
+
+    if path == "/api/stream" and method == "GET":
+        try:
+            device_id, rate, deltas = live_push.parse_stream_args(query, core.DEVICE_ID)
+        except ValueError:
+            await _send_json(send, {"error": "rate must be a positive, finite number"}, 400)
+            return
+        if device_id != live_push.ALL_DEVICES and not core.valid_device_id(device_id):
+            await _send_json(send, {"error": "invalid device"}, 400)
+            return
+        sub = core.live.subscribe(device_id, rate, deltas)
+        if sub is None:
+            await _send_json(send, {"error": "too many live clients"}, 503)
+            return
+        await _stream(send, receive, sub)
+        return
+
+    if path == "/api/ingest/stats" and method == "GET":
+        await _send_json(send, core.ingest_stats())
+        return
+
+    if path == "/metrics" and method == "GET":
+        await _send(send, 200, metrics.REGISTRY.render().encode(), metrics.CONTENT_TYPE.encode())
+        return
+
+    if path == "/admin/profile" and method == "GET":
+        headers = dict(scope.get("headers") or [])
+        token = headers.get(b"x-admin-token", b"").decode() or query.get("token")
+        client = scope.get("client") or (None, None)
+        if not core.admin_allowed(client[0], token):
+            await _send_json(send, {"error": "forbidden"}, 403)
+            return
+        # Sampling blocks for the whole duration; keep it off the loop (which
+        # it then samples like any other thread)
+        loop = asyncio.get_running_loop()
+        body, status = await loop.run_in_executor(None, core.profile_request, query)
+        if isinstance(body, dict):
+            await _send_json(send, body, status)
+        else:
+            await _send(send, status, body.encode(), b"text/plain; charset=utf-8")
+        return
+
+    await _send_json(send, {"error": "not found"}, 404)
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+
+    applied = await loop.run_in_executor(None, schema.ensure_schema, core.DB_FILE)
+    if applied:
+        print(f"[DB] migrated {core.DB_FILE} to schema {applied[-1]}")
+    warmed = await loop.run_in_executor(None, core.sensor_cache.warm_all_from_db, core.DB_FILE)
+    print(f"[CACHE] warmed {len(warmed)} device(s) from {core.DB_FILE}")
+
+    publisher = LoopPublisher(loop)
+    core.mqtt_client = publisher
+    # Decisions run inline on the loop, so they stay in arrival order per device
+    core.dispatcher = None
+    if core.ingest_writer is not None:
+        core.ingest_writer.start()
+    if core.retention_job is not None:
+        core.retention_job.start()
+
+    server = uvicorn.Server(uvicorn.Config(
+        app, host=HTTP_HOST, port=HTTP_PORT, lifespan="off", log_level="warning",
+    ))
+    consumer = asyncio.create_task(mqtt_consumer(publisher))
+    try:
+        await server.serve()
+    finally:
+        consumer.cancel()
+        if core.retention_job is not None:
+            core.retention_job.stop(5)
+        if core.ingest_writer is not None:
+            await loop.run_in_executor(None, core.ingest_writer.close, 5)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
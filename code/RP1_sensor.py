@@ -3,24 +3,79 @@ from smbus2 import SMBus, i2c_msg
 import paho.mqtt.client as mqtt
 import json
 import threading
-import gpiod
+
+import sampling
+import wire_format
+from backlog import DiskRing
+from deadband import Deadband
+from ultrasonic import HCSR04
 
 # MQTT def
 client = mqtt.Client()
 Broker = "10.215.255.119"
 PORT = 1883
 # client.username_pw_set("tfboys","Abc12345")
-TOPIC = "cx/iotbox01/sensors"
-TOPIC_heater = "cx/iotbox01/heater"
+DEVICE_ID = "iotbox01"  # unique per box: topics are cx/<DEVICE_ID>/...
+TOPIC = f"cx/{DEVICE_ID}/sensors"
+TOPIC_heater = f"cx/{DEVICE_ID}/heater"
+
+# "binary" = wire_format.py (19 bytes/sample), "json" = the original payload.
+# The server and PC_logger accept both.
+PAYLOAD_FORMAT = "binary"
+# Samples per MQTT message. Above 1 the server sees readings up to
+# BATCH_SIZE seconds late, so window-open reactions slow down accordingly.
+BATCH_SIZE = 1
+
+# Store-and-forward: readings taken while disconnected go to a ring buffer on
+# the SD card (backlog.py) and are sent as batches once the broker is back.
+BACKLOG_FILE = "rp1_backlog.bin"
+BACKLOG_CAPACITY = 3 * 24 * 3600  # samples; oldest are overwritten when full
+# Backlog drain: at most one batch in flight (QoS 1), DRAIN_BATCH samples each,
+# so a day offline catches up in ~5 minutes while live samples still go first
+DRAIN_BATCH = 300
+
+# Deadband publishing: a field is only sent when it moved past its deadband,
+# and a full sample goes out every HEARTBEAT_SEC. Left-out fields are held
+# by the server (ingest.HoldState, sensor_cache gap fill).
+DEADBANDS = {
+    "temperature": 0.1,   # degC
+    "humidity": 0.5,      # %RH
+    "window": 1.0,        # cm
+    "co2_ppm": 20.0,
+    "tvoc_ppb": 20.0,
+    "window_quality": 0.2,
+}
+HEARTBEAT_SEC = 60.0
+# Keep sending the window for 10 samples after it moves: PC_server averages the last 10
+SETTLE = {"window": 10}
+deadband = Deadband(DEADBANDS, HEARTBEAT_SEC, SETTLE)
+
+connected = threading.Event()
+
+def on_connect(client, userdata, flags, rc):
+    if rc == 0:
+        # (Re)subscribe here so the subscription survives reconnects
+        client.subscribe(TOPIC_heater)
+        # The server may have restarted meanwhile: give it a full sample to hold from
+        deadband.force_full()
+        connected.set()
+        print("MQTT connected")
+
+def on_disconnect(client, userdata, rc):
+    connected.clear()
+    print(f"MQTT disconnected (rc={rc}), buffering to {BACKLOG_FILE}")
 
 def on_message(client, userdata, msg):
     print(f"Received: {msg.payload.decode()}")
 
 def mqtt_loop():
-    client.connect(Broker, PORT, 60)
-    client.subscribe(TOPIC_heater)
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
     client.on_message = on_message
-    client.loop_forever()
+    client.reconnect_delay_set(min_delay=1, max_delay=60)
+    # connect_async + retry_first_connection: the node also boots without a broker
+    client.connect_async(Broker, PORT, 60)
+    client.loop_forever(retry_first_connection=True)
 
 threading.Thread(target=mqtt_loop, daemon=True).start()
 
@@ -29,8 +84,12 @@ bus3 = SMBus(3)
 
 # Si7021 definitions
 SI7021_ADDR = 0x40
-SI7021_READ_TEMPERATURE = 0xF3
-SI7021_READ_HUMIDITY = 0xF5
+SI7021_READ_HUMIDITY = 0xF5  # no-hold RH conversion; also measures temperature
+SI7021_READ_TEMP_FROM_RH = 0xE0  # temperature of the last RH conversion, no new conversion
+# 12-bit RH (12 ms) + 14-bit temperature (10.8 ms), datasheet maximums
+SI7021_CONVERSION_SEC = 0.025
+SI7021_POLL_SEC = 0.005
+SI7021_POLL_TRIES = 5
 
 # CCS811 (CO2) definitions
 CCS811_ADDR = 0x5A
@@ -42,36 +101,51 @@ CCS811_REG_APP_START = 0xF4
 CCS811_DATA_READY_MASK = 0x08
 CCS811_ERROR_MASK = 0x01
 
-def read_si7021_temperature():
-    write = i2c_msg.write(SI7021_ADDR, [SI7021_READ_TEMPERATURE])
-    bus.i2c_rdwr(write)
-
-    time.sleep(0.1)
-
+# Acquisition schedule: every sensor is read on its own thread and rate
+# (sampling.Periodic, drift-free deadlines); bus and bus3 conversions and
+# the ultrasonic ping overlap instead of running back to back. Each publish
+# takes the latest reading of every sensor.
+DISTANCE_HZ = 2.0  # each reading is a burst of ultrasonic.BURST_PINGS pings (~0.3 s)
+SI7021_HZ = 2.0
+CCS811_HZ = 1.0  # drive mode 1 produces one result per second
+PUBLISH_HZ = 1.0
+# A reading older than this many of its sensor's periods is sent as missing
+STALE_PERIODS = 3
+# Bursts where fewer pings agree are sent as a missing window reading
+MIN_WINDOW_QUALITY = 0.4
+# The CCS811 value is held longer, as the old loop always held it
+CCS811_HOLD_SEC = 60.0
+STATS_INTERVAL_SEC = 60
+
+def read_si7021():
+    """(temperature degC, humidity %RH) from one conversion."""
+    bus.i2c_rdwr(i2c_msg.write(SI7021_ADDR, [SI7021_READ_HUMIDITY]))
+
+    time.sleep(SI7021_CONVERSION_SEC)
+
+    # The chip NACKs reads until the conversion is done
     read = i2c_msg.read(SI7021_ADDR, 2)
-    bus.i2c_rdwr(read)
+    for attempt in range(SI7021_POLL_TRIES):
+        try:
+            bus.i2c_rdwr(read)
+            break
+        except OSError:
+            if attempt == SI7021_POLL_TRIES - 1:
+                raise
+            time.sleep(SI7021_POLL_SEC)
 
     data = list(read)
     raw = (data[0] << 8) | data[1]
+    humidity = (125.0 * raw) / 65536.0 - 6.0
 
-    temperature = (175.72 * raw) / 65536.0 - 46.85
-    return temperature
-
-
-def read_si7021_humidity():
-    write = i2c_msg.write(SI7021_ADDR, [SI7021_READ_HUMIDITY])
-    bus.i2c_rdwr(write)
-
-    time.sleep(0.1)
-
+    write = i2c_msg.write(SI7021_ADDR, [SI7021_READ_TEMP_FROM_RH])
     read = i2c_msg.read(SI7021_ADDR, 2)
-    bus.i2c_rdwr(read)
+    bus.i2c_rdwr(write, read)
 
     data = list(read)
     raw = (data[0] << 8) | data[1]
-
-    humidity = (125.0 * raw) / 65536.0 - 6.0
-    return humidity
+    temperature = (175.72 * raw) / 65536.0 - 46.85
+    return temperature, humidity
 
 def init_ccs811(bus):
     if bus.read_byte_data(CCS811_ADDR, CCS811_REG_HW_ID) != 0x81:
@@ -100,42 +174,16 @@ def read_ccs811_valid(bus):
 
     return eco2, tvoc
 
-def read_distance_cm():
-    trig.set_value(1)
-    time.sleep(0.00001)
-    trig.set_value(0)
-
-    timeout = time.time() + 0.04
+# HC-SR04 on gpiochip0, TRIG 23 / ECHO 24 (BCM); see ultrasonic.py
+ranger = HCSR04()
 
-    while echo.get_value() == 0:
-        if time.time() > timeout:
-            return None
-        start = time.time()
+def read_distance():
+    # Temperature-corrected speed of sound once the Si7021 has a reading
+    th = si7021_sensor.fresh(STALE_PERIODS / SI7021_HZ)
+    return ranger.measure(temperature_c=th[0] if th else None)
 
-    while echo.get_value() == 1:
-        if time.time() > timeout:
-            return None
-        end = time.time()
-
-    pulse = end - start
-    return (pulse * 34300) / 2
-
-
-CHIP = "gpiochip0"
-TRIG = 23  # BCM numbering
-ECHO = 24
-
-chip = gpiod.Chip(CHIP)
-
-trig = chip.get_line(TRIG)
-echo = chip.get_line(ECHO)
-
-trig.request(consumer="hcsr04_trig", type=gpiod.LINE_REQ_DIR_OUT)
-echo.request(consumer="hcsr04_echo", type=gpiod.LINE_REQ_DIR_IN)
 
 co2_available = False
-last_co2_ppm = None
-last_tvoc_ppb = None
 try:
     init_ccs811(bus3)
     co2_available = True
@@ -143,44 +191,138 @@ try:
 except Exception as e:
     print("CCS811 init failed:", e)
 
+clock = sampling.Clock()
+distance_sensor = sampling.Periodic("hcsr04", DISTANCE_HZ, read_distance, clock)
+si7021_sensor = sampling.Periodic("si7021", SI7021_HZ, read_si7021, clock)
+ccs811_sensor = sampling.Periodic("ccs811", CCS811_HZ, lambda: read_ccs811_valid(bus3), clock)
+sensors = [distance_sensor, si7021_sensor] + ([ccs811_sensor] if co2_available else [])
 
-# Main loop
-while True:
+
+def encode_payload(samples):
+    if PAYLOAD_FORMAT == "binary":
+        return wire_format.encode(samples)
+    return json.dumps(samples[0] if len(samples) == 1 else samples)
+
+
+def publish_samples(samples, qos=0):
+    """MQTTMessageInfo if paho accepted the message while connected, else None."""
+    if not connected.is_set():
+        return None
+    info = client.publish(TOPIC, encode_payload(samples), qos=qos)
+    return info if info.rc == mqtt.MQTT_ERR_SUCCESS else None
+
+
+class BacklogDrain:
+    """
+    Sends the ring buffer oldest-first, one QoS 1 batch at a time. Samples
+    leave the ring only after the broker acknowledged their batch; a batch
+    cut off by a disconnect is sent again (the server may see it twice).
+    """
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.inflight = None  # (MQTTMessageInfo, slots)
+        self.sent = 0
+
+    def step(self):
+        if self.inflight is not None:
+            info, slots = self.inflight
+            if info.is_published():
+                self.ring.pop(slots)
+                self.sent += slots
+                self.inflight = None
+            elif not connected.is_set():
+                self.inflight = None
+            else:
+                return
+        if not self.ring or not connected.is_set():
+            return
+        samples, slots = self.ring.peek(DRAIN_BATCH)
+        if not samples:
+            # Nothing decodable in these slots
+            self.ring.pop(slots)
+            return
+        info = publish_samples(samples, qos=1)
+        if info is not None:
+            self.inflight = (info, slots)
+
+
+backlog = DiskRing(BACKLOG_FILE, capacity=BACKLOG_CAPACITY)
+drain = BacklogDrain(backlog)
+if len(backlog):
+    print(f"Backlog: {len(backlog)} sample(s) from a previous run")
+
+def take_sample():
+    """Payload from the latest reading of every sensor, stamped now."""
+    reading = distance_sensor.fresh(STALE_PERIODS / DISTANCE_HZ)
+    quality = reading.quality if reading is not None else 0.0
+    # No 1000 cm sentinel any more: an unusable burst is a missing reading.
+    # PC_server keeps the other fields and, if no good reading follows within
+    # WINDOW_HOLD_SEC, treats the window as open (heater OFF)
+    distance_cm = reading.distance_cm if quality >= MIN_WINDOW_QUALITY else None
+    temperature, humidity = si7021_sensor.fresh(STALE_PERIODS / SI7021_HZ) or (None, None)
+    co2_ppm, tvoc_ppb = ccs811_sensor.fresh(CCS811_HOLD_SEC) or (None, None)
+
+    _, wall = clock.now()
+    return {
+        # Monotonic-derived wall time, ms resolution (see sampling.Clock)
+        "timestamp": round(wall, 3),
+        "window": distance_cm,
+        "window_quality": quality,
+        "temperature": temperature,
+        "humidity": humidity, 
+        "co2_ppm": co2_ppm,
+        "tvoc_ppb": tvoc_ppb,
+    }
+
+
+pending = []  # (deadband output, same with held fields written out)
+last_stats_ts = time.monotonic()
+
+def publish_tick():
+    global pending, last_stats_ts
     try:
-        distance_cm = read_distance_cm()
-        if distance_cm is None:
-            distance_cm = 1000
-        distance_cm = round(distance_cm,3)
-        temperature = read_si7021_temperature()
-        humidity = read_si7021_humidity()
-
-        co2_ppm = last_co2_ppm
-        tvoc_ppb = last_tvoc_ppb
-        if co2_available:
-            try:
-                result = read_ccs811_valid(bus3)
-                if result:
-                    co2_ppm, tvoc_ppb = result
-                    last_co2_ppm = co2_ppm
-                    last_tvoc_ppb = tvoc_ppb
-            except OSError as e:
-                print("CCS811 read error:", e)
-
-        payload = {
-            "timestamp": int(time.time()),
-            "window": distance_cm,
-            "temperature": temperature,
-            "humidity": humidity, 
-            "co2_ppm": co2_ppm,
-            "tvoc_ppb": tvoc_ppb,
-        }
+        payload = take_sample()
+        out = deadband.filter(payload)
+        if out is not None:
+            pending.append((out, deadband.expand(out)))
 
         # MSG_INFO = client.publish("IC.embedded/GroupJay",adc_value)
         # mqtt.error_string(MSG_INFO.rc)
-        client.publish(TOPIC, json.dumps(payload))
-        print("Published:", payload)
-        time.sleep(1)
+        if pending and len(pending) >= BATCH_SIZE:
+            # Live data first; only what could not be handed to paho is spooled.
+            # Spooled samples are stored in full: they arrive late, after the
+            # server's hold state has moved on.
+            if publish_samples([p[0] for p in pending]) is None:
+                for _, full in pending:
+                    backlog.append(full)
+                deadband.force_full()
+                print("Buffered:", payload, f"({len(backlog)} in backlog)")
+            else:
+                print("Published:", pending[-1][0])
+            pending = []
+
+        drain.step()
+
+        if time.monotonic() - last_stats_ts >= STATS_INTERVAL_SEC:
+            last_stats_ts = time.monotonic()
+            print("Sampler stats:", {p.name: p.stats() for p in sensors}, deadband.stats(), backlog.stats())
 
     except Exception as e:
+        # A failed publish must not take the node down
         print("Error:", e)
-        break
+
+
+# Main loop
+for sensor in sensors:
+    sensor.start()
+stop = threading.Event()
+try:
+    sampling.run_every(1.0 / PUBLISH_HZ, publish_tick, stop)
+finally:
+    for sensor in sensors:
+        sensor.stop(1)
+    ranger.close()
+    for _, full in pending:
+        backlog.append(full)
+    backlog.close()
@@ -0,0 +1,240 @@
+"""
+Columnar, memory-mapped archive of closed sensor_log days.
+
+Offline analysis used to pull sensor_log into Python tuples and then into
+NumPy (as compute_thresholds does). The archive stores each closed day
+partition (see partitions.py) per device as plain .npy columns:
+
+    <root>/<device_id>/index.json
+    <root>/<device_id>/20261018/time.npy         int64, sorted
+    <root>/<device_id>/20261018/temperature.npy  float32, NaN = missing
+    ...                         humidity / window / co2_ppm / tvoc_ppb
+
+index.json is the small header readers use to pick segments without opening
+them: format version, column dtypes, and per segment its day, row count and
+first / last timestamp. Readers np.load(..., mmap_mode="r") the columns, so
+a query over months touches only the pages it slices and decodes nothing.
+
+    python archive.py build [sensor.db] [--root archive]   # archive closed days
+    python archive.py info [--root archive]
+
+retention.py archives a partition before dropping it when given a root.
+A day that was already compacted (chunk_store.py) and then got late rows
+has part of its rows in sensor_chunks and the rest in a new partition for
+that day; its segment is rebuilt from both, so re-archiving never loses
+the earlier rows.
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+import numpy as np
+
+import chunk_store
+import partitions
+
+FORMAT_VERSION = 1
+ARCHIVE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "archive"))
+
+METRICS = ("temperature", "humidity", "window", "co2_ppm", "tvoc_ppb")
+TIME_DTYPE = np.dtype("<i8")
+VALUE_DTYPE = np.dtype("<f4")
+
+# A day is "closed" once this long past its end, so stragglers can arrive
+CLOSE_GRACE_SEC = 3600
+
+
+def _device_dir(root, device_id):
+    return os.path.join(root, device_id)
+
+
+def read_index(root, device_id):
+    path = os.path.join(_device_dir(root, device_id), "index.json")
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return {"version": FORMAT_VERSION, "device": device_id, "segments": []}
+    if index.get("version") != FORMAT_VERSION:
+        raise ValueError(f"{path}: unsupported archive version {index.get('version')}")
+    return index
+
+
+def _write_index(root, device_id, index):
+    index["segments"].sort(key=lambda s: s["t_min"])
+    path = os.path.join(_device_dir(root, device_id), "index.json")
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, path)
+
+
+def write_segment(root, device_id, day, t, values):
+    """
+    Write one segment: t (int64, sorted) and values {metric: float array}.
+    The directory is built under a temporary name and renamed into place.
+    """
+    seg_dir = os.path.join(_device_dir(root, device_id), day)
+    tmp_dir = seg_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, "time.npy"), np.ascontiguousarray(t, dtype=TIME_DTYPE))
+    for m in METRICS:
+        np.save(os.path.join(tmp_dir, f"{m}.npy"), np.ascontiguousarray(values[m], dtype=VALUE_DTYPE))
+    if os.path.isdir(seg_dir):
+        shutil.rmtree(seg_dir)
+    os.replace(tmp_dir, seg_dir)
+
+    index = read_index(root, device_id)
+    index["columns"] = {"time": TIME_DTYPE.str, **{m: VALUE_DTYPE.str for m in METRICS}}
+    index["segments"] = [s for s in index["segments"] if s["day"] != day]
+    index["segments"].append({
+        "day": day,
+        "rows": int(len(t)),
+        "t_min": int(t[0]) if len(t) else None,
+        "t_max": int(t[-1]) if len(t) else None,
+    })
+    _write_index(root, device_id, index)
+
+
+def archive_partition(conn, name, root=ARCHIVE_ROOT):
+    """
+    Archive every device in one day partition, together with the rows of
+    that day already compacted into sensor_chunks. Segments whose row count
+    already matches are skipped, so re-running only rewrites days that
+    received late samples. Returns rows written.
+    """
+    day = name[len(partitions.PREFIX):]
+    start = partitions.partition_start(name)
+    counts = conn.execute(f"SELECT device_id, COUNT(*) FROM {name} GROUP BY device_id").fetchall()
+    written = 0
+    for device_id, n in counts:
+        compacted = [r[1:] for r in chunk_store.rows_between(
+            conn, start, start + partitions.PARTITION_SEC, device_id)]
+        done = {s["day"]: s["rows"] for s in read_index(root, device_id)["segments"]}
+        if done.get(day) == n + len(compacted):
+            continue
+        rows = conn.execute(
+            f"SELECT time, {', '.join(METRICS)} FROM {name} WHERE device_id = ? ORDER BY time",
+            (device_id,)
+        ).fetchall()
+        if compacted:
+            # Same rule as chunk_store.encode_partition: a late row for a time
+            # already compacted is a resend of that sample
+            stored = {r[0] for r in compacted}
+            rows = sorted(compacted + [r for r in rows if r[0] not in stored], key=lambda r: r[0])
+        # None -> NaN via float conversion of the object array
+        arr = np.array(rows, dtype=float).reshape(-1, 1 + len(METRICS))
+        write_segment(root, device_id, day, arr[:, 0].astype(TIME_DTYPE),
+                      {m: arr[:, 1 + i] for i, m in enumerate(METRICS)})
+        written += len(rows)
+    return written
+
+
+def closed_partitions(conn, now=None, grace_sec=CLOSE_GRACE_SEC):
+    now = int(time.time() if now is None else now)
+    return [
+        name for start, name in partitions.list_partitions(conn)
+        if start + partitions.PARTITION_SEC + grace_sec <= now
+    ]
+
+
+def build(conn, root=ARCHIVE_ROOT, now=None, verbose=False):
+    total = 0
+    for name in closed_partitions(conn, now):
+        n = archive_partition(conn, name, root)
+        total += n
+        if verbose and n:
+            print(f"  {name}: {n} rows")
+    return total
+
+
+# ----------------------
+# Readers
+# ----------------------
+class Archive:
+    def __init__(self, root=ARCHIVE_ROOT):
+        self.root = root
+
+    def devices(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            d for d in os.listdir(self.root)
+            if os.path.isfile(os.path.join(self.root, d, "index.json"))
+        )
+
+    def segments(self, device_id, t_from=None, t_to=None):
+        return [
+            s for s in read_index(self.root, device_id)["segments"]
+            if s["rows"]
+            and (t_to is None or s["t_min"] < t_to)
+            and (t_from is None or s["t_max"] >= t_from)
+        ]
+
+    def _column(self, device_id, day, name):
+        return np.load(os.path.join(self.root, device_id, day, f"{name}.npy"), mmap_mode="r")
+
+    def iter_range(self, device_id, t_from=None, t_to=None, metrics=METRICS):
+        """
+        Yields one {"time": ..., metric: ...} dict per overlapping segment.
+        Arrays are read-only views into the memory-mapped files (no copy).
+        """
+        for seg in self.segments(device_id, t_from, t_to):
+            t = self._column(device_id, seg["day"], "time")
+            lo = 0 if t_from is None else int(np.searchsorted(t, t_from, side="left"))
+            hi = len(t) if t_to is None else int(np.searchsorted(t, t_to, side="left"))
+            if lo >= hi:
+                continue
+            out = {"time": t[lo:hi]}
+            for m in metrics:
+                out[m] = self._column(device_id, seg["day"], m)[lo:hi]
+            yield out
+
+    def load(self, device_id, t_from=None, t_to=None, metrics=METRICS):
+        """Concatenated columns for [t_from, t_to) (one copy; views if a single day)."""
+        parts = list(self.iter_range(device_id, t_from, t_to, metrics))
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return {"time": np.empty(0, TIME_DTYPE), **{m: np.empty(0, VALUE_DTYPE) for m in metrics}}
+        return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar archive of closed sensor_log days.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_build = sub.add_parser("build", help="Archive every closed day partition")
+    p_build.add_argument("db_file", nargs="?", default="sensor.db")
+    p_build.add_argument("--root", default=ARCHIVE_ROOT)
+    p_info = sub.add_parser("info", help="List archived devices and ranges")
+    p_info.add_argument("--root", default=ARCHIVE_ROOT)
+    args = parser.parse_args()
+
+    if args.cmd == "build":
+        import schema
+        schema.ensure_schema(args.db_file)
+        conn = sqlite3.connect(f"file:{args.db_file}?mode=ro", uri=True)
+        try:
+            t0 = time.perf_counter()
+            n = build(conn, args.root, verbose=True)
+            print(f"Archived {n} rows to {args.root} in {time.perf_counter() - t0:.1f}s")
+        finally:
+            conn.close()
+        return
+
+    archive = Archive(args.root)
+    for device_id in archive.devices():
+        segs = archive.segments(device_id)
+        rows = sum(s["rows"] for s in segs)
+        if segs:
+            first = time.strftime("%Y-%m-%d", time.gmtime(segs[0]["t_min"]))
+            last = time.strftime("%Y-%m-%d", time.gmtime(segs[-1]["t_max"]))
+            print(f"{device_id}: {len(segs)} day(s), {rows} rows, {first} .. {last}")
+
+
+if __name__ == "__main__":
+    main()
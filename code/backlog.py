@@ -0,0 +1,143 @@
+"""
+Bounded on-disk ring buffer of sensor samples for the RP1 node.
+
+While the broker is unreachable RP1_sensor.py appends every reading here
+instead of dropping it, and drains the backlog once it is connected again.
+The file is a fixed 16 byte header followed by `capacity` fixed-size slots:
+
+    header  <4sIII   magic b"RPB" + wire_format version, capacity, head (oldest slot), count
+    slot    one single-sample wire_format message (27 bytes)
+
+- Appends write one slot and the header in place (pwrite); when the ring is
+  full the oldest sample is overwritten and counted in `overwritten`.
+- fsync runs every SYNC_EVERY appends rather than per sample, to spare the
+  SD card; a power cut loses at most that many buffered readings.
+- pop() only moves the head, so samples leave the file once the publish
+  that carried them has been acknowledged.
+- Slots that fail to decode (torn write) are skipped on read.
+
+At 1 Hz the default capacity holds three days in ~7 MB.
+"""
+import os
+import struct
+
+import wire_format
+
+CAPACITY = 3 * 24 * 3600
+SYNC_EVERY = 60
+
+# Follows the slot layout (wire_format version); older files start empty
+MAGIC = b"RPB" + bytes([wire_format.VERSION])
+HEADER = struct.Struct("<4sIII")
+SLOT_SIZE = wire_format.HEADER.size + wire_format.SAMPLE.size
+
+
+class DiskRing:
+    def __init__(self, path, capacity=CAPACITY, sync_every=SYNC_EVERY):
+        self.path = path
+        self.capacity = capacity
+        self.sync_every = sync_every
+        self.head = 0
+        self.count = 0
+        self.overwritten = 0
+        self.corrupt = 0
+        self._unsynced = 0
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._load()
+
+    def _load(self):
+        raw = os.pread(self._fd, HEADER.size, 0)
+        if len(raw) == HEADER.size:
+            magic, capacity, head, count = HEADER.unpack(raw)
+            if magic == MAGIC and capacity == self.capacity and head < capacity and count <= capacity:
+                self.head, self.count = head, count
+                return
+            print(f"[BACKLOG] {self.path}: unreadable or resized, starting empty")
+        os.ftruncate(self._fd, HEADER.size)
+        self._write_header()
+
+    def _write_header(self):
+        os.pwrite(self._fd, HEADER.pack(MAGIC, self.capacity, self.head, self.count), 0)
+
+    def _offset(self, slot):
+        return HEADER.size + slot * SLOT_SIZE
+
+    def __len__(self):
+        return self.count
+
+    def append(self, sample):
+        """sample: payload dict with "timestamp" (the keys RP1_sensor.py sends)."""
+        record = wire_format.encode([sample])
+        slot = (self.head + self.count) % self.capacity
+        os.pwrite(self._fd, record, self._offset(slot))
+        if self.count == self.capacity:
+            self.head = (self.head + 1) % self.capacity
+            self.overwritten += 1
+        else:
+            self.count += 1
+        self._write_header()
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def peek(self, n, max_span=wire_format.MAX_DT):
+        """
+        Up to n oldest samples as payload dicts, stopping early where the
+        timestamps would span more than max_span seconds (one wire batch).
+        Returns (samples, slots_covered); pop(slots_covered) removes them.
+        """
+        n = min(n, self.count)
+        if n == 0:
+            return [], 0
+        first = self.head
+        k1 = min(n, self.capacity - first)
+        raw = os.pread(self._fd, k1 * SLOT_SIZE, self._offset(first))
+        if n > k1:
+            raw += os.pread(self._fd, (n - k1) * SLOT_SIZE, self._offset(0))
+
+        samples = []
+        t_min = t_max = None
+        used = 0
+        for i in range(0, len(raw), SLOT_SIZE):
+            try:
+                ((t, values),) = wire_format.decode(raw[i:i + SLOT_SIZE])
+            except (wire_format.WireFormatError, ValueError):
+                self.corrupt += 1
+                used += 1
+                continue
+            lo = t if t_min is None else min(t_min, t)
+            hi = t if t_max is None else max(t_max, t)
+            if hi - lo > max_span:
+                break
+            t_min, t_max = lo, hi
+            sample = {"timestamp": t}
+            sample.update((k, v) for k, v in zip(wire_format.KEYS, values) if v is not wire_format.HELD)
+            samples.append(sample)
+            used += 1
+        return samples, used
+
+    def pop(self, n):
+        n = min(n, self.count)
+        self.head = (self.head + n) % self.capacity
+        self.count -= n
+        if self.count == 0:
+            self.head = 0
+        self._write_header()
+
+    def sync(self):
+        os.fsync(self._fd)
+        self._unsynced = 0
+
+    def close(self):
+        if self._fd is not None:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
+
+    def stats(self):
+        return {
+            "buffered": self.count,
+            "capacity": self.capacity,
+            "overwritten": self.overwritten,
+            "corrupt": self.corrupt,
+        }
@@ -0,0 +1,622 @@
+"""
+Backtest heater / alert settings against recorded samples.
+
+Replays PC_server.decide_sample over a device's history from sensor.db
+(day partitions and compressed chunks) for a given set of parameters, e.g.
+
+    python backtest.py sensor.db --device iotbox01 --set auto_off_mode=Smart --set temp_off_hysteresis=2
+    python backtest.py sensor.db --verify        # also run the sample-by-sample replay and compare
+
+and reports the heater timeline, alert counts and heater-on-while-window-
+open minutes. Sample time stands in for wall-clock time (cooldowns, the
+threshold window), samples are replayed in time order, and the heater only
+changes through the server's own commands (no manual overrides).
+
+How the replay is vectorised:
+
+- trimmed means (last RECENT_LIMIT samples, nulls skipped, min/max dropped)
+  come from a sorted (n, 10) sliding-window view, summed column by column in
+  sorted order so they match trimmed_mean() bit for bit;
+- alert cooldowns jump from one alert to the next with searchsorted, so the
+  Python loop runs once per alert, not per sample;
+- T_cold uses prefix sums over the 30 minute window; H_dry needs a sliding
+  20th percentile, which is the one per-sample loop (bisect over a sorted
+  window, ~1 us a row);
+- the heater state is a forward fill: every sample either sets ON, sets
+  OFF, leaves the state alone, or (hysteresis band) keeps ON and otherwise
+  forces OFF, which never depends on anything but the last set.
+
+replay_reference() is the straightforward per-sample loop using the
+production ThresholdEngine and decision_engine rules (trimmed_mean,
+window_state, heater_decision, the same functions decide_sample calls);
+--verify runs both and diffs every output, so it also catches the
+vectorised path drifting from production.
+T_cold can differ from the streaming engine only when the window mean sits
+within ~1e-9 of a 2-decimal rounding boundary (see threshold_engine.py).
+"""
+import argparse
+import bisect
+import json
+import sqlite3
+import sys
+import time
+from collections import deque
+
+import numpy as np
+
+import chunk_store
+import partitions
+import schema
+from decision_engine import heater_decision, trimmed_mean, window_state
+from threshold_engine import ThresholdEngine
+
+METRICS = ("temperature", "humidity", "window", "co2_ppm", "tvoc_ppb")
+
+# Mirrors the constants / settings in PC_server
+DEFAULT_PARAMS = {
+    "auto_off_mode": "Automatic",
+    "auto_on_mode": "Automatic",
+    "open_window_health_alert": "OFF",
+    "window_open_threshold": 20,
+    "window_hold_sec": 10,
+    "temp_off_hysteresis": 3.0,
+    "co2_alert_threshold": 500,
+    "co2_alert_cooldown_sec": 60 * 60,
+    "tvoc_alert_threshold": 600,
+    "tvoc_alert_cooldown_sec": 60 * 60,
+    "hum_alert_cooldown_sec": 60 * 60,
+    "heater_alert_cooldown_sec": 30 * 60,
+    "health_alert_cooldown_sec": 15 * 60,
+    "temp_bad_low": 16.0,
+    "temp_bad_high": 28.0,
+    "hum_bad_low": 30.0,
+    "hum_bad_high": 70.0,
+    "default_t_cold": 18.0,
+    "default_h_dry": 30.0,
+    "threshold_window_minutes": 30,
+    "min_samples": 20,
+    "t_cold_offset": 1.0,
+    "h_dry_percentile": 20,
+    "recent_limit": 10,
+    "initial_heater": None,
+    # Gaps longer than this (box offline) do not count towards minutes
+    "max_gap_sec": 300,
+}
+
+MODES = ("Automatic", "Smart", "Alert", "Off")
+
+KEEP, SET_OFF, SET_ON, HOLD = 0, 1, 2, 3
+_STATE_NAMES = {0: None, 1: "OFF", 2: "ON"}
+
+
+def _legacy_rows(conn, device_id, t_from, t_to):
+    """
+    Rows from a sensor_log that is still a plain table (schema before v4),
+    or None once it is the partition view. v1 files have no device column
+    (every row is the default box) and may lack tvoc_ppb.
+    """
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (partitions.VIEW,)).fetchone()
+    if row is None or row[0] != "table":
+        return None
+    columns = {r[1] for r in conn.execute(f"PRAGMA table_info({partitions.VIEW})")}
+    select = ", ".join(m if m in columns else "NULL" for m in METRICS)
+    sql = f"SELECT time, {select} FROM {partitions.VIEW} WHERE time >= ? AND time < ?"
+    params = [t_from, t_to]
+    if "device_id" in columns:
+        sql += " AND device_id = ?"
+        params.append(device_id)
+    elif device_id != schema.DEFAULT_DEVICE_ID:
+        return []
+    return conn.execute(sql + " ORDER BY time", params).fetchall()
+
+
+def load_samples(conn, device_id, t_from=None, t_to=None):
+    """
+    Columns for one device as NumPy arrays (time int64, metrics float64 with NaN),
+    in time order. Reads read-only, so unmigrated files (plain sensor_log, no
+    sensor_chunks) are read as they are.
+    """
+    t_from = -2 ** 62 if t_from is None else int(t_from)
+    t_to = 2 ** 62 if t_to is None else int(t_to)
+    rows = _legacy_rows(conn, device_id, t_from, t_to)
+    if rows is None:
+        rows = conn.execute(
+            f"SELECT time, {', '.join(METRICS)} FROM {partitions.source(conn, t_from, t_to)} "
+            "WHERE device_id = ? AND time >= ? AND time < ? ORDER BY time",
+            (device_id, t_from, t_to)
+        ).fetchall()
+    compacted = [r[1:] for r in chunk_store.rows_between(conn, t_from, t_to, device_id)]
+    if compacted:
+        rows = compacted + rows
+    arr = np.array(rows, dtype=float).reshape(-1, 1 + len(METRICS))
+    order = np.argsort(arr[:, 0], kind="stable")
+    arr = arr[order]
+    out = {"time": arr[:, 0].astype(np.int64)}
+    for i, m in enumerate(METRICS):
+        out[m] = arr[:, 1 + i]
+    return out
+
+
+# ----------------------
+# Vectorised building blocks
+# ----------------------
+def rolling_trimmed_mean(values, limit):
+    """
+    trimmed_mean() of the non-null values among the last `limit` samples,
+    for every position; falls back to the current value (NaN if none).
+    """
+    n = len(values)
+    if n == 0:
+        return values.copy()
+    padded = np.concatenate([np.full(limit - 1, np.nan), values])
+    win = np.sort(np.lib.stride_tricks.sliding_window_view(padded, limit), axis=1)  # NaN last
+    k = (~np.isnan(win)).sum(axis=1)
+
+    # k >= 3: drop min and max, sum the rest in sorted order like sum(sorted(v)[1:-1])
+    acc = np.zeros(n)
+    for j in range(1, limit - 1):
+        acc = np.where(j <= k - 2, acc + win[:, j], acc)
+    # k < 3: plain mean (one or two values; order does not matter)
+    small = np.where(k == 2, win[:, 0] + win[:, 1], win[:, 0])
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = np.where(k >= 3, acc / np.maximum(k - 2, 1), small / np.maximum(k, 1))
+    return np.where(k == 0, values, out)
+
+
+def cooldown_fires(t, eligible, cooldown_sec, last_ts=0.0):
+    """Indices where an alert fires: eligible and >= cooldown since the previous one."""
+    idx = np.flatnonzero(eligible)
+    if len(idx) == 0:
+        return idx
+    et = t[idx].astype(float)
+    fired = []
+    pos = int(np.searchsorted(et, last_ts + cooldown_sec, side="left"))
+    while pos < len(idx):
+        fired.append(idx[pos])
+        pos = int(np.searchsorted(et, et[pos] + cooldown_sec, side="left"))
+    return np.array(fired, dtype=np.int64)
+
+
+def _round2(values):
+    """round(x, 2) for an array, bit-identical to Python's round()."""
+    out = np.round(values, 2)
+    # np.round scales by 100 first, which can land on the other side of a
+    # half-way point; redo anything close to one with Python's round()
+    scaled = values * 100.0
+    near = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    out[near] = [round(x, 2) for x in values[near].tolist()]
+    return out
+
+
+def rolling_thresholds(t, temp, hum, win, p):
+    """Per-sample T_cold / H_dry as ThresholdEngine.thresholds(now=t) returns them."""
+    n = len(t)
+    window_sec = int(p["threshold_window_minutes"]) * 60
+    t_cold = np.full(n, float(p["default_t_cold"]))
+    h_dry = np.full(n, float(p["default_h_dry"]))
+
+    counted = ~(np.isnan(temp) | np.isnan(hum) | np.isnan(win))
+    # Number of counted samples up to and including each row, and the first
+    # counted sample still inside each row's window
+    hi = np.cumsum(counted)
+    ct = t[counted]
+    lo = np.searchsorted(ct, np.floor(t).astype(np.int64) - window_sec, side="left")
+    size = hi - lo
+    ready = size >= int(p["min_samples"])
+    if not ready.any():
+        return t_cold, h_dry
+
+    temps = temp[counted]
+    prefix = np.concatenate([[0.0], np.cumsum(temps, dtype=np.longdouble)])
+    mean = (prefix[hi] - prefix[lo]).astype(float) / np.maximum(size, 1)
+    raw_cold = mean - float(p["t_cold_offset"])
+
+    # Sliding percentile: the one sequential part. The loop only keeps the
+    # window sorted and records the two order statistics percentile_sorted()
+    # interpolates between; the interpolation itself is vectorised below.
+    q = float(p["h_dry_percentile"])
+    pos = (size - 1) * (q / 100.0)
+    lo_rank = np.floor(pos).astype(np.int64)
+    hi_rank = np.minimum(lo_rank + 1, size - 1)
+    frac = pos - lo_rank
+
+    hums = hum[counted].tolist()
+    window = []
+    a_out = [0.0] * n
+    b_out = [0.0] * n
+    j = 0  # counted samples added so far
+    k = 0  # counted samples expired so far
+    ready_l = ready.tolist()
+    lo_l = lo.tolist()
+    lo_rank_l = lo_rank.tolist()
+    hi_rank_l = hi_rank.tolist()
+    counted_l = counted.tolist()
+    insort = bisect.insort
+    bisect_left = bisect.bisect_left
+    for i in range(n):
+        if counted_l[i]:
+            insort(window, hums[j])
+            j += 1
+        target = lo_l[i]
+        while k < target:
+            del window[bisect_left(window, hums[k])]
+            k += 1
+        if ready_l[i]:
+            a_out[i] = window[lo_rank_l[i]]
+            b_out[i] = window[hi_rank_l[i]]
+
+    a = np.array(a_out)
+    b = np.array(b_out)
+    # Same lerp as percentile_sorted, branch for branch
+    raw_dry = np.where(frac >= 0.5, b - (b - a) * (1.0 - frac), a + (b - a) * frac)
+
+    t_cold[ready] = _round2(raw_cold[ready])
+    h_dry[ready] = _round2(raw_dry[ready])
+    return t_cold, h_dry
+
+
+def heater_ops(temp, hum, avg_window, window_is_open, t_cold, h_dry, p):
+    """Per-sample heater op (KEEP / SET_OFF / SET_ON / HOLD) for the current settings."""
+    n = len(temp)
+    off_mode = p["auto_off_mode"]
+    on_mode = p["auto_on_mode"]
+
+    auto_off = np.full(n, off_mode == "Automatic") & window_is_open
+    auto_on = np.full(n, on_mode == "Automatic") & ~window_is_open
+
+    smart = off_mode == "Smart" or on_mode == "Smart"
+    if smart:
+        w_open = p["window_open_threshold"]
+        hyst = float(p["temp_off_hysteresis"])
+        with np.errstate(invalid="ignore"):
+            blocked = np.isnan(avg_window) | (avg_window >= w_open) | np.isnan(temp) | np.isnan(hum)
+            cold = ~blocked & (temp < t_cold)
+            humid = hum >= h_dry
+            engine_on = cold & humid
+            # Hysteresis band: ON only if the heater is already ON
+            band = ~blocked & ~cold & humid & (temp < t_cold + hyst)
+    else:
+        engine_on = band = np.zeros(n, dtype=bool)
+
+    def outcome(engine_says_on):
+        want_off = auto_off.copy()
+        want_on = auto_on.copy()
+        if smart:
+            if off_mode == "Smart":
+                want_off |= ~engine_says_on
+            if on_mode == "Smart":
+                want_on |= engine_says_on
+        # pick_cmd: OFF wins
+        return np.where(want_off, SET_OFF, np.where(want_on, SET_ON, KEEP))
+
+    out_on = outcome(engine_on | band)  # heater currently ON
+    out_off = outcome(engine_on)        # heater OFF / unknown
+    ops = np.where(out_on == out_off, out_on, KEEP)
+    # ON stays ON, anything else becomes OFF
+    ops = np.where((out_on != out_off) & (out_off == SET_OFF), HOLD, ops)
+    return ops
+
+
+def heater_states(ops, initial=None):
+    """(state_before, state_after) per sample as codes 0 = unknown, 1 = OFF, 2 = ON."""
+    n = len(ops)
+    init = {None: 0, "OFF": SET_OFF, "ON": SET_ON}[initial]
+    is_set = (ops == SET_ON) | (ops == SET_OFF)
+    last_set = np.maximum.accumulate(np.where(is_set, np.arange(n), -1)) if n else np.empty(0, np.int64)
+    after = np.where(last_set >= 0, ops[np.maximum(last_set, 0)], init)
+    # A HOLD with nothing set before it (and no initial state) turns the heater OFF
+    seen_hold = np.maximum.accumulate(ops == HOLD) if n else np.empty(0, bool)
+    after = np.where((after == 0) & seen_hold, SET_OFF, after)
+    before = np.concatenate([[init], after[:-1]]) if n else after
+    return before, after
+
+
+def _durations(t, max_gap):
+    if len(t) == 0:
+        return np.empty(0)
+    dt = np.diff(t).astype(float)
+    return np.concatenate([np.minimum(dt, max_gap), [0.0]])
+
+
+def _summary(t, window_is_open, before, after, alerts, p, device_id):
+    dt = _durations(t, float(p["max_gap_sec"]))
+    on = after == SET_ON
+    changes = np.flatnonzero(after != before)
+    return {
+        "device": device_id,
+        "rows": int(len(t)),
+        "from": int(t[0]) if len(t) else None,
+        "to": int(t[-1]) if len(t) else None,
+        "heater": {
+            "commands": int(len(changes)),
+            "on_minutes": round(float(dt[on].sum()) / 60.0, 3),
+            "on_while_window_open_minutes": round(float(dt[on & window_is_open].sum()) / 60.0, 3),
+            "timeline": [[int(t[i]), _STATE_NAMES[int(after[i])]] for i in changes],
+        },
+        "window_open_minutes": round(float(dt[window_is_open].sum()) / 60.0, 3),
+        "alerts": alerts,
+    }
+
+
+def _cached(cache, key, fn, *args):
+    if cache is None:
+        return fn(*args)
+    if key not in cache:
+        cache[key] = fn(*args)
+    return cache[key]
+
+
+def replay(samples, params=None, cache=None):
+    """
+    Vectorised replay returning the per-sample arrays (avg_*, window_is_open,
+    heater state before/after, alert indices) that run() summarises.
+    cache: optional dict reused across calls on the same samples, so a
+    parameter sweep only recomputes what its parameters change.
+    """
+    p = {**DEFAULT_PARAMS, **(params or {})}
+    t = samples["time"]
+    temp, hum, win = samples["temperature"], samples["humidity"], samples["window"]
+    limit = int(p["recent_limit"])
+
+    avg_window, avg_co2, avg_tvoc = (
+        _cached(cache, ("trimmed", m, limit), rolling_trimmed_mean, samples[m], limit)
+        for m in ("window", "co2_ppm", "tvoc_ppb")
+    )
+    # window_state(): no window reading for window_hold_sec -> no average, counts as open
+    has_win = ~np.isnan(win)
+    last_good = np.maximum.accumulate(np.where(has_win, np.arange(len(t)), -1)) if len(t) else np.empty(0, np.int64)
+    age = t - t[np.maximum(last_good, 0)] if len(t) else t
+    stale = ~has_win & ((last_good < 0) | (age > p["window_hold_sec"]))
+    avg_window = np.where(stale, np.nan, avg_window)
+    with np.errstate(invalid="ignore"):
+        window_is_open = np.isnan(avg_window) | (avg_window > p["window_open_threshold"])
+
+    enabled = p["open_window_health_alert"] == "ON"
+    closed = ~window_is_open
+    with np.errstate(invalid="ignore"):
+        temp_bad = ~np.isnan(temp) & ((temp < p["temp_bad_low"]) | (temp > p["temp_bad_high"]))
+        hum_bad = ~np.isnan(hum) & ((hum < p["hum_bad_low"]) | (hum > p["hum_bad_high"]))
+        co2_ok = avg_co2 > p["co2_alert_threshold"]
+        tvoc_ok = avg_tvoc > p["tvoc_alert_threshold"]
+        hum_high = hum > p["hum_bad_high"]
+    gate = np.full(len(t), enabled) & closed
+    fired = {
+        "health": cooldown_fires(t, gate & (temp_bad | hum_bad), p["health_alert_cooldown_sec"]),
+        "co2": cooldown_fires(t, gate & co2_ok, p["co2_alert_cooldown_sec"]),
+        "humidity": cooldown_fires(t, gate & hum_high, p["hum_alert_cooldown_sec"]),
+        "tvoc": cooldown_fires(t, gate & tvoc_ok, p["tvoc_alert_cooldown_sec"]),
+    }
+    alerts = {name: len(idx) for name, idx in fired.items()}
+
+    if "Smart" in (p["auto_off_mode"], p["auto_on_mode"]):
+        key = ("thresholds",) + tuple(p[k] for k in (
+            "threshold_window_minutes", "min_samples", "t_cold_offset", "h_dry_percentile",
+            "default_t_cold", "default_h_dry"))
+        t_cold, h_dry = _cached(cache, key, rolling_thresholds, t, temp, hum, win, p)
+    else:
+        t_cold = h_dry = np.zeros(len(t))
+    ops = heater_ops(temp, hum, avg_window, window_is_open, t_cold, h_dry, p)
+    before, after = heater_states(ops, p["initial_heater"])
+
+    # Alert-mode heater reminders key off the last CO2 alert (as in PC_server)
+    # (by sample index: several samples can share one second)
+    co2_idx = fired["co2"]
+    co2_times = np.concatenate([[0.0], t[co2_idx].astype(float)])
+    last_co2 = co2_times[np.searchsorted(co2_idx, np.arange(len(t)), side="right")]
+    cool = (t - last_co2) >= p["heater_alert_cooldown_sec"]
+    alerts["heater_window_open"] = int(np.count_nonzero(
+        (p["auto_off_mode"] == "Alert") & window_is_open & cool & (before == SET_ON)))
+    alerts["heater_window_shut"] = int(np.count_nonzero(
+        (p["auto_on_mode"] == "Alert") & closed & cool & (before == SET_OFF)))
+
+    return {
+        "params": p,
+        "avg_window": avg_window,
+        "avg_co2": avg_co2,
+        "avg_tvoc": avg_tvoc,
+        "window_is_open": window_is_open,
+        "before": before,
+        "after": after,
+        "fired": fired,
+        "alerts": alerts,
+    }
+
+
+def run(samples, params=None, device_id=None, cache=None):
+    """Vectorised replay summary. samples: load_samples() output."""
+    r = replay(samples, params, cache)
+    return _summary(samples["time"], r["window_is_open"], r["before"], r["after"], r["alerts"],
+                    r["params"], device_id)
+
+
+# ----------------------
+# Reference: one sample at a time, like decide_sample
+# ----------------------
+def replay_reference(samples, params=None, device_id=None):
+    p = {**DEFAULT_PARAMS, **(params or {})}
+    t_arr = samples["time"]
+    cols = {m: [None if v != v else v for v in samples[m].tolist()] for m in METRICS}
+    limit = int(p["recent_limit"])
+    recent = {m: deque(maxlen=limit) for m in ("window", "co2_ppm", "tvoc_ppb")}
+    engine = ThresholdEngine(
+        window_minutes=p["threshold_window_minutes"], min_samples=p["min_samples"],
+        t_cold_offset=p["t_cold_offset"], h_dry_percentile=p["h_dry_percentile"],
+    )
+    defaults = {"T_cold": p["default_t_cold"], "H_dry": p["default_h_dry"], "W_open": p["window_open_threshold"]}
+    smart = "Smart" in (p["auto_off_mode"], p["auto_on_mode"])
+    enabled = p["open_window_health_alert"] == "ON"
+
+    state = p["initial_heater"]
+    last = {"health": 0.0, "co2": 0.0, "humidity": 0.0, "tvoc": 0.0}
+    alerts = {"health": 0, "co2": 0, "humidity": 0, "tvoc": 0, "heater_window_open": 0, "heater_window_shut": 0}
+    n = len(t_arr)
+    before = np.zeros(n, dtype=np.int64)
+    after = np.zeros(n, dtype=np.int64)
+    is_open = np.zeros(n, dtype=bool)
+    code = {None: 0, "OFF": SET_OFF, "ON": SET_ON}
+
+    last_window_t = None
+    for i in range(n):
+        now = float(t_arr[i])
+        temp, hum, win = cols["temperature"][i], cols["humidity"][i], cols["window"][i]
+        co2, tvoc = cols["co2_ppm"][i], cols["tvoc_ppb"][i]
+        # SensorCache.append
+        for m, v in (("window", win), ("co2_ppm", co2), ("tvoc_ppb", tvoc)):
+            recent[m].append(v)
+        if win is not None:
+            last_window_t = now
+        if smart:
+            engine.add(int(t_arr[i]), {"temperature": temp, "humidity": hum, "window": win})
+
+        avg = {}
+        for m, current in (("co2_ppm", co2), ("tvoc_ppb", tvoc)):
+            a = trimmed_mean([v for v in recent[m] if v is not None])
+            avg[m] = current if a is None else a
+        avg["window"], window_is_open = window_state(
+            win,
+            [v for v in recent["window"] if v is not None],
+            None if last_window_t is None else now - last_window_t,
+            p["window_open_threshold"],
+            p["window_hold_sec"],
+        )
+        is_open[i] = window_is_open
+        before[i] = code[state]
+
+        if enabled and not window_is_open:
+            temp_bad = temp is not None and (temp < p["temp_bad_low"] or temp > p["temp_bad_high"])
+            hum_bad = hum is not None and (hum < p["hum_bad_low"] or hum > p["hum_bad_high"])
+            if (temp_bad or hum_bad) and now - last["health"] >= p["health_alert_cooldown_sec"]:
+                last["health"] = now
+                alerts["health"] += 1
+            for key, cond, cooldown in (
+                ("co2", avg["co2_ppm"] is not None and avg["co2_ppm"] > p["co2_alert_threshold"],
+                 p["co2_alert_cooldown_sec"]),
+                ("humidity", hum is not None and hum > p["hum_bad_high"], p["hum_alert_cooldown_sec"]),
+                ("tvoc", avg["tvoc_ppb"] is not None and avg["tvoc_ppb"] > p["tvoc_alert_threshold"],
+                 p["tvoc_alert_cooldown_sec"]),
+            ):
+                if cond and now - last[key] >= cooldown:
+                    last[key] = now
+                    alerts[key] += 1
+
+        cmds = []
+        if window_is_open:
+            if p["auto_off_mode"] == "Automatic":
+                cmds.append("OFF")
+            elif p["auto_off_mode"] == "Alert":
+                if now - last["co2"] >= p["heater_alert_cooldown_sec"] and state == "ON":
+                    alerts["heater_window_open"] += 1
+        else:
+            if p["auto_on_mode"] == "Automatic":
+                cmds.append("ON")
+            elif p["auto_on_mode"] == "Alert":
+                if now - last["co2"] >= p["heater_alert_cooldown_sec"] and state == "OFF":
+                    alerts["heater_window_shut"] += 1
+
+        if smart:
+            th = engine.thresholds(now, defaults)
+            th["W_open"] = p["window_open_threshold"]
+            cmd, _ = heater_decision(temp, hum, avg["window"], th, state, p["temp_off_hysteresis"])
+            if cmd == "OFF" and p["auto_off_mode"] == "Smart":
+                cmds.append("OFF")
+            elif cmd == "ON" and p["auto_on_mode"] == "Smart":
+                cmds.append("ON")
+
+        if "OFF" in cmds:
+            state = "OFF"
+        elif "ON" in cmds:
+            state = "ON"
+        after[i] = code[state]
+
+    return _summary(t_arr, is_open, before, after, alerts, p, device_id)
+
+
+def compare(a, b):
+    """List of human-readable differences between two results."""
+    diffs = []
+    for key in ("rows", "window_open_minutes"):
+        if a[key] != b[key]:
+            diffs.append(f"{key}: {a[key]} != {b[key]}")
+    for key, value in a["alerts"].items():
+        if value != b["alerts"].get(key):
+            diffs.append(f"alerts.{key}: {value} != {b['alerts'].get(key)}")
+    for key in ("commands", "on_minutes", "on_while_window_open_minutes"):
+        if a["heater"][key] != b["heater"][key]:
+            diffs.append(f"heater.{key}: {a['heater'][key]} != {b['heater'][key]}")
+    if a["heater"]["timeline"] != b["heater"]["timeline"]:
+        first = next(
+            (x, y) for x, y in zip(a["heater"]["timeline"] + [None], b["heater"]["timeline"] + [None]) if x != y
+        )
+        diffs.append(f"heater.timeline first differs at {first}")
+    return diffs
+
+
+def _parse_value(text):
+    if text in ("None", "null"):
+        return None
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text
+
+
+def parse_params(pairs):
+    params = {}
+    for pair in pairs:
+        key, sep, value = pair.partition("=")
+        if not sep or key not in DEFAULT_PARAMS:
+            raise SystemExit(f"unknown parameter {key!r}; one of: {', '.join(DEFAULT_PARAMS)}")
+        params[key] = _parse_value(value)
+    for key in ("auto_off_mode", "auto_on_mode"):
+        if params.get(key, DEFAULT_PARAMS[key]) not in MODES:
+            raise SystemExit(f"{key} must be one of {', '.join(MODES)}")
+    return params
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest heater settings against sensor.db history.")
+    parser.add_argument("db_file", nargs="?", default="sensor.db")
+    parser.add_argument("--device", default=schema.DEFAULT_DEVICE_ID)
+    parser.add_argument("--from", dest="t_from", type=int, default=None, help="Epoch seconds")
+    parser.add_argument("--to", dest="t_to", type=int, default=None, help="Epoch seconds")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override a parameter (repeatable): " + ", ".join(DEFAULT_PARAMS))
+    parser.add_argument("--verify", action="store_true", help="Also run the per-sample replay and compare")
+    parser.add_argument("--timeline", action="store_true", help="Include the heater timeline in the output")
+    args = parser.parse_args()
+
+    params = parse_params(args.set)
+    conn = sqlite3.connect(f"file:{args.db_file}?mode=ro", uri=True)
+    try:
+        t0 = time.perf_counter()
+        samples = load_samples(conn, args.device, args.t_from, args.t_to)
+        load_sec = time.perf_counter() - t0
+    finally:
+        conn.close()
+
+    t0 = time.perf_counter()
+    result = run(samples, params, args.device)
+    run_sec = time.perf_counter() - t0
+    result["params"] = {**DEFAULT_PARAMS, **params}
+    result["timing_sec"] = {"load": round(load_sec, 3), "replay": round(run_sec, 3)}
+
+    exit_code = 0
+    if args.verify:
+        t0 = time.perf_counter()
+        reference = replay_reference(samples, params, args.device)
+        diffs = compare(result, reference)
+        result["timing_sec"]["reference"] = round(time.perf_counter() - t0, 3)
+        result["verify"] = {"ok": not diffs, "differences": diffs}
+        exit_code = 0 if not diffs else 1
+
+    if not args.timeline:
+        result["heater"]["timeline"] = f"{len(result['heater']['timeline'])} change(s); --timeline to list"
+    print(json.dumps(result, indent=2))
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
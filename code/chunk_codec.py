@@ -0,0 +1,234 @@
+"""
+Gorilla-style compression for sensor sample chunks.
+
+One chunk holds the rows of one device for a fixed time window, encoded as a
+single bit stream with the columns of each row interleaved:
+
+    time    delta-of-delta against the previous two timestamps
+    values  64-bit float XOR against the previous value of the same column
+
+Delta-of-delta buckets (prefix, payload bits):
+
+    0            dod == 0
+    10   +  7    -64 .. 63
+    110  +  9    -256 .. 255
+    1110 + 12    -2048 .. 2047
+    1111 + 32    anything else
+
+Payloads are two's complement, so each bucket holds exactly the range its
+bit width can sign-extend back (decode() uses _signed()).
+
+Value encoding:
+
+    0                                   same as previous
+    10 + meaningful bits                fits the previous leading/trailing window
+    11 + 5 leading + 6 length + bits    new window (length 64 is stored as 0)
+
+Missing values (None) are stored as a canonical NaN and decoded back to None.
+Slow-moving sensors (Si7021 readings repeat, HC-SR04 distance is rounded
+to 3 decimals) mostly hit the 1-2 bit cases.
+
+Blob layout: version byte, uint16 column count, uint32 row count, stream.
+"""
+import math
+import struct
+
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<BHI")
+
+_NAN_BITS = 0x7FF8000000000000
+_MASK64 = (1 << 64) - 1
+_DOUBLE = struct.Struct("<d")
+_UINT64 = struct.Struct("<Q")
+
+
+def _float_bits(v):
+    if v is None or v != v:
+        return _NAN_BITS
+    return _UINT64.unpack(_DOUBLE.pack(v))[0]
+
+
+def _bits_float(bits):
+    if bits == _NAN_BITS:
+        return None
+    return _DOUBLE.unpack(_UINT64.pack(bits))[0]
+
+
+class BitWriter:
+    def __init__(self):
+        self._buf = bytearray()
+        self._acc = 0
+        self._nacc = 0
+
+    def write(self, value, nbits):
+        self._acc = (self._acc << nbits) | (value & ((1 << nbits) - 1))
+        self._nacc += nbits
+        while self._nacc >= 8:
+            self._nacc -= 8
+            self._buf.append((self._acc >> self._nacc) & 0xFF)
+        self._acc &= (1 << self._nacc) - 1
+
+    def getvalue(self):
+        if self._nacc:
+            return bytes(self._buf) + bytes([(self._acc << (8 - self._nacc)) & 0xFF])
+        return bytes(self._buf)
+
+
+class BitReader:
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+
+    def read(self, nbits):
+        if nbits == 0:
+            return 0
+        start = self._pos >> 3
+        end = (self._pos + nbits + 7) >> 3
+        if end > len(self._data):
+            raise ValueError("chunk stream truncated")
+        chunk = int.from_bytes(self._data[start:end], "big")
+        shift = (end << 3) - self._pos - nbits
+        self._pos += nbits
+        return (chunk >> shift) & ((1 << nbits) - 1)
+
+    def read_bit(self):
+        byte = self._data[self._pos >> 3]
+        bit = (byte >> (7 - (self._pos & 7))) & 1
+        self._pos += 1
+        return bit
+
+
+def _signed(value, nbits):
+    return value - (1 << nbits) if value >= 1 << (nbits - 1) else value
+
+
+class ChunkEncoder:
+    """Streaming encoder: append() rows in time order, then finish()."""
+
+    def __init__(self, n_columns):
+        self.n_columns = n_columns
+        self.count = 0
+        self._w = BitWriter()
+        self._t_prev = 0
+        self._delta_prev = 0
+        self._v_prev = [0] * n_columns
+        self._lead = [0] * n_columns
+        self._trail = [0] * n_columns
+        self._has_window = [False] * n_columns
+
+    def append(self, t, values):
+        w = self._w
+        t = int(t)
+        if self.count == 0:
+            w.write(t, 64)
+        else:
+            delta = t - self._t_prev
+            dod = delta - self._delta_prev
+            if dod == 0:
+                w.write(0, 1)
+            elif -64 <= dod <= 63:
+                w.write(0b10, 2)
+                w.write(dod, 7)
+            elif -256 <= dod <= 255:
+                w.write(0b110, 3)
+                w.write(dod, 9)
+            elif -2048 <= dod <= 2047:
+                w.write(0b1110, 4)
+                w.write(dod, 12)
+            else:
+                w.write(0b1111, 4)
+                w.write(dod, 32)
+            self._delta_prev = delta
+        self._t_prev = t
+
+        for i in range(self.n_columns):
+            bits = _float_bits(values[i])
+            if self.count == 0:
+                w.write(bits, 64)
+                self._v_prev[i] = bits
+                continue
+            x = bits ^ self._v_prev[i]
+            self._v_prev[i] = bits
+            if x == 0:
+                w.write(0, 1)
+                continue
+            lead = min(64 - x.bit_length(), 31)
+            trail = (x & -x).bit_length() - 1
+            if self._has_window[i] and self._lead[i] <= lead and self._trail[i] <= trail:
+                w.write(0b10, 2)
+                w.write(x >> self._trail[i], 64 - self._lead[i] - self._trail[i])
+            else:
+                length = 64 - lead - trail
+                w.write(0b11, 2)
+                w.write(lead, 5)
+                w.write(length & 63, 6)
+                w.write(x >> trail, length)
+                self._lead[i] = lead
+                self._trail[i] = trail
+                self._has_window[i] = True
+        self.count += 1
+
+    def finish(self):
+        return _HEADER.pack(FORMAT_VERSION, self.n_columns, self.count) + self._w.getvalue()
+
+
+def encode(rows, n_columns):
+    """rows: iterable of (t, v0, v1, ...) in time order. Returns the blob."""
+    enc = ChunkEncoder(n_columns)
+    for row in rows:
+        enc.append(row[0], row[1:])
+    return enc.finish()
+
+
+def decode(blob):
+    """Yields (t, v0, v1, ...) tuples."""
+    version, n_columns, count = _HEADER.unpack_from(blob)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"unsupported chunk version {version}")
+    r = BitReader(memoryview(blob)[_HEADER.size:])
+    t = 0
+    delta = 0
+    prev = [0] * n_columns
+    lead = [0] * n_columns
+    trail = [0] * n_columns
+    for k in range(count):
+        if k == 0:
+            t = _signed(r.read(64), 64)
+        else:
+            if r.read_bit() == 0:
+                dod = 0
+            elif r.read_bit() == 0:
+                dod = _signed(r.read(7), 7)
+            elif r.read_bit() == 0:
+                dod = _signed(r.read(9), 9)
+            elif r.read_bit() == 0:
+                dod = _signed(r.read(12), 12)
+            else:
+                dod = _signed(r.read(32), 32)
+            delta += dod
+            t += delta
+
+        row = [t]
+        for i in range(n_columns):
+            if k == 0:
+                prev[i] = r.read(64)
+            elif r.read_bit() == 1:
+                if r.read_bit() == 0:
+                    x = r.read(64 - lead[i] - trail[i]) << trail[i]
+                else:
+                    lead[i] = r.read(5)
+                    length = r.read(6) or 64
+                    trail[i] = 64 - lead[i] - length
+                    x = r.read(length) << trail[i]
+                prev[i] ^= x
+            row.append(_bits_float(prev[i]))
+        yield tuple(row)
+
+
+def header(blob):
+    """(version, n_columns, count) without decoding the stream."""
+    return _HEADER.unpack_from(blob)
+
+
+def is_missing(v):
+    return v is None or (isinstance(v, float) and math.isnan(v))
@@ -0,0 +1,192 @@
+"""
+Optional compressed storage for closed days: sensor_chunks.
+
+Raw samples land in day partitions (partitions.py). With compaction on,
+every closed partition is re-packed per device into fixed CHUNK_SEC windows
+encoded with chunk_codec (delta-of-delta timestamps, XOR floats), stored as
+BLOBs, and the partition is dropped:
+
+    sensor_chunks (device_id, start, t_min, t_max, count, data BLOB)
+    UNIQUE (device_id, start)   <- time-range index for readers
+
+Readers (history raw queries, rollup backfill) call rows_between(), which
+finds overlapping chunks through the (device_id, start) index and decodes
+only those. Samples that arrive for an already compacted day go into a new
+partition for that day and are merged into the existing chunks on the next
+pass.
+
+Every blob is decoded and compared with its source rows before the
+partition is dropped; a day that does not round-trip exactly is left in
+place and reported.
+
+Encoding happens outside any transaction; the swap (write chunks, drop the
+partition) is one short BEGIN IMMEDIATE transaction that re-checks the
+partition's row count, so a late sample in between just defers that day.
+"""
+import time
+
+import chunk_codec
+import partitions
+
+CHUNK_SEC = 2 * 3600
+TABLE = "sensor_chunks"
+METRICS = ("temperature", "humidity", "window", "co2_ppm", "tvoc_ppb")
+
+DAY_SEC = 24 * 3600
+
+
+def create_tables(conn):
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {TABLE} (
+        device_id TEXT NOT NULL,
+        start INTEGER NOT NULL,
+        t_min INTEGER NOT NULL,
+        t_max INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        UNIQUE (device_id, start)
+    )
+    """)
+
+
+def has_table(conn):
+    """False for files from before schema v5 (e.g. opened read-only, unmigrated)."""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (TABLE,)
+    ).fetchone() is not None
+
+
+def _chunk_rows(conn, device_id, start):
+    row = conn.execute(
+        f"SELECT data FROM {TABLE} WHERE device_id = ? AND start = ?", (device_id, start)
+    ).fetchone()
+    return list(chunk_codec.decode(row[0])) if row else []
+
+
+def _overlapping(conn, t_from, t_to, device_id=None):
+    # start is aligned to CHUNK_SEC, so the index range below is exact enough;
+    # t_min / t_max trim chunks that do not really overlap
+    sql = (
+        f"SELECT device_id, data FROM {TABLE} "
+        "WHERE start > ? AND start < ? AND t_max >= ? AND t_min < ?"
+    )
+    params = [t_from - CHUNK_SEC, t_to, t_from, t_to]
+    if device_id is not None:
+        sql = sql.replace("WHERE ", "WHERE device_id = ? AND ", 1)
+        params.insert(0, device_id)
+    return conn.execute(sql + " ORDER BY device_id, start", params)
+
+
+def rows_between(conn, t_from, t_to, device_id=None):
+    """
+    Decoded rows in sensor_log column order (device_id, time, temperature,
+    humidity, window, co2_ppm, tvoc_ppb) with t_from <= time < t_to, sorted
+    by device and time. Empty if the file has no sensor_chunks table.
+    """
+    if not has_table(conn):
+        return []
+    out = []
+    for dev, data in _overlapping(conn, t_from, t_to, device_id):
+        out.extend((dev, *row) for row in chunk_codec.decode(data) if t_from <= row[0] < t_to)
+    return out
+
+
+def encode_partition(conn, name, chunk_sec=CHUNK_SEC):
+    """
+    Read one partition and build its chunks, merged with chunks already
+    stored for the same windows. Returns (row_count, [(device_id, start, rows, blob)]).
+    """
+    count = conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+    devices = [d for (d,) in conn.execute(f"SELECT DISTINCT device_id FROM {name}")]
+    chunks = []
+    for device_id in devices:
+        rows = conn.execute(
+            f"SELECT time, {', '.join(METRICS)} FROM {name} "
+            "WHERE device_id = ? AND time IS NOT NULL ORDER BY time",
+            (device_id,)
+        ).fetchall()
+        groups = {}
+        for row in rows:
+            groups.setdefault(row[0] - row[0] % chunk_sec, []).append(row)
+        for start, group in groups.items():
+            existing = _chunk_rows(conn, device_id, start)
+            if existing:
+                # A late row for a time already stored is a resend of that sample
+                stored = {r[0] for r in existing}
+                group = sorted(existing + [r for r in group if r[0] not in stored], key=lambda r: r[0])
+            chunks.append((device_id, start, group, chunk_codec.encode(group, len(METRICS))))
+    return count, chunks
+
+
+def _same_value(a, b):
+    if chunk_codec.is_missing(a) or chunk_codec.is_missing(b):
+        return chunk_codec.is_missing(a) and chunk_codec.is_missing(b)
+    return float(a) == float(b)
+
+
+def round_trips(rows, blob):
+    """True if blob decodes back to exactly these (time, *METRICS) rows."""
+    decoded = list(chunk_codec.decode(blob))
+    if len(decoded) != len(rows):
+        return False
+    for row, back in zip(rows, decoded):
+        if int(row[0]) != back[0] or not all(map(_same_value, row[1:], back[1:])):
+            return False
+    return True
+
+
+def _swap(conn, name, count, chunks):
+    now_count = conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+    if now_count != count:
+        return False
+    conn.executemany(
+        f"INSERT OR REPLACE INTO {TABLE} (device_id, start, t_min, t_max, count, data) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [(dev, start, rows[0][0], rows[-1][0], len(rows), blob) for dev, start, rows, blob in chunks]
+    )
+    conn.execute(f"DROP TABLE {name}")
+    partitions.rebuild_view(conn)
+    return True
+
+
+def compactable_partitions(conn, now, after_days):
+    cutoff = now - after_days * DAY_SEC
+    return [
+        name for start, name in partitions.list_partitions(conn)
+        if start + partitions.PARTITION_SEC <= cutoff
+    ]
+
+
+def compact(conn, now=None, after_days=2, before_drop=None, verbose=False):
+    """
+    Compact every partition that closed more than after_days ago.
+    before_drop(conn, name) runs first, e.g. archive.archive_partition.
+    Returns {"partitions": n, "rows": n, "bytes": n}, plus "failed": n when
+    a partition was kept because its chunks did not round-trip.
+    """
+    now = int(time.time() if now is None else now)
+    out = {"partitions": 0, "rows": 0, "bytes": 0}
+    for name in compactable_partitions(conn, now, after_days):
+        if before_drop is not None:
+            before_drop(conn, name)
+        count, chunks = encode_partition(conn, name)
+        bad = [(dev, start) for dev, start, rows, blob in chunks if not round_trips(rows, blob)]
+        if bad:
+            out["failed"] = out.get("failed", 0) + 1
+            print(f"[COMPACT] {name}: chunk(s) {bad} do not decode back to their rows, keeping the partition")
+            continue
+        if not partitions.immediate(conn, _swap, name, count, chunks):
+            if verbose:
+                print(f"  {name}: changed while encoding, retry next pass")
+            continue
+        out["partitions"] += 1
+        out["rows"] += count
+        out["bytes"] += sum(len(blob) for *_, blob in chunks)
+        if verbose:
+            print(f"  {name}: {count} rows -> {len(chunks)} chunk(s)")
+    return out
+
+
+def prune(conn, cutoff):
+    """Delete chunks entirely older than cutoff (no commit). Returns rows deleted."""
+    return conn.execute(f"DELETE FROM {TABLE} WHERE t_max < ?", (cutoff,)).rowcount
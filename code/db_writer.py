@@ -0,0 +1,234 @@
+"""
+Batched group-commit writer for sensor_log.
+
+PC_logger used to open a connection, insert one row and commit for every
+MQTT message (one fsync per sample). BatchWriter instead:
+
+- owns one long-lived sqlite connection in WAL mode, on its own thread,
+- takes rows from on_message through a bounded queue,
+- writes them with executemany in a single transaction once batch_size rows
+  are waiting or flush_interval_ms has passed, whichever comes first,
+- drains everything still queued on close(). If that does not finish
+  within close()'s timeout the writer keeps running (and keeps draining);
+  close() returns False and stats() shows the rows not yet written.
+
+Rows are inserted with insert_rows(conn, batch), by default
+partitions.insert_rows (one table per day, see partitions.py); pass
+insert_sql instead to executemany into a single table. on_flush hooks (e.g.
+rollups.apply_rows) run inside the same transaction as the INSERT, with the
+connection and the rows insert_rows returned as stored: a resent sample
+that is already in the table is not counted twice (see partitions.py).
+insert_sql and insert_rows functions that return None pass the whole batch
+on. Each flush is one explicit BEGIN
+IMMEDIATE transaction (partitions.immediate): sqlite3's implicit
+transactions do not cover DDL, and a flush at day rollover creates a
+partition and rebuilds the sensor_log view before inserting.
+
+stats() exposes queue depth, drop and duplicate counts and flush latency
+counters.
+"""
+import queue
+import sqlite3
+import threading
+import time
+
+import partitions
+
+BATCH_SIZE = 200
+FLUSH_INTERVAL_MS = 500
+MAX_QUEUE = 10000
+
+_STOP = object()
+
+
+def open_connection(db_file):
+    # Long busy timeout so a schema migration holding the write lock just
+    # delays a flush instead of failing it
+    conn = sqlite3.connect(db_file, timeout=60, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WAL + NORMAL only fsyncs at checkpoints; a crash can lose the last
+    # un-checkpointed batch but never corrupts the file.
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class BatchWriter:
+    def __init__(
+        self,
+        db_file,
+        batch_size=BATCH_SIZE,
+        flush_interval_ms=FLUSH_INTERVAL_MS,
+        max_queue=MAX_QUEUE,
+        insert_sql=None,
+        on_flush=(),
+        insert_rows=None,
+    ):
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.insert_sql = insert_sql
+        if insert_rows is None:
+            insert_rows = self._executemany if insert_sql else partitions.insert_rows
+        self.insert_rows = insert_rows
+        self.on_flush = list(on_flush)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._stopping = False
+        self._stats_lock = threading.Lock()
+
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.rows_duplicate = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.last_batch_size = 0
+        self.in_flight = 0
+        self.close_timeouts = 0
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+        return self
+
+    def submit(self, row):
+        """
+        Queue one (device_id, time, temperature, humidity, window, co2_ppm, tvoc_ppb)
+        row. Never blocks the caller; returns False if the queue is full.
+        """
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            with self._stats_lock:
+                self.rows_dropped += 1
+            return False
+
+    def close(self, timeout=None):
+        """
+        Flush everything queued so far and stop the writer thread. Returns
+        False if it is still flushing after `timeout` seconds; calling
+        close() again waits for it once more.
+        """
+        if self._thread is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._stopping:
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+                self._stopping = True
+            except queue.Full:
+                pass
+        if self._stopping:
+            self._thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        if not self._stopping or self._thread.is_alive():
+            with self._stats_lock:
+                self.close_timeouts += 1
+            print(f"[DB-WRITER] close timed out after {timeout}s, "
+                  f"{self.stats()['undrained_rows']} row(s) not written yet")
+            return False
+        self._thread = None
+        self._stopping = False
+        return True
+
+    def stats(self):
+        with self._stats_lock:
+            flushes = self.flushes
+            # The stop marker sits in the queue until the thread reaches it
+            queued = max(0, self._queue.qsize() - (1 if self._stopping else 0))
+            return {
+                "queue_depth": queued,
+                # Queued plus taken off the queue but not committed yet
+                "undrained_rows": queued + self.in_flight,
+                "close_timeouts": self.close_timeouts,
+                "rows_written": self.rows_written,
+                "rows_dropped": self.rows_dropped,
+                "rows_duplicate": self.rows_duplicate,
+                "flushes": flushes,
+                "flush_errors": self.flush_errors,
+                "last_batch_size": self.last_batch_size,
+                "last_flush_ms": round(self.last_flush_ms, 3),
+                "max_flush_ms": round(self.max_flush_ms, 3),
+                "avg_flush_ms": round(self.total_flush_ms / flushes, 3) if flushes else 0.0,
+            }
+
+    def _run(self):
+        conn = open_connection(self.db_file)
+        try:
+            stopping = False
+            while not stopping:
+                batch = []
+                deadline = None
+                while len(batch) < self.batch_size:
+                    if deadline is None:
+                        timeout = None  # idle: wait for the first row
+                    else:
+                        timeout = deadline - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    try:
+                        item = self._queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+
+                if stopping:
+                    # Drain whatever arrived before close()
+                    while True:
+                        try:
+                            item = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is not _STOP:
+                            batch.append(item)
+
+                if batch:
+                    with self._stats_lock:
+                        self.in_flight = len(batch)
+                    self._flush(conn, batch)
+                    with self._stats_lock:
+                        self.in_flight = 0
+        finally:
+            conn.close()
+
+    def _write(self, conn, batch):
+        stored = self.insert_rows(conn, batch)
+        if stored is None:
+            stored = batch
+        for hook in self.on_flush:
+            hook(conn, stored)
+        return stored
+
+    def _executemany(self, conn, batch):
+        conn.executemany(self.insert_sql, batch)
+
+    def _flush(self, conn, batch):
+        t0 = time.perf_counter()
+        try:
+            stored = partitions.immediate(conn, self._write, batch)
+        except sqlite3.Error as e:
+            print("Batch write failed:", e)
+            with self._stats_lock:
+                self.flush_errors += 1
+                self.rows_dropped += len(batch)
+            return
+        elapsed_ms = (time.perf_counter() - t0) * 1000.0
+
+        with self._stats_lock:
+            self.flushes += 1
+            self.rows_written += len(stored)
+            self.rows_duplicate += len(batch) - len(stored)
+            self.last_batch_size = len(batch)
+            self.last_flush_ms = elapsed_ms
+            self.total_flush_ms += elapsed_ms
+            if elapsed_ms > self.max_flush_ms:
+                self.max_flush_ms = elapsed_ms
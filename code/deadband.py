@@ -0,0 +1,92 @@
+"""
+Edge-side deadband for RP1 sensor payloads.
+
+Deadband.filter() takes every full payload the node produces and returns
+what to publish:
+
+- None when no field moved by more than its deadband since it was last
+  sent (nothing goes on the wire);
+- otherwise the timestamp plus only the fields that moved. Left-out keys
+  mean "unchanged" and the server holds the previous value (see
+  ingest.HoldState), while a key with None is still a missing reading;
+- a full payload at least every heartbeat_sec, so a restarted server or a
+  lost message is corrected within one heartbeat.
+
+A field's reference is only updated when it is sent. A slow drift therefore
+still goes out once it has built up past the deadband, instead of being
+swallowed step by step.
+
+Fields the server smooths over its last N samples (the window distance
+feeds a 10-sample trimmed mean) are sent for `settle` more samples after
+they move. The server's average then converges at the same pace as with a
+full stream, rather than waiting for the next heartbeat.
+
+    band = Deadband({"temperature": 0.1, "window": 1.0}, heartbeat_sec=60, settle={"window": 10})
+    out = band.filter(payload)
+    if out is not None:
+        publish(out)
+"""
+
+DEADBANDS = {
+    "temperature": 0.1,   # degC
+    "humidity": 0.5,      # %RH
+    "window": 1.0,        # cm; the open threshold is 20 cm
+    "co2_ppm": 20.0,
+    "tvoc_ppb": 20.0,
+    "window_quality": 0.2,
+}
+HEARTBEAT_SEC = 60.0
+# Samples a field keeps being sent after it moved (PC_server's moving average length)
+SETTLE = {"window": 10}
+
+
+class Deadband:
+    def __init__(self, deadbands=None, heartbeat_sec=HEARTBEAT_SEC, settle=None):
+        self.deadbands = dict(DEADBANDS if deadbands is None else deadbands)
+        self.heartbeat_sec = heartbeat_sec
+        self.settle = dict(SETTLE if settle is None else settle)
+        self.sent = {}
+        self._settling = {}  # field -> samples still to send
+        self.last_full = None
+        self.published = 0
+        self.suppressed = 0
+
+    def _moved(self, name, value):
+        if name not in self.sent:
+            return True
+        ref = self.sent[name]
+        if value is None or ref is None:
+            return (value is None) != (ref is None)
+        return abs(value - ref) > self.deadbands.get(name, 0.0)
+
+    def filter(self, payload):
+        t = payload["timestamp"]
+        fields = {k: v for k, v in payload.items() if k != "timestamp"}
+        changed = {}
+        for k, v in fields.items():
+            if self._moved(k, v):
+                changed[k] = v
+                self._settling[k] = self.settle.get(k, 0)
+            elif self._settling.get(k):
+                changed[k] = v
+                self._settling[k] -= 1
+        if self.last_full is None or t - self.last_full >= self.heartbeat_sec:
+            changed = fields
+            self.last_full = t
+        elif not changed:
+            self.suppressed += 1
+            return None
+        self.sent.update(changed)
+        self.published += 1
+        return {"timestamp": t, **changed}
+
+    def expand(self, out):
+        """A filtered payload with the held fields written out (self-contained)."""
+        return {"timestamp": out["timestamp"], **self.sent, **out}
+
+    def force_full(self):
+        """Send everything next time (e.g. after samples were spooled offline)."""
+        self.last_full = None
+
+    def stats(self):
+        return {"published": self.published, "suppressed": self.suppressed}
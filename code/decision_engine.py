@@ -0,0 +1,66 @@
+"""
+Heater decision rules shared by PC_server.decide_sample and backtest.py.
+
+Production and the backtest's reference replay call the same functions, so
+`backtest.py --verify` (vectorised vs reference) also checks the vectorised
+replay against the rules the server actually runs.
+
+    trimmed_mean    moving average of the last N readings, min/max dropped
+    window_state    averaged window distance -> open / closed, failing safe
+                    to "open" when no window reading arrived for hold_sec
+    heater_decision Smart mode: adaptive thresholds plus an OFF hysteresis
+"""
+
+
+def trimmed_mean(values):
+    if not values:
+        return None
+    if len(values) < 3:
+        return sum(values) / len(values)
+    vals = sorted(values)
+    core = vals[1:-1]
+    return sum(core) / len(core)
+
+
+def window_state(current, recent, last_good_age, threshold, hold_sec):
+    """
+    (avg_window, window_is_open) for one sample.
+    current: this sample's window (None = no usable echo)
+    recent: the last N non-missing window readings
+    last_good_age: seconds since the last non-missing reading, or None
+    Without a reading for more than hold_sec the average is None and the
+    window counts as open, so the heater fails safe to OFF.
+    """
+    avg = None
+    if current is not None or (last_good_age is not None and last_good_age <= hold_sec):
+        avg = trimmed_mean(recent)
+        if avg is None:
+            avg = current
+    return avg, avg is None or avg > threshold
+
+
+def heater_decision(temp, hum, win, th, last_state, hysteresis):
+    """(command, reason). th: thresholds dict with T_cold, H_dry and W_open."""
+    if win is None:
+        return "OFF", "No window data"
+
+    if win >= th["W_open"]:
+        return "OFF", "Window open – heating disabled"
+
+    if temp is None or hum is None:
+        return "OFF", "Missing temperature/humidity data"
+
+    if temp < th["T_cold"] and hum >= th["H_dry"]:
+        return "ON", "Temperature below adaptive threshold"
+
+    if temp < th["T_cold"] and hum < th["H_dry"]:
+        return "OFF", "Air too dry – heating not recommended"
+
+    if (
+        last_state == "ON"
+        and hum >= th["H_dry"]
+        and temp < th["T_cold"] + hysteresis
+    ):
+        return "ON", "Within hysteresis band"
+
+    return "OFF", "Temperature comfortable"
@@ -0,0 +1,153 @@
+"""
+Bounded worker pool that takes decision work off the MQTT network thread.
+
+paho runs on_message on its network loop thread, so anything slow in there
+(sqlite, NumPy, publishes) delays keepalives and every other topic.
+Dispatcher turns callbacks into work items:
+
+- items are routed to a lane by key (the device id), and each lane is served
+  by exactly one worker thread, so items for one device stay in order;
+- every lane is bounded; when it is full the policy decides what to shed:
+    "drop_oldest" - discard the oldest queued item in that lane
+    "coalesce"    - keep at most one pending item per key (the latest one);
+                    if the lane is still full, drop the oldest key
+- stats() exposes queue depth, drops and coalesced counts.
+"""
+import threading
+import zlib
+from collections import OrderedDict, deque
+
+POLICIES = ("drop_oldest", "coalesce")
+
+WORKERS = 4
+LANE_CAPACITY = 256
+POLICY = "coalesce"
+
+
+class _Lane:
+    def __init__(self, capacity, policy):
+        self.capacity = capacity
+        self.policy = policy
+        self.cond = threading.Condition()
+        # drop_oldest: deque of (key, item); coalesce: key -> latest item
+        self.pending = OrderedDict() if policy == "coalesce" else deque()
+        self.max_depth = 0
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def put(self, key, item):
+        with self.cond:
+            self.submitted += 1
+            pending = self.pending
+            if self.policy == "coalesce":
+                if key in pending:
+                    pending[key] = item  # keeps its place in line
+                    self.coalesced += 1
+                    return
+                if len(pending) >= self.capacity:
+                    pending.popitem(last=False)
+                    self.dropped += 1
+                pending[key] = item
+            else:
+                if len(pending) >= self.capacity:
+                    pending.popleft()
+                    self.dropped += 1
+                pending.append((key, item))
+            if len(pending) > self.max_depth:
+                self.max_depth = len(pending)
+            self.cond.notify()
+
+    def take(self, stopping):
+        """Next item, or None once stopping() is true and the lane is empty."""
+        with self.cond:
+            while not self.pending:
+                if stopping():
+                    return None
+                self.cond.wait(0.5)
+            if self.policy == "coalesce":
+                return self.pending.popitem(last=False)[1]
+            return self.pending.popleft()[1]
+
+
+class Dispatcher:
+    """
+    handler: callable(item), run on a worker thread.
+    workers: number of lanes / threads.
+    """
+
+    def __init__(self, handler, workers=WORKERS, lane_capacity=LANE_CAPACITY, policy=POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {POLICIES}")
+        self.handler = handler
+        self.policy = policy
+        self._lanes = [_Lane(lane_capacity, policy) for _ in range(max(1, workers))]
+        self._threads = []
+        self._stopping = False
+
+    def start(self):
+        if self._threads:
+            return self
+        self._stopping = False
+        for i, lane in enumerate(self._lanes):
+            t = threading.Thread(target=self._run, args=(lane,), name=f"dispatch-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self, timeout=None):
+        """Finish queued work, then stop the workers."""
+        self._stopping = True
+        for lane in self._lanes:
+            with lane.cond:
+                lane.cond.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def lane_for(self, key):
+        return self._lanes[zlib.crc32(str(key).encode()) % len(self._lanes)]
+
+    def submit(self, key, item):
+        """Never blocks; sheds load according to the policy when the lane is full."""
+        self.lane_for(key).put(key, item)
+
+    def _run(self, lane):
+        stopping = lambda: self._stopping
+        while True:
+            item = lane.take(stopping)
+            if item is None:
+                return
+            try:
+                self.handler(item)
+            except Exception as e:
+                print("Dispatch handler failed:", e)
+                with lane.cond:
+                    lane.errors += 1
+            with lane.cond:
+                lane.processed += 1
+
+    def stats(self):
+        totals = {
+            "workers": len(self._lanes),
+            "policy": self.policy,
+            "queue_depth": 0,
+            "max_lane_depth": 0,
+            "submitted": 0,
+            "processed": 0,
+            "dropped": 0,
+            "coalesced": 0,
+            "errors": 0,
+        }
+        for lane in self._lanes:
+            with lane.cond:
+                totals["queue_depth"] += len(lane.pending)
+                totals["max_lane_depth"] = max(totals["max_lane_depth"], lane.max_depth)
+                totals["submitted"] += lane.submitted
+                totals["processed"] += lane.processed
+                totals["dropped"] += lane.dropped
+                totals["coalesced"] += lane.coalesced
+                totals["errors"] += lane.errors
+        return totals
@@ -0,0 +1,89 @@
+"""
+Per-device server state for a fleet of sensor boxes.
+
+Topics follow cx/<device_id>/<kind> (kind: sensors, heater, alert). The
+server subscribes with cx/+/sensors and cx/+/heater and keeps one
+DeviceState per box in a DeviceRegistry.
+
+Each DeviceState has its own lock, so rooms never contend with each other.
+The registry itself is split into shards; a shard lock is only taken the
+first time a device is seen.
+"""
+import threading
+import zlib
+
+TOPIC_PREFIX = "cx"
+SHARDS = 64
+
+
+def topic_for(device_id, kind):
+    return f"{TOPIC_PREFIX}/{device_id}/{kind}"
+
+
+def wildcard_topic(kind):
+    return f"{TOPIC_PREFIX}/+/{kind}"
+
+
+def parse_topic(topic):
+    """cx/<device>/<kind> -> (device, kind); (None, None) for anything else."""
+    parts = (topic or "").split("/")
+    if len(parts) != 3 or parts[0] != TOPIC_PREFIX or not parts[1]:
+        return None, None
+    return parts[1], parts[2]
+
+
+class DeviceState:
+    """Heater state and alert cooldown timestamps for one device."""
+
+    __slots__ = (
+        "device_id",
+        "lock",
+        "last_published_heater",
+        "last_health_alert_ts",
+        "last_co2_alert_ts",
+        "last_hum_alert_ts",
+        "last_tvoc_alert_ts",
+        "last_heater_alert_ts",
+    )
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.lock = threading.Lock()
+        self.last_published_heater = None  # "ON"/"OFF"
+        self.last_health_alert_ts = 0.0
+        self.last_co2_alert_ts = 0.0
+        self.last_hum_alert_ts = 0.0
+        self.last_tvoc_alert_ts = 0.0
+        self.last_heater_alert_ts = 0.0
+
+
+class DeviceRegistry:
+    def __init__(self, shards=SHARDS):
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+
+    def _shard(self, device_id):
+        return self._shards[zlib.crc32(device_id.encode()) % len(self._shards)]
+
+    def get(self, device_id):
+        devices, lock = self._shard(device_id)
+        dev = devices.get(device_id)
+        if dev is None:
+            with lock:
+                dev = devices.get(device_id)
+                if dev is None:
+                    dev = DeviceState(device_id)
+                    devices[device_id] = dev
+        return dev
+
+    def find(self, device_id):
+        """Like get() but never creates a device."""
+        return self._shard(device_id)[0].get(device_id)
+
+    def device_ids(self):
+        ids = []
+        for devices, _ in self._shards:
+            ids.extend(list(devices))
+        return sorted(ids)
+
+    def __len__(self):
+        return sum(len(devices) for devices, _ in self._shards)
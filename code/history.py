@@ -0,0 +1,171 @@
+"""
+History queries for the dashboard: range + resolution selection + LTTB.
+
+query_history() picks the cheapest source that still has enough detail for
+the requested point budget:
+
+    raw sensor_log      when span / points < 60 s   (1 Hz rows, only the
+                        day partitions / compressed chunks overlapping the range)
+    sensor_rollup_1m    when span / points < 3600 s
+    sensor_rollup_1h    otherwise
+
+and then downsamples to `points` with Largest-Triangle-Three-Buckets, which
+keeps peaks and edges that plain striding would drop. The result is
+columnar (parallel arrays) rather than one object per row:
+
+    {"device": .., "metric": .., "resolution": "raw"|"1m"|"1h",
+     "t": [...], "v": [...], "min": [...]?, "max": [...]?}
+
+min / max are present for rollup resolutions.
+"""
+import sqlite3
+
+import numpy as np
+
+import chunk_store
+import partitions
+import rollups
+
+METRICS = rollups.METRICS
+
+DEFAULT_SPAN_SEC = 24 * 3600
+DEFAULT_POINTS = 1000
+MAX_POINTS = 5000
+VALUE_DECIMALS = 3
+
+
+def choose_resolution(span_sec, points):
+    step = span_sec / max(points, 1)
+    if step < 60:
+        return "raw"
+    if step < 3600:
+        return "1m"
+    return "1h"
+
+
+def load_series(conn, device_id, metric, t_from, t_to, resolution):
+    """Returns (t, v, vmin, vmax) NumPy arrays; vmin / vmax are None for raw."""
+    if metric not in METRICS:
+        raise ValueError(f"unknown metric {metric!r}")
+
+    if resolution == "raw":
+        rows = conn.execute(
+            f"SELECT time, {metric} FROM {partitions.source(conn, t_from, t_to)} "
+            f"WHERE device_id = ? AND time >= ? AND time < ? AND {metric} IS NOT NULL "
+            "ORDER BY time",
+            (device_id, t_from, t_to)
+        ).fetchall()
+        col = 2 + METRICS.index(metric)
+        compacted = [
+            (r[1], r[col]) for r in chunk_store.rows_between(conn, t_from, t_to, device_id)
+            if r[col] is not None
+        ]
+        if compacted:
+            rows = sorted(compacted + rows, key=lambda r: r[0])
+        arr = np.array(rows, dtype=float).reshape(-1, 2)
+        return arr[:, 0], arr[:, 1], None, None
+
+    table = rollups.table_for(resolution)
+    rows = conn.execute(
+        f"SELECT bucket, {metric}_sum / {metric}_count, {metric}_min, {metric}_max FROM {table} "
+        f"WHERE device_id = ? AND bucket >= ? AND bucket < ? AND {metric}_count > 0 "
+        "ORDER BY bucket",
+        (device_id, t_from, t_to)
+    ).fetchall()
+    arr = np.array(rows, dtype=float).reshape(-1, 4)
+    return arr[:, 0], arr[:, 1], arr[:, 2], arr[:, 3]
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Indices of the points Largest-Triangle-Three-Buckets keeps.
+
+    Bucket edges and the next-bucket averages are computed for all buckets
+    at once; only the anchor selection (which depends on the previous pick)
+    walks the buckets, with a vectorised argmax over each bucket's slice.
+    """
+    n = len(x)
+    if n_out >= n:
+        return np.arange(n)
+    if n_out < 3:
+        return np.array([0, n - 1], dtype=np.int64)
+
+    # Buckets cover x[1:-1]; first and last points are always kept
+    edges = (np.floor(np.linspace(1, n - 1, n_out - 1))).astype(np.int64)
+    starts = edges[:-1]
+    ends = edges[1:]
+
+    sums_x = np.add.reduceat(x[1:n - 1], starts - 1)
+    sums_y = np.add.reduceat(y[1:n - 1], starts - 1)
+    counts = (ends - starts).astype(float)
+    avg_x = sums_x / counts
+    avg_y = sums_y / counts
+    # Anchor C for bucket i is the average of bucket i + 1 (last point for the final bucket)
+    next_x = np.append(avg_x[1:], x[n - 1])
+    next_y = np.append(avg_y[1:], y[n - 1])
+
+    out = np.empty(n_out, dtype=np.int64)
+    out[0] = 0
+    out[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        s, e = starts[i], ends[i]
+        bx = x[s:e]
+        by = y[s:e]
+        ax, ay = x[a], y[a]
+        area = np.abs((ax - next_x[i]) * (by - ay) - (ax - bx) * (next_y[i] - ay))
+        a = s + int(np.argmax(area))
+        out[i + 1] = a
+    return out
+
+
+def query_history(conn, device_id, metric, t_from, t_to, points=DEFAULT_POINTS, resolution=None):
+    points = max(2, min(int(points), MAX_POINTS))
+    resolution = resolution or choose_resolution(t_to - t_from, points)
+    t, v, vmin, vmax = load_series(conn, device_id, metric, t_from, t_to, resolution)
+
+    idx = lttb_indices(t, v, points)
+    out = {
+        "device": device_id,
+        "metric": metric,
+        "resolution": resolution,
+        "from": t_from,
+        "to": t_to,
+        "t": t[idx].astype(np.int64).tolist(),
+        "v": np.round(v[idx], VALUE_DECIMALS).tolist(),
+    }
+    if vmin is not None:
+        out["min"] = np.round(vmin[idx], VALUE_DECIMALS).tolist()
+        out["max"] = np.round(vmax[idx], VALUE_DECIMALS).tolist()
+    return out
+
+
+def history_request(db_file, args, now, default_device):
+    """
+    Shared by the Flask and ASGI routes. args: mapping of query parameters
+    (device, metric, from, to, points, resolution). Returns (body, status).
+    """
+    metric = args.get("metric") or "temperature"
+    if metric not in METRICS:
+        return {"error": f"metric must be one of {', '.join(METRICS)}"}, 400
+    resolution = args.get("resolution") or None
+    if resolution is not None and resolution != "raw" and resolution not in rollups.RESOLUTIONS:
+        return {"error": "resolution must be raw, 1m or 1h"}, 400
+    try:
+        t_to = int(float(args.get("to") or now))
+        t_from = int(float(args.get("from") or (t_to - DEFAULT_SPAN_SEC)))
+        points = int(args.get("points") or DEFAULT_POINTS)
+    except (ValueError, OverflowError):
+        # int(float("inf")) raises OverflowError, not ValueError
+        return {"error": "from, to and points must be finite numbers"}, 400
+    if t_from >= t_to:
+        return {"error": "from must be before to"}, 400
+
+    device_id = args.get("device") or default_device
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    try:
+        return query_history(conn, device_id, metric, t_from, t_to, points, resolution), 200
+    except sqlite3.OperationalError as e:
+        return {"error": str(e)}, 503
+    finally:
+        conn.close()
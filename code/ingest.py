@@ -0,0 +1,265 @@
+"""
+Single-decode ingestion pipeline for sensor messages.
+
+PC_logger and PC_server used to parse every sensor payload separately, and
+the server then read back from sqlite what the logger had just written.
+IngestPipeline runs each message once through:
+
+  decode   -> JSON or wire_format binary to typed SensorSamples (a message
+              may carry a batch; the later stages run once per sample).
+              Fields the device left out as unchanged (deadband) are filled
+              from its previous sample (HoldState)
+  validate -> reject samples without any reading (a missing window alone
+              is kept: the other fields are stored and the server
+              decides without it, see PC_server.decide_sample)
+  persist  -> hand the row to a BatchWriter (optional)
+  decide   -> call the server's decision handler with the same sample
+
+and keeps per-stage timings (count / total / max / last, in ms).
+"""
+import json
+import threading
+import time
+from dataclasses import dataclass
+
+import fleet
+import metrics
+import schema
+import wire_format
+
+STAGES = ("decode", "validate", "persist", "decide")
+
+STAGE_SECONDS = metrics.Histogram(
+    "pc_ingest_stage_seconds", "Time per ingestion stage (decide includes the decision handler)", ("stage",)
+)
+SAMPLES_DROPPED = metrics.Counter(
+    "pc_ingest_dropped_total", "Sensor payloads not processed, by reason", ("reason",)
+)
+
+
+def to_float(x):
+    try:
+        return float(x) if x is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def device_from_topic(topic):
+    """cx/<device>/sensors -> <device>; falls back to the default box."""
+    device_id, _ = fleet.parse_topic(topic)
+    return device_id or schema.DEFAULT_DEVICE_ID
+
+
+@dataclass
+class SensorSample:
+    device_id: str
+    time: int
+    temperature: float | None = None
+    humidity: float | None = None
+    window: float | None = None
+    co2_ppm: float | None = None
+    tvoc_ppb: float | None = None
+    # Share of the ultrasonic burst that agreed (RP1 with ultrasonic.py); not stored
+    window_quality: float | None = None
+    # Fields the payload left out (= unchanged); HoldState fills them in
+    held: tuple = ()
+
+    def values(self):
+        return {
+            "temperature": self.temperature,
+            "humidity": self.humidity,
+            "window": self.window,
+            "co2_ppm": self.co2_ppm,
+            "tvoc_ppb": self.tvoc_ppb,
+        }
+
+    def row(self):
+        """Row tuple in BatchWriter / sensor_log order."""
+        return (
+            self.device_id, self.time, self.temperature, self.humidity,
+            self.window, self.co2_ppm, self.tvoc_ppb,
+        )
+
+    def loggable(self):
+        # Any reading is worth a row; e.g. the window is None when the
+        # ultrasonic burst got no usable echo, the rest is still valid
+        return any(v is not None for v in self.values().values())
+
+
+FIELDS = wire_format.KEYS
+
+
+def _sample_from_json(device_id, data):
+    try:
+        t = int(data.get("timestamp", time.time()))
+    except (TypeError, ValueError):
+        t = int(time.time())
+
+    return SensorSample(
+        device_id=device_id,
+        time=t,
+        temperature=to_float(data.get("temperature")),
+        humidity=to_float(data.get("humidity")),
+        window=to_float(data.get("window")),
+        co2_ppm=to_float(data.get("co2_ppm")),
+        tvoc_ppb=to_float(data.get("tvoc_ppb")),
+        window_quality=to_float(data.get("window_quality")),
+        held=tuple(name for name in FIELDS if name not in data),
+    )
+
+
+def decode_samples(topic, payload):
+    """
+    Decode one sensor message (bytes or str) into a list of SensorSamples.
+    Accepts the wire_format binary batch, a JSON object, or a JSON array of
+    objects. Returns None if the payload is none of those.
+    """
+    device_id = device_from_topic(topic)
+    if wire_format.is_binary(payload):
+        try:
+            rows = wire_format.decode(payload)
+        except wire_format.WireFormatError:
+            return None
+        samples = []
+        for t, values in rows:
+            held = ()
+            if wire_format.HELD in values:
+                held = tuple(name for name, v in zip(FIELDS, values) if v is wire_format.HELD)
+                values = tuple(None if v is wire_format.HELD else v for v in values)
+            # sensor_log keeps whole seconds
+            samples.append(SensorSample(device_id, int(t), *values, held=held))
+        return samples
+
+    try:
+        # json.loads takes bytes directly; no separate utf-8 decode pass
+        data = json.loads(payload)
+    except ValueError:
+        return None
+    if isinstance(data, dict):
+        return [_sample_from_json(device_id, data)]
+    if isinstance(data, list) and data and all(isinstance(d, dict) for d in data):
+        return [_sample_from_json(device_id, d) for d in data]
+    return None
+
+
+def decode_sample(topic, payload):
+    """Single-sample form of decode_samples: the first sample, or None."""
+    samples = decode_samples(topic, payload)
+    return samples[0] if samples else None
+
+
+class HoldState:
+    """
+    Last value of every field per device, for payloads that leave unchanged
+    fields out (RP1 deadband publishing). A held field takes the device's
+    previous value, which may itself be None (missing). Only samples newer
+    than the last one update the state, so a late backlog sample cannot
+    overwrite the live values.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last = {}  # device_id -> [time, {field: value}]
+
+    def apply(self, sample):
+        with self._lock:
+            entry = self._last.get(sample.device_id)
+            if entry is None:
+                entry = self._last[sample.device_id] = [None, {}]
+            last_time, last = entry
+            for name in sample.held:
+                setattr(sample, name, last.get(name))
+            if last_time is None or sample.time >= last_time:
+                entry[0] = sample.time
+                for name in FIELDS:
+                    last[name] = getattr(sample, name)
+        return sample
+
+
+class IngestPipeline:
+    """
+    writer:  BatchWriter or None (None = another process persists the data)
+    decide:  callable(SensorSample) or None
+    """
+
+    def __init__(self, writer=None, decide=None):
+        self.writer = writer
+        self.decide = decide
+        self.holds = HoldState()
+        self._lock = threading.Lock()
+        self.decode_errors = 0
+        self.rejected = 0
+        self._timings = {s: [0, 0.0, 0.0, 0.0] for s in STAGES}  # count, total, max, last
+        self._stage_seconds = {s: STAGE_SECONDS.labels(s) for s in STAGES}
+
+    def _record(self, stage, elapsed_ms):
+        self._stage_seconds[stage].observe(elapsed_ms / 1000.0)
+        with self._lock:
+            t = self._timings[stage]
+            t[0] += 1
+            t[1] += elapsed_ms
+            t[3] = elapsed_ms
+            if elapsed_ms > t[2]:
+                t[2] = elapsed_ms
+
+    def process(self, topic, payload):
+        """Runs every sample in the message through the stages; returns the accepted ones."""
+        t0 = time.perf_counter()
+        samples = decode_samples(topic, payload)
+        if samples is not None:
+            for sample in samples:
+                self.holds.apply(sample)
+        t1 = time.perf_counter()
+        self._record("decode", (t1 - t0) * 1000.0)
+        if samples is None:
+            with self._lock:
+                self.decode_errors += 1
+            SAMPLES_DROPPED.labels("decode_error").inc()
+            print("Invalid sensor payload")
+            return None
+
+        accepted = []
+        for sample in samples:
+            t1 = time.perf_counter()
+            ok = sample.loggable()
+            t2 = time.perf_counter()
+            self._record("validate", (t2 - t1) * 1000.0)
+            if not ok:
+                with self._lock:
+                    self.rejected += 1
+                SAMPLES_DROPPED.labels("no_readings").inc()
+                print("No sensor readings in payload")
+                continue
+
+            if self.writer is not None:
+                self.writer.submit(sample.row())
+                t3 = time.perf_counter()
+                self._record("persist", (t3 - t2) * 1000.0)
+            else:
+                t3 = t2
+
+            if self.decide is not None:
+                self.decide(sample)
+                self._record("decide", (time.perf_counter() - t3) * 1000.0)
+            accepted.append(sample)
+        return accepted
+
+    def stats(self):
+        with self._lock:
+            stages = {
+                s: {
+                    "count": c,
+                    "avg_ms": round(total / c, 4) if c else 0.0,
+                    "max_ms": round(mx, 4),
+                    "last_ms": round(last, 4),
+                }
+                for s, (c, total, mx, last) in self._timings.items()
+            }
+            out = {
+                "decode_errors": self.decode_errors,
+                "rejected": self.rejected,
+                "stages": stages,
+            }
+        if self.writer is not None:
+            out["writer"] = self.writer.stats()
+        return out
@@ -0,0 +1,181 @@
+"""
+Fan-out of live device updates to dashboard clients (Server-Sent Events).
+
+Before this every browser tab opened its own MQTT-over-WebSocket connection
+and parsed every raw sensor message. Now the server's single MQTT
+subscription feeds a Broadcaster, which hands updates to N subscribers:
+
+- each Subscription has a bounded buffer: state updates ("sensors",
+  "heater") are coalesced per (device, event) so only the latest values
+  wait to be sent, and discrete events ("alert") sit in a small ring;
+- a client picks its frame rate; everything that arrived in between goes
+  out as one coalesced frame;
+- with deltas on, a state frame only carries fields that changed since the
+  last frame that client received.
+
+publish() only touches the subscribers of that device and never blocks, so
+it is safe to call from the MQTT network thread.
+"""
+import json
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+STATE_EVENTS = ("sensors", "heater")
+
+DEFAULT_RATE_HZ = 1.0
+MAX_RATE_HZ = 10.0
+MIN_RATE_HZ = 0.05
+BUFFER_SIZE = 64
+EVENT_BUFFER_SIZE = 16
+MAX_CLIENTS = 1000
+ALL_DEVICES = "*"
+
+
+class Subscription:
+    def __init__(self, broadcaster, device_id, rate_hz, deltas, buffer_size=BUFFER_SIZE):
+        self.broadcaster = broadcaster
+        self.device_id = device_id
+        if not (math.isfinite(rate_hz) and rate_hz > 0):
+            # min/max pass NaN through, which would never make a frame due
+            raise ValueError("rate must be a positive, finite number")
+        self.interval = 1.0 / min(max(rate_hz, MIN_RATE_HZ), MAX_RATE_HZ)
+        self.deltas = deltas
+        self.buffer_size = buffer_size
+        self.cond = threading.Condition()
+        self.pending = OrderedDict()  # (device, event) -> merged fields
+        self.events = deque(maxlen=EVENT_BUFFER_SIZE)  # (device, event, data)
+        self.sent = {}  # (device, event) -> fields last sent, for deltas
+        self.last_frame = 0.0
+        self.dropped = 0
+        self.closed = False
+
+    def push(self, device_id, event, data):
+        with self.cond:
+            if event in STATE_EVENTS:
+                key = (device_id, event)
+                merged = self.pending.get(key)
+                if merged is None:
+                    if len(self.pending) >= self.buffer_size:
+                        self.pending.popitem(last=False)
+                        self.dropped += 1
+                    self.pending[key] = dict(data)
+                else:
+                    merged.update(data)
+            else:
+                if len(self.events) == self.events.maxlen:
+                    self.dropped += 1
+                self.events.append((device_id, event, data))
+            self.cond.notify()
+
+    def _take(self):
+        frames = []
+        for (device_id, event), fields in self.pending.items():
+            if self.deltas:
+                last = self.sent.setdefault((device_id, event), {})
+                changed = {k: v for k, v in fields.items() if last.get(k) != v}
+                last.update(changed)
+                if not changed:
+                    continue
+                fields = changed
+            frames.append((event, {"device": device_id, **fields}))
+        for device_id, event, data in self.events:
+            frames.append((event, {"device": device_id, **data}))
+        self.pending.clear()
+        self.events.clear()
+        self.last_frame = time.monotonic()
+        return frames
+
+    def poll(self):
+        """Non-blocking: frames due now, or [] if throttled / nothing new."""
+        with self.cond:
+            if time.monotonic() - self.last_frame < self.interval:
+                return []
+            return self._take()
+
+    def wait(self, timeout):
+        """Block until a frame is due (respecting the rate) or timeout; returns frames or []."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while not self.closed:
+                now = time.monotonic()
+                wake = deadline
+                if self.pending or self.events:
+                    due = self.last_frame + self.interval
+                    if now >= due:
+                        return self._take()
+                    wake = min(due, deadline)
+                if now >= deadline:
+                    return []
+                self.cond.wait(wake - now)
+            return []
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.broadcaster.unsubscribe(self)
+
+
+class Broadcaster:
+    def __init__(self, max_clients=MAX_CLIENTS):
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._subs = {}  # device_id or ALL_DEVICES -> tuple of Subscription
+        self._snapshot = {}  # (device, event) -> latest fields, for new clients
+        self.published = 0
+
+    def subscribe(self, device_id=ALL_DEVICES, rate_hz=DEFAULT_RATE_HZ, deltas=True):
+        """Returns a Subscription, or None when max_clients is reached."""
+        sub = Subscription(self, device_id, rate_hz, deltas)
+        with self._lock:
+            if sum(len(s) for s in self._subs.values()) >= self.max_clients:
+                return None
+            # Copy-on-write so publish() can iterate without the lock
+            self._subs[device_id] = self._subs.get(device_id, ()) + (sub,)
+            snapshot = [
+                (dev, event, fields) for (dev, event), fields in self._snapshot.items()
+                if device_id in (ALL_DEVICES, dev)
+            ]
+        for dev, event, fields in snapshot:
+            sub.push(dev, event, fields)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = tuple(s for s in self._subs.get(sub.device_id, ()) if s is not sub)
+            if subs:
+                self._subs[sub.device_id] = subs
+            else:
+                self._subs.pop(sub.device_id, None)
+
+    def publish(self, device_id, event, data):
+        if event in STATE_EVENTS:
+            key = (device_id, event)
+            with self._lock:
+                self._snapshot[key] = {**self._snapshot.get(key, {}), **data}
+        self.published += 1
+        for sub in self._subs.get(device_id, ()) + self._subs.get(ALL_DEVICES, ()):
+            sub.push(device_id, event, data)
+
+    def client_count(self):
+        with self._lock:
+            return sum(len(s) for s in self._subs.values())
+
+
+def sse_frame(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def parse_stream_args(args, default_device):
+    """
+    (device_id, rate_hz, deltas) from query parameters. Raises ValueError
+    for a rate that is not a positive, finite number (callers answer 400).
+    """
+    device_id = args.get("device") or default_device
+    rate = float(args.get("rate") or DEFAULT_RATE_HZ)
+    if not (math.isfinite(rate) and rate > 0):
+        raise ValueError("rate must be a positive, finite number")
+    deltas = str(args.get("delta", "1")).lower() not in ("0", "false", "no")
+    return device_id, rate, deltas
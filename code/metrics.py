@@ -0,0 +1,309 @@
+"""
+Counters, gauges and histograms in Prometheus text format (no client
+library needed).
+
+Hot-path cost is what matters here: every sensor message touches several
+metrics, at 1 Hz per device across the fleet. So:
+
+- Counter and Histogram keep per-thread cells. A thread only ever writes
+  its own cell (a plain list), so inc() / observe() take no lock; a scrape
+  sums the cells. Cells of finished threads are folded into a retired total
+  and dropped, so Flask's thread-per-request model does not leak.
+- labels() is a dict lookup; the lock is only taken the first time a label
+  combination is seen. Call sites on the hot path bind their children once.
+- Gauges are either set() directly or computed at scrape time from a
+  callable (queue depths, client counts), which costs nothing per message.
+
+    REQUESTS = metrics.Counter("pc_http_requests_total", "HTTP requests", ("route", "status"))
+    REQUESTS.labels("/api/heater", "200").inc()
+    print(metrics.REGISTRY.render())
+"""
+import math
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; message handling is sub-millisecond, HTTP and DB reads are not
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+
+class _Cells:
+    """
+    Per-thread accumulators of a fixed size. Writers read their cell from
+    .local directly (one attribute lookup) and call new_cell() on a miss.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self.local = threading.local()
+        self._lock = threading.Lock()
+        self._cells = []  # (thread, cell)
+        self._retired = [0.0] * size
+
+    def new_cell(self):
+        cell = [0.0] * self._size
+        with self._lock:
+            self._fold_dead()
+            self._cells.append((threading.current_thread(), cell))
+        self.local.cell = cell
+        return cell
+
+    def _fold_dead(self):
+        alive = []
+        for thread, cell in self._cells:
+            if thread.is_alive():
+                alive.append((thread, cell))
+            else:
+                # A finished thread never writes again, so its cell is final
+                for i, v in enumerate(cell):
+                    self._retired[i] += v
+        self._cells = alive
+
+    def totals(self):
+        with self._lock:
+            self._fold_dead()
+            out = list(self._retired)
+            cells = [cell for _, cell in self._cells]
+        for cell in cells:
+            for i, v in enumerate(cell):
+                out[i] += v
+        return out
+
+
+class _CounterChild:
+    __slots__ = ("_cells", "_local")
+
+    def __init__(self):
+        self._cells = _Cells(1)
+        self._local = self._cells.local
+
+    def inc(self, amount=1):
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._cells.new_cell()
+        cell[0] += amount
+
+    def value(self):
+        return self._cells.totals()[0]
+
+
+class _GaugeChild:
+    __slots__ = ("_value", "_lock")
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self._value = float(value)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def value(self):
+        return self._value
+
+
+class _HistogramChild:
+    __slots__ = ("_bounds", "_cells", "_local")
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        # one slot per bucket (+Inf last), then the sum
+        self._cells = _Cells(len(bounds) + 2)
+        self._local = self._cells.local
+
+    def observe(self, value):
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._cells.new_cell()
+        cell[bisect_left(self._bounds, value)] += 1
+        cell[-1] += value
+
+    def snapshot(self):
+        """(cumulative bucket counts incl. +Inf, count, sum)."""
+        totals = self._cells.totals()
+        buckets = []
+        running = 0
+        for v in totals[:-1]:
+            running += v
+            buckets.append(running)
+        return buckets, running, totals[-1]
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=(), fn=None, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._children = {}
+        self._lock = threading.Lock()
+        if fn is None and not self.labelnames:
+            self._default = self._child(())
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _child(self, key):
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._new_child()
+                    # Copy-on-write so scrapes can iterate without the lock
+                    self._children = {**self._children, key: child}
+        return child
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return self._child(tuple(str(v) for v in values))
+
+    def _values(self):
+        """[(label values, value)] from the children or the callable."""
+        if self.fn is None:
+            return [(key, child.value()) for key, child in self._children.items()]
+        result = self.fn()
+        if isinstance(result, dict):
+            return [((k,) if not isinstance(k, tuple) else k, v) for k, v in result.items()]
+        return [((), result)]
+
+    def samples(self):
+        for key, value in self._values():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Counter(_Metric):
+    """Monotonic count; fn= makes it read an existing total at scrape time."""
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def value(self):
+        return self._default.value()
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def value(self):
+        return self._default.value()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, None, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def samples(self):
+        for key, child in self._children.items():
+            labels = dict(zip(self.labelnames, key))
+            buckets, count, total = child.snapshot()
+            for bound, value in zip(self.buckets + (math.inf,), buckets):
+                yield self.name + "_bucket", {**labels, "le": _format_value(bound)}, value
+            yield self.name + "_count", labels, count
+            yield self.name + "_sum", labels, total
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"metric {metric.name} already registered")
+            self._metrics = {**self._metrics, metric.name: metric}
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics = {k: v for k, v in self._metrics.items() if k != name}
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """Prometheus text exposition format 0.0.4."""
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                # A broken callback must not take the whole scrape down
+                lines.append(f"# {metric.name} unavailable: {_escape_help(str(e))}")
+                continue
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_help(text):
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items()) + "}"
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    value = float(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value.is_integer() and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(value)
+
+
+REGISTRY = Registry()
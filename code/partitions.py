@@ -0,0 +1,325 @@
+"""
+Day partitions for raw sensor samples.
+
+Raw rows no longer go into one ever-growing sensor_log table. Each UTC day
+has its own table
+
+    sensor_log_d20261018   (device_id, time, temperature, humidity, window,
+                            co2_ppm, tvoc_ppb) + unique (device_id, time) index
+
+and sensor_log becomes a view over all of them (UNION ALL), so existing
+readers keep working. Expiring a day is then a DROP TABLE (see retention.py)
+instead of a DELETE that rewrites index pages.
+
+Writers call insert_rows(), which routes every row to the partition for its
+own timestamp (late samples land in the right day) and creates partitions on
+first use. Range readers should use source() so only the overlapping days
+are scanned.
+
+A device sample is identified by (device_id, time). RP1 resends a backlog
+batch whose PUBACK was lost (QoS 1), so the same sample can arrive twice;
+rows are inserted with INSERT OR IGNORE against the unique index and
+insert_rows() returns only the rows actually stored, which is what the
+rollups get fed.
+
+Writers that still run "INSERT INTO sensor_log" (a PC_logger started before
+the v4 migration) keep working. An INSTEAD OF INSERT trigger on the view
+sends each row to its day's partition. A trigger cannot create tables, so
+a row for a day that has no partition yet goes to sensor_log_unrouted,
+which is part of the view. The next insert_rows() batch or retention pass
+moves it into the right partition (drain_unrouted).
+"""
+import calendar
+import time
+
+# schema imports this module; its attributes are only read at call time
+import schema
+
+VIEW = "sensor_log"
+PREFIX = "sensor_log_d"
+UNROUTED = "sensor_log_unrouted"
+TRIGGER = "sensor_log_insert"
+SPLIT_MARK = "sensor_log_split"
+PARTITION_SEC = 24 * 3600
+
+COLUMNS = ("device_id", "time", "temperature", "humidity", "window", "co2_ppm", "tvoc_ppb")
+_COLS = ", ".join(COLUMNS)
+
+# SQLite caps a compound SELECT at 500 terms; larger views nest groups
+_UNION_GROUP = 400
+
+
+def immediate(conn, fn, *args):
+    """Run fn(conn, *args) in one BEGIN IMMEDIATE transaction and return its result."""
+    old_isolation = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn, *args)
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.isolation_level = old_isolation
+
+
+def partition_for(t):
+    # Rows without a timestamp live in the 1970-01-01 partition
+    t = int(t or 0)
+    return PREFIX + time.strftime("%Y%m%d", time.gmtime(t - t % PARTITION_SEC))
+
+
+def partition_start(name):
+    return calendar.timegm(time.strptime(name[len(PREFIX):], "%Y%m%d"))
+
+
+def list_partitions(conn):
+    """[(day_start, name), ...] oldest first."""
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?",
+        (PREFIX + "%",)
+    ).fetchall()
+    return sorted((partition_start(name), name) for (name,) in rows)
+
+
+def create_partition(conn, name):
+    # Same shape as the v2 sensor_log, so rows can be moved with INSERT ... SELECT
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {name} (
+        device_id TEXT NOT NULL DEFAULT '{schema.DEFAULT_DEVICE_ID}',
+        time INTEGER,
+        temperature REAL,
+        humidity REAL,
+        window REAL,
+        co2_ppm REAL,
+        tvoc_ppb REAL
+    )
+    """)
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name}_device_time ON {name} (device_id, time)")
+
+
+def make_unique(conn, name):
+    """
+    Delete repeated (device_id, time) rows from a partition made before the
+    index was unique, keeping the first stored, and rebuild the index as
+    UNIQUE (no commit; used by the v6 migration). Returns the distinct
+    times whose duplicates were removed.
+    """
+    dup = f"time IS NOT NULL AND rowid NOT IN (SELECT MIN(rowid) FROM {name} GROUP BY device_id, time)"
+    times = [t for (t,) in conn.execute(f"SELECT DISTINCT time FROM {name} WHERE {dup}")]
+    if times:
+        conn.execute(f"DELETE FROM {name} WHERE {dup}")
+    conn.execute(f"DROP INDEX IF EXISTS {name}_device_time")
+    conn.execute(f"CREATE UNIQUE INDEX {name}_device_time ON {name} (device_id, time)")
+    return times
+
+
+def _union(names):
+    selects = [f"SELECT {_COLS} FROM {name}" for name in names]
+    if len(selects) <= _UNION_GROUP:
+        return " UNION ALL ".join(selects)
+    groups = [
+        f"SELECT {_COLS} FROM (" + " UNION ALL ".join(selects[i:i + _UNION_GROUP]) + ")"
+        for i in range(0, len(selects), _UNION_GROUP)
+    ]
+    return " UNION ALL ".join(groups)
+
+
+def _empty_select():
+    return (
+        "SELECT CAST(NULL AS TEXT) AS device_id, CAST(NULL AS INTEGER) AS time, "
+        "CAST(NULL AS REAL) AS temperature, CAST(NULL AS REAL) AS humidity, "
+        "CAST(NULL AS REAL) AS window, CAST(NULL AS REAL) AS co2_ppm, "
+        "CAST(NULL AS REAL) AS tvoc_ppb WHERE 0"
+    )
+
+
+def _insert_trigger(parts):
+    new_cols = ", ".join(
+        f"COALESCE(NEW.device_id, '{schema.DEFAULT_DEVICE_ID}')" if c == "device_id" else f"NEW.{c}"
+        for c in COLUMNS
+    )
+    routes = [
+        f"INSERT OR IGNORE INTO {name} ({_COLS}) SELECT {new_cols} "
+        f"WHERE NEW.time >= {start} AND NEW.time < {start + PARTITION_SEC};"
+        for start, name in parts
+    ]
+    days = ", ".join(str(start // PARTITION_SEC) for start, _ in parts)
+    routes.append(
+        f"INSERT OR IGNORE INTO {UNROUTED} ({_COLS}) SELECT {new_cols} "
+        f"WHERE NEW.time IS NULL OR CAST(NEW.time AS INTEGER) / {PARTITION_SEC} NOT IN ({days});"
+    )
+    return f"CREATE TRIGGER {TRIGGER} INSTEAD OF INSERT ON {VIEW} BEGIN\n" + "\n".join(routes) + "\nEND"
+
+
+def rebuild_view(conn):
+    """
+    Point the sensor_log view and its insert trigger at the current set of
+    partitions (no commit). Dropping the view drops the old trigger.
+    """
+    parts = list_partitions(conn)
+    create_partition(conn, UNROUTED)
+    conn.execute(f"DROP VIEW IF EXISTS {VIEW}")
+    conn.execute(f"CREATE VIEW {VIEW} AS " + _union([name for _, name in parts] + [UNROUTED]))
+    conn.execute(_insert_trigger(parts))
+
+
+def _has_unrouted(conn):
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (UNROUTED,)).fetchone() is None:
+        return False
+    return conn.execute(f"SELECT 1 FROM {UNROUTED} LIMIT 1").fetchone() is not None
+
+
+def drain_unrouted(conn):
+    """
+    Move rows the view trigger could not route into their day partitions
+    (no commit). Returns the number of rows moved.
+    """
+    if not _has_unrouted(conn):
+        return 0
+    rows = conn.execute(f"SELECT {_COLS} FROM {UNROUTED}").fetchall()
+    conn.execute(f"DELETE FROM {UNROUTED}")
+    _route(conn, rows)
+    return len(rows)
+
+
+def insert_rows(conn, rows):
+    """
+    BatchWriter insert step: rows in COLUMNS order, grouped by partition.
+    Runs inside the caller's transaction, which must be an explicit BEGIN
+    (see immediate()) since creating a partition and rebuilding the view is
+    DDL; called outside a transaction it opens one itself. Listing
+    partitions per batch is one small sqlite_master read and also picks up
+    days dropped by retention. Returns the rows stored, without the ones
+    already present (same device_id and time).
+    """
+    if not conn.in_transaction:
+        return immediate(conn, insert_rows, rows)
+    drain_unrouted(conn)
+    return _route(conn, rows)
+
+
+def _route(conn, rows):
+    by_part = {}
+    for row in rows:
+        by_part.setdefault(partition_for(row[1]), []).append(row)
+
+    existing = {name for _, name in list_partitions(conn)}
+    missing = [name for name in by_part if name not in existing]
+    for name in missing:
+        create_partition(conn, name)
+    if missing:
+        rebuild_view(conn)
+
+    placeholders = ", ".join("?" for _ in COLUMNS)
+    inserted = []
+    for name, part_rows in by_part.items():
+        # One execute per row: executemany's rowcount does not say which rows were ignored
+        sql = f"INSERT OR IGNORE INTO {name} ({_COLS}) VALUES ({placeholders})"
+        inserted += [row for row in part_rows if conn.execute(sql, row).rowcount]
+    return inserted
+
+
+def source(conn, t_from=None, t_to=None):
+    """
+    FROM-clause expression covering [t_from, t_to): a single partition, a
+    UNION ALL subquery of the overlapping ones, or the full view.
+    """
+    if t_from is None and t_to is None:
+        return VIEW
+    names = [
+        name for start, name in list_partitions(conn)
+        if (t_to is None or start < t_to) and (t_from is None or start + PARTITION_SEC > t_from)
+    ]
+    if _has_unrouted(conn):
+        names.append(UNROUTED)
+    if not names:
+        return f"({_empty_select()})"
+    if len(names) == 1:
+        return names[0]
+    return f"({_union(names)})"
+
+
+def _has_legacy_table(conn):
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (VIEW,)).fetchone()
+    return row is not None and row[0] == "table"
+
+
+def _copy_legacy(conn, where, params=()):
+    """Copy legacy sensor_log rows matching where into their day partitions (no commit)."""
+    days = [d for (d,) in conn.execute(f"SELECT DISTINCT time / {PARTITION_SEC} FROM {VIEW} WHERE {where}", params)]
+    for day in days:
+        # Rows without a timestamp are kept in the 1970-01-01 partition
+        start = (day or 0) * PARTITION_SEC
+        name = partition_for(start)
+        create_partition(conn, name)
+        # Resent samples may be in the legacy table more than once
+        if day is None:
+            conn.execute(
+                f"INSERT OR IGNORE INTO {name} ({_COLS}) SELECT {_COLS} FROM {VIEW} "
+                f"WHERE ({where}) AND time IS NULL", params
+            )
+        else:
+            conn.execute(
+                f"INSERT OR IGNORE INTO {name} ({_COLS}) SELECT {_COLS} FROM {VIEW} "
+                f"WHERE ({where}) AND time >= ? AND time < ?", (*params, start, start + PARTITION_SEC)
+            )
+
+
+def _copy_legacy_day(conn, day):
+    upto, done = conn.execute(f"SELECT upto, done_day FROM {SPLIT_MARK}").fetchone()
+    if done is not None and day <= done:
+        return  # another process got here first
+    _copy_legacy(conn, "rowid <= ? AND time >= ? AND time < ?", (upto, day * PARTITION_SEC, (day + 1) * PARTITION_SEC))
+    conn.execute(f"UPDATE {SPLIT_MARK} SET done_day = ?", (day,))
+
+
+def copy_legacy_days(conn):
+    """
+    First half of the v4 migration, run before its transaction: copy a
+    plain sensor_log table into day partitions, one day per BEGIN IMMEDIATE,
+    so a live writer waits for one day at a time instead of the whole table.
+    The rows present at the start (rowid <= upto) are copied day by day and
+    progress is kept in sensor_log_split, so an interrupted copy resumes.
+    split_legacy_table() copies whatever was written meanwhile.
+    """
+    if not _has_legacy_table(conn):
+        return
+
+    def mark(conn):
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {SPLIT_MARK} (upto INTEGER NOT NULL, done_day INTEGER)")
+        if conn.execute(f"SELECT 1 FROM {SPLIT_MARK}").fetchone() is None:
+            conn.execute(f"INSERT INTO {SPLIT_MARK} (upto) SELECT COALESCE(MAX(rowid), 0) FROM {VIEW}")
+        return conn.execute(f"SELECT upto, done_day FROM {SPLIT_MARK}").fetchone()
+
+    upto, done = immediate(conn, mark)
+    days = conn.execute(
+        f"SELECT DISTINCT time / {PARTITION_SEC} FROM {VIEW} WHERE rowid <= ? AND time IS NOT NULL ORDER BY 1",
+        (upto,)
+    ).fetchall()
+    for (day,) in days:
+        if done is None or day > done:
+            immediate(conn, _copy_legacy_day, day)
+
+
+def split_legacy_table(conn):
+    """
+    Copy the rows of a plain sensor_log table that copy_legacy_days() has
+    not (all of them if it did not run), drop the table and put the view in
+    its place (no commit; used by the v4 migration).
+    """
+    if _has_legacy_table(conn):
+        upto, done = 0, None
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (SPLIT_MARK,)).fetchone():
+            upto, done = conn.execute(f"SELECT upto, done_day FROM {SPLIT_MARK}").fetchone()
+            conn.execute(f"DROP TABLE {SPLIT_MARK}")
+        if done is None:
+            _copy_legacy(conn, "1")
+        else:
+            # Written after the copy started, days it had not reached, and rows without a time
+            _copy_legacy(conn, "rowid > ? OR time >= ? OR time IS NULL", (upto, (done + 1) * PARTITION_SEC))
+        conn.execute(f"DROP TABLE {VIEW}")
+    rebuild_view(conn)
@@ -0,0 +1,163 @@
+"""
+On-demand sampling profiler for the running server, all threads at once.
+
+A sampler thread wakes every `interval` seconds, grabs every thread's
+current frame with sys._current_frames() and counts the stack it sees.
+Nothing is installed into the other threads (no settrace / setprofile), so
+paho's network loop, the dispatcher workers and the Flask request threads
+run untouched between samples; the only cost to them is the GIL being held
+while a snapshot is walked. It is a wall-clock profile: idle threads show
+up in the place they wait (select, Condition.wait), which is usually what
+explains a server that falls behind.
+
+Overhead is bounded on every axis:
+
+- duration and rate are clamped (MAX_SECONDS, MAX_HZ);
+- the sampler measures its own walk time and sleeps long enough to stay
+  under MAX_DUTY of one core, so a process with many deep stacks gets
+  fewer samples instead of a slower server;
+- stacks are cut at MAX_DEPTH frames and at most MAX_STACKS distinct
+  stacks are kept (the rest are counted under "[truncated]");
+- only one profile runs at a time; a second request gets None.
+
+Output is collapsed-stack text, one "thread;outer;...;inner count" line
+per stack, which flamegraph.pl, speedscope and inferno read directly:
+
+    result = profiler.run(seconds=10, hz=100)
+    print(result.collapsed())
+"""
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+SECONDS = 10.0
+MAX_SECONDS = 60.0
+HZ = 100.0
+MAX_HZ = 250.0
+# Fraction of one core the sampler may use
+MAX_DUTY = 0.05
+MAX_DEPTH = 96
+MAX_STACKS = 20000
+
+_running = threading.Lock()
+
+
+class Profile:
+    def __init__(self, seconds, interval):
+        self.seconds = seconds
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.sampler_seconds = 0.0
+        self.wall_seconds = 0.0
+        self.truncated = 0
+
+    def collapsed(self) -> str:
+        lines = [f"{stack} {count}" for stack, count in self.stacks.most_common()]
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def stats(self) -> dict:
+        wall = self.wall_seconds or 1e-9
+        return {
+            "seconds": round(self.wall_seconds, 3),
+            "interval_ms": round(self.interval * 1000.0, 3),
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+            "truncated": self.truncated,
+            "sampler_cpu_share": round(self.sampler_seconds / wall, 4),
+        }
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frame, labels):
+    """Root-first ';'-joined stack of a frame, cut at MAX_DEPTH."""
+    parts = []
+    while frame is not None and len(parts) < MAX_DEPTH:
+        code = frame.f_code
+        label = labels.get(code)
+        if label is None:
+            label = labels[code] = _frame_label(code)
+        parts.append(label)
+        frame = frame.f_back
+    if frame is not None:
+        parts.append("[deeper]")
+    parts.reverse()
+    return ";".join(parts)
+
+
+def _sample_once(profile, skip, names, labels):
+    frames = sys._current_frames()
+    try:
+        for ident, frame in frames.items():
+            if ident in skip:
+                continue
+            name = names.get(ident)
+            if name is None:
+                # Thread started after the last refresh
+                names.update((t.ident, t.name) for t in threading.enumerate())
+                name = names.get(ident, f"thread-{ident}")
+            stack = f"{name};{_collapse(frame, labels)}"
+            if stack in profile.stacks or len(profile.stacks) < MAX_STACKS:
+                profile.stacks[stack] += 1
+            else:
+                profile.stacks["[truncated]"] += 1
+                profile.truncated += 1
+    finally:
+        # Frames keep their locals alive; do not hold them past the walk
+        del frames
+    profile.samples += 1
+
+
+def _sample(profile, deadline, caller):
+    # Neither the sampler nor the thread waiting for the result is interesting
+    skip = {threading.get_ident(), caller}
+    names = {t.ident: t.name for t in threading.enumerate()}
+    labels = {}
+    clock = time.perf_counter
+    t_start = clock()
+    while True:
+        t0 = clock()
+        if t0 >= deadline:
+            break
+        _sample_once(profile, skip, names, labels)
+        spent = clock() - t0
+        profile.sampler_seconds += spent
+        # Stay under MAX_DUTY even when a walk is slower than the interval
+        time.sleep(max(profile.interval - spent, spent * (1.0 / MAX_DUTY - 1.0)))
+    profile.wall_seconds = clock() - t_start
+
+
+def run(seconds: float = SECONDS, hz: float = HZ) -> Profile | None:
+    """
+    Sample all threads for `seconds` at up to `hz` and return the Profile.
+    Blocks the caller for the duration; returns None if a profile is
+    already running. Raises ValueError for non-finite arguments.
+    """
+    seconds, hz = float(seconds), float(hz)
+    # min/max pass NaN straight through, which would leave the deadline unreachable
+    if not (math.isfinite(seconds) and math.isfinite(hz)):
+        raise ValueError("seconds and hz must be finite")
+    seconds = min(max(seconds, 0.1), MAX_SECONDS)
+    hz = min(max(hz, 1.0), MAX_HZ)
+    if not _running.acquire(blocking=False):
+        return None
+    try:
+        profile = Profile(seconds, 1.0 / hz)
+        deadline = time.perf_counter() + seconds
+        sampler = threading.Thread(target=_sample, args=(profile, deadline, threading.get_ident()),
+                                   name="profiler", daemon=True)
+        sampler.start()
+        sampler.join()
+        return profile
+    finally:
+        _running.release()
+
+
+def is_running() -> bool:
+    return _running.locked()
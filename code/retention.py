@@ -0,0 +1,299 @@
+"""
+Retention for sensor.db: drop expired raw partitions, trim rollups, and
+return freed pages to the OS with incremental vacuum.
+
+Policy (days to keep, None = forever):
+
+    raw   day partitions of sensor_log (see partitions.py) and compressed
+          chunks of compacted days (see chunk_store.py)
+    1m    sensor_rollup_1m buckets
+    1h    sensor_rollup_1h buckets
+
+Each step is its own short BEGIN IMMEDIATE transaction, so a BatchWriter
+only waits (on its busy timeout) for one partition drop or one day of
+rollup deletes, never for the whole pass; WAL readers are not blocked.
+A day partition is only dropped once all of it is older than the cutoff.
+With an archive root set, the partition is first written to the columnar
+archive (see archive.py), so raw history stays available offline.
+
+Freed pages are handed back with PRAGMA incremental_vacuum in small steps.
+That needs auto_vacuum=INCREMENTAL, which new files get from schema.py;
+an existing file has to be converted once, offline (full VACUUM):
+
+    python retention.py sensor.db --convert
+
+RetentionJob runs compaction (optional), prune() and vacuum on a background
+thread; the CLI runs one pass:
+
+    python retention.py [sensor.db] [--raw-days N] [--rollup-1m-days N] [--rollup-1h-days N]
+                        [--archive-root DIR] [--compact-after-days N] [--dry-run]
+"""
+import argparse
+import sqlite3
+import threading
+import time
+
+import archive
+import chunk_store
+import partitions
+import rollups
+import schema
+
+RETENTION_DAYS = {
+    "raw": 30,
+    "1m": 365,
+    "1h": None,
+}
+
+INTERVAL_SEC = 3600
+VACUUM_STEP_PAGES = 256
+VACUUM_PAUSE_SEC = 0.05
+DAY_SEC = 24 * 3600
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def _drop_partition(conn, name):
+    conn.execute(f"DROP TABLE IF EXISTS {name}")
+    partitions.rebuild_view(conn)
+
+
+def _delete_buckets(conn, table, start, end):
+    return conn.execute(
+        f"DELETE FROM {table} WHERE bucket >= ? AND bucket < ?", (start, end)
+    ).rowcount
+
+
+def expired_partitions(conn, now, days):
+    if days is None:
+        return []
+    cutoff = now - days * DAY_SEC
+    return [
+        name for start, name in partitions.list_partitions(conn)
+        if start + partitions.PARTITION_SEC <= cutoff
+    ]
+
+
+def prune(conn, now=None, retention=None, dry_run=False, verbose=False, archive_root=None):
+    """
+    Apply the retention policy once. Returns
+    {"partitions_dropped": n, "chunks_deleted": n, "rollup_rows_deleted": {"1m": n, "1h": n}}.
+    """
+    now = int(time.time() if now is None else now)
+    retention = {**RETENTION_DAYS, **(retention or {})}
+    out = {"partitions_dropped": 0, "chunks_deleted": 0, "rollup_rows_deleted": {}}
+
+    for name in expired_partitions(conn, now, retention["raw"]):
+        if verbose:
+            print(f"  drop {name}")
+        if not dry_run:
+            if archive_root is not None:
+                archive.archive_partition(conn, name, archive_root)
+            partitions.immediate(conn, _drop_partition, name)
+        out["partitions_dropped"] += 1
+
+    if retention["raw"] is not None:
+        cutoff = now - retention["raw"] * DAY_SEC
+        if dry_run:
+            out["chunks_deleted"] = conn.execute(
+                f"SELECT COUNT(*) FROM {chunk_store.TABLE} WHERE t_max < ?", (cutoff,)
+            ).fetchone()[0]
+        else:
+            out["chunks_deleted"] = partitions.immediate(conn, chunk_store.prune, cutoff)
+
+    for resolution in rollups.RESOLUTIONS:
+        days = retention.get(resolution)
+        if days is None:
+            continue
+        table = rollups.table_for(resolution)
+        cutoff = now - days * DAY_SEC
+        first = conn.execute(f"SELECT MIN(bucket) FROM {table} WHERE bucket < ?", (cutoff,)).fetchone()[0]
+        deleted = 0
+        if first is not None and not dry_run:
+            # One day of buckets per transaction keeps the write lock short
+            start = first
+            while start < cutoff:
+                end = min(start + DAY_SEC, cutoff)
+                deleted += partitions.immediate(conn, _delete_buckets, table, start, end)
+                start = end
+        elif first is not None:
+            deleted = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE bucket < ?", (cutoff,)).fetchone()[0]
+        out["rollup_rows_deleted"][resolution] = deleted
+        if verbose and deleted:
+            print(f"  {table}: {deleted} rows older than {days} days")
+    return out
+
+
+def compact(conn, now, after_days, archive_root=None, verbose=False):
+    """Compress closed partitions into sensor_chunks, archiving them first if asked."""
+    before_drop = None
+    if archive_root is not None:
+        def before_drop(conn, name):
+            archive.archive_partition(conn, name, archive_root)
+    return chunk_store.compact(conn, now, after_days, before_drop, verbose)
+
+
+def incremental_vacuum(conn, step_pages=VACUUM_STEP_PAGES, pause_sec=VACUUM_PAUSE_SEC, stop=None):
+    """
+    Release free pages step_pages at a time, pausing between steps so
+    writers get the lock. Returns pages released (0 if auto_vacuum is not
+    INCREMENTAL for this file).
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        return 0
+    released = 0
+    old_isolation = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        while stop is None or not stop.is_set():
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if free == 0:
+                break
+            # executescript steps the pragma to completion; execute() would
+            # stop after the first page
+            conn.executescript(f"PRAGMA incremental_vacuum({step_pages});")
+            released += free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+            time.sleep(pause_sec)
+    finally:
+        conn.isolation_level = old_isolation
+    return released
+
+
+def convert_to_incremental(db_file):
+    """One-time, offline: switch an existing file to auto_vacuum=INCREMENTAL (full VACUUM)."""
+    conn = sqlite3.connect(db_file, timeout=schema.BUSY_TIMEOUT_SEC, isolation_level=None)
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL
+    finally:
+        conn.close()
+
+
+class RetentionJob:
+    def __init__(self, db_file, retention=None, interval_sec=INTERVAL_SEC,
+                 step_pages=VACUUM_STEP_PAGES, pause_sec=VACUUM_PAUSE_SEC, archive_root=None,
+                 compact_after_days=None):
+        self.db_file = db_file
+        self.archive_root = archive_root
+        self.compact_after_days = compact_after_days
+        self.retention = {**RETENTION_DAYS, **(retention or {})}
+        self.interval_sec = interval_sec
+        self.step_pages = step_pages
+        self.pause_sec = pause_sec
+        self._stop = threading.Event()
+        self._thread = None
+        self._warned = False
+
+        self.runs = 0
+        self.errors = 0
+        self.partitions_dropped = 0
+        self.rollup_rows_deleted = 0
+        self.pages_released = 0
+        self.rows_compacted = 0
+        self.last_run_ms = 0.0
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def run_once(self, now=None):
+        t0 = time.perf_counter()
+        conn = sqlite3.connect(self.db_file, timeout=schema.BUSY_TIMEOUT_SEC)
+        try:
+            # Rows a pre-v4 writer sent through the view trigger for a day without a partition
+            partitions.immediate(conn, partitions.drain_unrouted)
+            if self.compact_after_days is not None:
+                compacted = compact(conn, now, self.compact_after_days, self.archive_root)
+                self.rows_compacted += compacted["rows"]
+            result = prune(conn, now, self.retention, archive_root=self.archive_root)
+            released = incremental_vacuum(conn, self.step_pages, self.pause_sec, self._stop)
+            if not self._warned and conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+                self._warned = True
+                print(f"[RETENTION] {self.db_file} is not auto_vacuum=INCREMENTAL; "
+                      "freed pages are reused but the file will not shrink (see retention.py --convert)")
+        finally:
+            conn.close()
+
+        self.runs += 1
+        self.partitions_dropped += result["partitions_dropped"]
+        self.rollup_rows_deleted += sum(result["rollup_rows_deleted"].values())
+        self.pages_released += released
+        self.last_run_ms = (time.perf_counter() - t0) * 1000.0
+        if result["partitions_dropped"] or released:
+            print(f"[RETENTION] dropped {result['partitions_dropped']} partition(s), "
+                  f"released {released} page(s) in {self.last_run_ms:.0f} ms")
+        return result
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "partitions_dropped": self.partitions_dropped,
+            "rollup_rows_deleted": self.rollup_rows_deleted,
+            "pages_released": self.pages_released,
+            "rows_compacted": self.rows_compacted,
+            "last_run_ms": round(self.last_run_ms, 3),
+        }
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                # Any failure (sqlite, disk, archive_partition, ...) only costs this pass
+                self.errors += 1
+                print(f"[RETENTION] pass failed: {type(e).__name__}: {e}")
+            self._stop.wait(self.interval_sec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply sensor.db retention and reclaim space.")
+    parser.add_argument("db_file", nargs="?", default="sensor.db")
+    parser.add_argument("--raw-days", type=int, default=RETENTION_DAYS["raw"])
+    parser.add_argument("--rollup-1m-days", type=int, default=RETENTION_DAYS["1m"])
+    parser.add_argument("--rollup-1h-days", type=int, default=RETENTION_DAYS["1h"])
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be removed")
+    parser.add_argument("--compact-after-days", type=int, default=None,
+                        help="Compress partitions closed for N days into sensor_chunks first")
+    parser.add_argument("--archive-root", default=None,
+                        help="Archive expired partitions here (archive.py format) before dropping them")
+    parser.add_argument("--convert", action="store_true",
+                        help="Switch the file to auto_vacuum=INCREMENTAL (full VACUUM; stop writers first)")
+    args = parser.parse_args()
+
+    schema.ensure_schema(args.db_file)
+    if args.convert:
+        ok = convert_to_incremental(args.db_file)
+        print(f"{args.db_file}: " + ("auto_vacuum=INCREMENTAL" if ok else "conversion failed"))
+        return
+
+    retention = {"raw": args.raw_days, "1m": args.rollup_1m_days, "1h": args.rollup_1h_days}
+    conn = sqlite3.connect(args.db_file, timeout=schema.BUSY_TIMEOUT_SEC)
+    try:
+        t0 = time.perf_counter()
+        if args.compact_after_days is not None and not args.dry_run:
+            compacted = compact(conn, int(time.time()), args.compact_after_days, args.archive_root, verbose=True)
+            print(f"Compacted {compacted['rows']} rows into {compacted['bytes']} bytes of chunks")
+        result = prune(conn, retention=retention, dry_run=args.dry_run, verbose=True,
+                       archive_root=args.archive_root)
+        released = 0 if args.dry_run else incremental_vacuum(conn)
+        print(f"{'Would drop' if args.dry_run else 'Dropped'} {result['partitions_dropped']} partition(s), "
+              f"{result['chunks_deleted']} chunk(s), rollup rows {result['rollup_rows_deleted']}, "
+              f"released {released} page(s) in {time.perf_counter() - t0:.1f}s")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Per-device 1-minute and 1-hour aggregates of sensor_log.
+
+Each rollup row holds, per metric, min / max / sum / count / last value for
+one (device_id, bucket) pair; the mean is sum / count. The tables are:
+
+    sensor_rollup_1m   bucket = time // 60 * 60
+    sensor_rollup_1h   bucket = time // 3600 * 3600
+
+apply_rows() is registered as a BatchWriter flush hook, so every flushed
+batch is folded into both tables inside the same transaction (one UPSERT per
+touched bucket, not per sample). backfill() rebuilds them from existing
+sensor_log rows:
+
+    python rollups.py [sensor.db] [--since EPOCH] [--until EPOCH]
+"""
+import argparse
+import sqlite3
+import time
+
+import chunk_store
+import partitions
+
+METRICS = ("temperature", "humidity", "window", "co2_ppm", "tvoc_ppb")
+
+RESOLUTIONS = {
+    "1m": 60,
+    "1h": 3600,
+}
+
+BACKFILL_CHUNK_SEC = 24 * 3600
+
+
+def table_for(resolution):
+    return f"sensor_rollup_{resolution}"
+
+
+def _ddl(resolution):
+    cols = []
+    for m in METRICS:
+        cols += [
+            f"{m}_min REAL",
+            f"{m}_max REAL",
+            f"{m}_sum REAL NOT NULL DEFAULT 0",
+            f"{m}_count INTEGER NOT NULL DEFAULT 0",
+            f"{m}_last REAL",
+        ]
+    return (
+        f"CREATE TABLE IF NOT EXISTS {table_for(resolution)} (\n"
+        "    device_id TEXT NOT NULL,\n"
+        "    bucket INTEGER NOT NULL,\n"
+        "    samples INTEGER NOT NULL DEFAULT 0,\n"
+        "    last_time INTEGER,\n    "
+        + ",\n    ".join(cols)
+        + ",\n    PRIMARY KEY (device_id, bucket)\n"
+        ") WITHOUT ROWID"
+    )
+
+
+def create_tables(conn):
+    for resolution in RESOLUTIONS:
+        conn.execute(_ddl(resolution))
+
+
+def _upsert_sql(resolution):
+    table = table_for(resolution)
+    columns = ["device_id", "bucket", "samples", "last_time"]
+    updates = [
+        "samples = samples + excluded.samples",
+        "last_time = max(last_time, excluded.last_time)",
+    ]
+    for m in METRICS:
+        columns += [f"{m}_min", f"{m}_max", f"{m}_sum", f"{m}_count", f"{m}_last"]
+        updates += [
+            f"{m}_min = coalesce(min({m}_min, excluded.{m}_min), {m}_min, excluded.{m}_min)",
+            f"{m}_max = coalesce(max({m}_max, excluded.{m}_max), {m}_max, excluded.{m}_max)",
+            f"{m}_sum = {m}_sum + excluded.{m}_sum",
+            f"{m}_count = {m}_count + excluded.{m}_count",
+            # Late samples must not overwrite a newer "last" value
+            f"{m}_last = CASE WHEN excluded.last_time >= last_time "
+            f"THEN coalesce(excluded.{m}_last, {m}_last) "
+            f"ELSE coalesce({m}_last, excluded.{m}_last) END",
+        ]
+    placeholders = ", ".join("?" for _ in columns)
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders}) "
+        f"ON CONFLICT (device_id, bucket) DO UPDATE SET {', '.join(updates)}"
+    )
+
+
+UPSERT_SQL = {resolution: _upsert_sql(resolution) for resolution in RESOLUTIONS}
+
+
+def aggregate(rows, bucket_sec):
+    """
+    rows: (device_id, time, temperature, humidity, window, co2_ppm, tvoc_ppb)
+    Returns {(device_id, bucket): [samples, last_time, m0_min, m0_max, m0_sum, m0_count, m0_last, ...]}
+    """
+    out = {}
+    n = len(METRICS)
+    for row in rows:
+        device_id, t = row[0], int(row[1])
+        key = (device_id, t - t % bucket_sec)
+        agg = out.get(key)
+        if agg is None:
+            agg = [0, t] + [None, None, 0.0, 0, None] * n
+            out[key] = agg
+        agg[0] += 1
+        newest = t >= agg[1]
+        if newest:
+            agg[1] = t
+        for i in range(n):
+            v = row[2 + i]
+            if v is None:
+                continue
+            j = 2 + i * 5
+            if agg[j] is None or v < agg[j]:
+                agg[j] = v
+            if agg[j + 1] is None or v > agg[j + 1]:
+                agg[j + 1] = v
+            agg[j + 2] += v
+            agg[j + 3] += 1
+            if newest or agg[j + 4] is None:
+                agg[j + 4] = v
+    return out
+
+
+def apply_rows(conn, rows):
+    """Fold a batch of sensor_log rows into every rollup table (no commit)."""
+    for resolution, bucket_sec in RESOLUTIONS.items():
+        params = [
+            (device_id, bucket, *agg)
+            for (device_id, bucket), agg in aggregate(rows, bucket_sec).items()
+        ]
+        conn.executemany(UPSERT_SQL[resolution], params)
+
+
+def backfill(conn, since=None, until=None, chunk_sec=BACKFILL_CHUNK_SEC, verbose=False):
+    """
+    Recompute the rollups for [since, until) from sensor_log. Existing
+    buckets in the range are replaced, so it is safe to re-run. Works in
+    chunks aligned to whole hours, one transaction each, so a live writer is
+    only held off for one chunk at a time.
+    """
+    # Raw rows live in day partitions and, once compacted, in sensor_chunks
+    bounds = [(start, start + partitions.PARTITION_SEC - 1) for start, _ in partitions.list_partitions(conn)]
+    chunk_bounds = conn.execute(f"SELECT MIN(t_min), MAX(t_max) FROM {chunk_store.TABLE}").fetchone()
+    if chunk_bounds[0] is not None:
+        bounds.append(chunk_bounds)
+    if not bounds:
+        return 0
+    first = min(b[0] for b in bounds)
+    last = max(b[1] for b in bounds)
+    since = first if since is None else max(since, first)
+    until = last + 1 if until is None else until
+    hour = RESOLUTIONS["1h"]
+    start = since - since % hour
+    chunk_sec = max(hour, chunk_sec - chunk_sec % hour)
+
+    total = 0
+    while start < until:
+        end = start + chunk_sec
+        with conn:
+            n = rebuild_range(conn, start, end)
+        total += n
+        if verbose and n:
+            print(f"  {time.strftime('%Y-%m-%d %H:%M', time.localtime(start))}: {n} rows")
+        start = end
+    return total
+
+
+def rebuild_range(conn, start, end):
+    """
+    Replace the rollup buckets in [start, end) (whole hours) with ones
+    recomputed from the raw rows (no commit). Returns the raw rows read.
+    """
+    # Raw rows live in day partitions and, once compacted, in sensor_chunks
+    rows = conn.execute(
+        "SELECT device_id, time, temperature, humidity, window, co2_ppm, tvoc_ppb "
+        f"FROM {partitions.source(conn, start, end)} WHERE time >= ? AND time < ?",
+        (start, end)
+    ).fetchall()
+    rows += chunk_store.rows_between(conn, start, end)
+    for resolution in RESOLUTIONS:
+        conn.execute(
+            f"DELETE FROM {table_for(resolution)} WHERE bucket >= ? AND bucket < ?",
+            (start, end)
+        )
+    apply_rows(conn, rows)
+    return len(rows)
+
+
+def main():
+    import schema
+
+    parser = argparse.ArgumentParser(description="Rebuild 1m/1h rollups from sensor_log.")
+    parser.add_argument("db_file", nargs="?", default="sensor.db")
+    parser.add_argument("--since", type=int, default=None, help="Epoch seconds (inclusive)")
+    parser.add_argument("--until", type=int, default=None, help="Epoch seconds (exclusive)")
+    args = parser.parse_args()
+
+    schema.ensure_schema(args.db_file)
+    conn = sqlite3.connect(args.db_file, timeout=schema.BUSY_TIMEOUT_SEC)
+    try:
+        t0 = time.perf_counter()
+        n = backfill(conn, args.since, args.until, verbose=True)
+        print(f"Backfilled {n} rows in {time.perf_counter() - t0:.1f}s")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
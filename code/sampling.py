@@ -0,0 +1,120 @@
+"""
+Scheduling helpers for the RP1 acquisition loop.
+
+Clock maps time.monotonic() onto wall-clock time. Timestamps therefore have
+sub-second resolution and steady spacing. They do not jump when NTP slews
+the clock, although a step larger than REANCHOR_SEC (typical right after a
+Pi without an RTC boots) re-anchors once.
+
+Periodic runs fn() on its own thread at a fixed rate with drift-free
+deadlines (start + k * period, not "sleep(period) after the work"). If a
+call overruns, the missed deadlines are skipped and counted instead of
+being run back to back. The last result is kept in .latest as
+(monotonic, wall, value), replaced in one assignment so readers never lock.
+
+    clock = Clock()
+    si = Periodic("si7021", 2.0, read_si7021, clock)
+    si.start()
+    mono, wall, (t, rh) = si.latest
+"""
+import threading
+import time
+
+REANCHOR_SEC = 2.0
+
+
+class Clock:
+    def __init__(self):
+        self.reanchors = 0
+        self._anchor()
+
+    def _anchor(self):
+        self._mono0 = time.monotonic()
+        self._wall0 = time.time()
+
+    def now(self):
+        """(monotonic, wall) for the same instant."""
+        mono = time.monotonic()
+        wall = self._wall0 + (mono - self._mono0)
+        if abs(time.time() - wall) > REANCHOR_SEC:
+            self._anchor()
+            self.reanchors += 1
+            print(f"[CLOCK] wall clock stepped, re-anchored ({self.reanchors})")
+            return self.now()
+        return mono, wall
+
+    def wall(self, mono):
+        """Wall time for a monotonic reading taken earlier."""
+        return self._wall0 + (mono - self._mono0)
+
+
+def run_every(period, fn, stop, on_missed=None):
+    """
+    Call fn() every `period` seconds on drift-free deadlines until the
+    `stop` Event is set. Overruns skip the missed deadlines and report
+    how many were skipped to on_missed(n).
+    """
+    deadline = time.monotonic()
+    while not stop.is_set():
+        fn()
+        deadline += period
+        now = time.monotonic()
+        if now > deadline:
+            missed = int((now - deadline) // period) + 1
+            deadline += missed * period
+            if on_missed is not None:
+                on_missed(missed)
+        stop.wait(deadline - now)
+
+
+class Periodic:
+    def __init__(self, name, rate_hz, fn, clock):
+        self.name = name
+        self.period = 1.0 / rate_hz
+        self.fn = fn
+        self.clock = clock
+        self.latest = None
+        self.runs = 0
+        self.errors = 0
+        self.missed = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _tick(self):
+        try:
+            value = self.fn()
+        except Exception as e:
+            self.errors += 1
+            # First failure and then every 100th, so a dead sensor cannot flood the log
+            if self.errors % 100 == 1:
+                print(f"[{self.name}] read failed ({self.errors} so far): {e}")
+            return
+        self.runs += 1
+        if value is not None:
+            mono, wall = self.clock.now()
+            self.latest = (mono, wall, value)
+
+    def _count_missed(self, n):
+        self.missed += n
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=run_every, args=(self.period, self._tick, self._stop, self._count_missed),
+            name=self.name, daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def fresh(self, max_age):
+        """The latest value if it is at most max_age seconds old, else None."""
+        latest = self.latest
+        if latest is None or time.monotonic() - latest[0] > max_age:
+            return None
+        return latest[2]
+
+    def stats(self):
+        return {"runs": self.runs, "errors": self.errors, "missed": self.missed}
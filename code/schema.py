@@ -0,0 +1,212 @@
+"""
+Versioned schema for sensor.db, with in-place migrations.
+
+The original sensor_log table (see PC_logger.init_db) had no device column
+and no index, so every "WHERE time >= ?" / "ORDER BY time DESC LIMIT" was a
+full table scan. Migrations here bring any existing sensor.db up to date:
+
+  v1  legacy sensor_log (created if missing, tvoc_ppb added to old files)
+  v2  device_id column + (device_id, time) and (time) indexes
+  v3  1-minute / 1-hour rollup tables (see rollups.py; fill with its backfill)
+  v4  sensor_log split into per-day tables behind a sensor_log view
+      (see partitions.py; old days are dropped by retention.py)
+  v5  sensor_chunks table for compressed closed days (see chunk_store.py)
+  v6  unique (device_id, time) index per partition; rows stored twice by
+      QoS 1 resends are deleted and their rollup hours recomputed
+
+The applied versions are recorded in the schema_version table. New files
+are created with auto_vacuum=INCREMENTAL so dropped partitions can be given
+back to the OS a few pages at a time (older files: retention.py --convert).
+
+Online safety: the database runs in WAL mode, so readers are never blocked.
+Each migration runs in one BEGIN IMMEDIATE transaction, which only excludes
+other writers. v4 first copies the legacy table one day per transaction
+(PREPARE), so its own transaction only moves the rows written meanwhile.
+A concurrent writer waits on its busy timeout and then carries on with
+the new schema. Its INSERTs stay valid before and after:
+new columns all have defaults, and from v4 on, "INSERT INTO sensor_log"
+goes through an INSTEAD OF INSERT trigger on the view that routes the row
+to its day partition (see partitions.py).
+
+Usage:
+    python schema.py [sensor.db ...]          # migrate to latest
+    python schema.py --status [sensor.db ...] # show current version
+"""
+import argparse
+import sqlite3
+import time
+
+import chunk_store
+import partitions
+import rollups
+
+DEFAULT_DEVICE_ID = "iotbox01"
+BUSY_TIMEOUT_SEC = 60
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _v1_legacy(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sensor_log (
+        time INTEGER,
+        temperature REAL,
+        humidity REAL,
+        window REAL,
+        co2_ppm REAL,
+        tvoc_ppb REAL
+    )
+    """)
+    if "tvoc_ppb" not in _columns(conn, "sensor_log"):
+        conn.execute("ALTER TABLE sensor_log ADD COLUMN tvoc_ppb REAL")
+
+
+def _v2_device_index(conn):
+    if "device_id" not in _columns(conn, "sensor_log"):
+        # Existing rows all came from the single original box
+        conn.execute(
+            f"ALTER TABLE sensor_log ADD COLUMN device_id TEXT NOT NULL DEFAULT '{DEFAULT_DEVICE_ID}'"
+        )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sensor_log_device_time ON sensor_log (device_id, time)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sensor_log_time ON sensor_log (time)"
+    )
+
+
+def _v3_rollups(conn):
+    rollups.create_tables(conn)
+
+
+def _v4_copy_days(conn):
+    partitions.copy_legacy_days(conn)
+
+
+def _v4_partitions(conn):
+    partitions.split_legacy_table(conn)
+
+
+def _v5_chunks(conn):
+    chunk_store.create_tables(conn)
+
+
+def _v6_unique_samples(conn):
+    hour = rollups.RESOLUTIONS["1h"]
+    hours = set()
+    for _, name in partitions.list_partitions(conn) + [(None, partitions.UNROUTED)]:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone():
+            hours.update(t - t % hour for t in partitions.make_unique(conn, name))
+    for start in sorted(hours):
+        rollups.rebuild_range(conn, start, start + hour)
+
+
+MIGRATIONS = [
+    (1, "legacy sensor_log", _v1_legacy),
+    (2, "device_id column and (device_id, time) index", _v2_device_index),
+    (3, "1m / 1h rollup tables", _v3_rollups),
+    (4, "per-day sensor_log partitions", _v4_partitions),
+    (5, "compressed sensor_chunks", _v5_chunks),
+    (6, "unique (device_id, time) per partition", _v6_unique_samples),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Bulk copies run before a migration's own transaction, in short
+# transactions of their own, so a live writer is never held off for long
+PREPARE = {
+    4: _v4_copy_days,
+}
+
+
+def current_version(conn):
+    try:
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] or 0
+
+
+def migrate(conn, target=None, verbose=False):
+    """
+    Apply pending migrations up to target (default: latest).
+    Returns the list of versions applied. Safe to call on every startup.
+    """
+    target = SCHEMA_VERSION if target is None else target
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_SEC * 1000}")
+    # Only takes effect before the first table is created
+    if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    if conn.execute("PRAGMA journal_mode").fetchone()[0].lower() != "wal":
+        conn.execute("PRAGMA journal_mode=WAL")
+
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if version > target:
+            break
+        # Python's sqlite3 would otherwise open its own implicit transaction
+        old_isolation = conn.isolation_level
+        conn.isolation_level = None
+        try:
+            if version in PREPARE and current_version(conn) < version:
+                PREPARE[version](conn)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at INTEGER NOT NULL
+                )
+                """)
+                # Re-check under the write lock: another process may have won
+                if current_version(conn) >= version:
+                    conn.execute("COMMIT")
+                    continue
+                t0 = time.perf_counter()
+                step(conn)
+                conn.execute(
+                    "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                    (version, description, int(time.time()))
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.isolation_level = old_isolation
+
+        applied.append(version)
+        if verbose:
+            print(f"Applied v{version} ({description}) in {time.perf_counter() - t0:.2f}s")
+    return applied
+
+
+def ensure_schema(db_file, verbose=False):
+    conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT_SEC)
+    try:
+        return migrate(conn, verbose=verbose)
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upgrade sensor.db files to the latest schema.")
+    parser.add_argument("db_files", nargs="*", default=["sensor.db"])
+    parser.add_argument("--status", action="store_true", help="Only print the current version")
+    args = parser.parse_args()
+
+    for db_file in args.db_files:
+        if args.status:
+            conn = sqlite3.connect(db_file)
+            print(f"{db_file}: v{current_version(conn)} (latest v{SCHEMA_VERSION})")
+            conn.close()
+            continue
+        applied = ensure_schema(db_file, verbose=True)
+        print(f"{db_file}: " + (f"migrated {applied}" if applied else "already up to date"))
+
+
+if __name__ == "__main__":
+    main()
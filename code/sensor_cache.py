@@ -0,0 +1,198 @@
+"""
+In-memory rolling store of recent sensor samples, kept per device.
+
+PC_server used to re-query sensor_log for every incoming message (last 10
+window / CO2 / TVOC values plus a 30 minute range scan for the adaptive
+thresholds). This module keeps the same data in memory instead:
+
+- a fixed-size ring buffer per metric for the moving averages,
+- a ThresholdEngine holding the 30 minute window for the adaptive
+  thresholds (see threshold_engine.py).
+
+Buffers are fed straight from MQTT samples and can be warmed from sensor.db
+once at startup, so the hot path never touches the disk.
+
+Boxes that publish with a deadband (RP1_sensor.py) stay quiet while nothing
+changes, so the gap between two in-order samples means "values held". Gaps of
+up to HOLD_MAX_SEC are filled with the previous values at the node's
+HOLD_FILL_SEC sample period, so the moving averages and the threshold window
+see what a full 1 Hz stream would have shown. Longer gaps are an outage and
+stay empty.
+"""
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import partitions
+from threshold_engine import ThresholdEngine
+
+METRICS = ("temperature", "humidity", "window", "co2_ppm", "tvoc_ppb")
+
+RECENT_LIMIT = 10
+HISTORY_MINUTES = 30
+# Node sample period, and the longest silence still read as "unchanged"
+# (a bit over RP1_sensor.HEARTBEAT_SEC)
+HOLD_FILL_SEC = 1
+HOLD_MAX_SEC = 90
+
+
+class DeviceBuffer:
+    """Ring buffers for one device. Guarded by its own lock."""
+
+    def __init__(self, recent_limit=RECENT_LIMIT, history_minutes=HISTORY_MINUTES, hold_max_sec=HOLD_MAX_SEC):
+        self.lock = threading.Lock()
+        self.recent = {m: deque(maxlen=recent_limit) for m in METRICS}
+        self.engine = ThresholdEngine(window_minutes=history_minutes)
+        self.hold_max_sec = hold_max_sec
+        self.latest_time = None
+        self.latest_values = None
+        self.last_seen = {}  # metric -> time of its newest non-missing value
+
+    def append(self, t, values):
+        """
+        Returns False for a sample older than the newest one seen (e.g. a
+        store-and-forward backlog): it still enters the event-time threshold
+        window, but not the "last N readings" ring buffers.
+        """
+        with self.lock:
+            in_order = self.latest_time is None or t >= self.latest_time
+            if in_order:
+                if self.latest_time is not None and HOLD_FILL_SEC < t - self.latest_time <= self.hold_max_sec:
+                    self._fill_held(t)
+                self.latest_time = t
+                self.latest_values = values
+                for m in METRICS:
+                    v = values.get(m)
+                    self.recent[m].append(v)
+                    if v is not None:
+                        self.last_seen[m] = t
+            self.engine.add(t, values)
+        return in_order
+
+    def _fill_held(self, t):
+        """Repeat the previous values at HOLD_FILL_SEC steps up to (not incl.) t."""
+        held = self.latest_values
+        times = range(self.latest_time + HOLD_FILL_SEC, t, HOLD_FILL_SEC)
+        # Only the last maxlen copies can survive in the ring buffers
+        for m in METRICS:
+            recent = self.recent[m]
+            recent.extend([held.get(m)] * min(len(times), recent.maxlen))
+        since = t - self.engine.window_sec
+        for ts in times:
+            if ts >= since:
+                self.engine.add(ts, held)
+
+    def recent_values(self, metric, limit=None):
+        with self.lock:
+            values = [v for v in self.recent[metric] if v is not None]
+        if limit is not None:
+            values = values[-limit:]
+        return values
+
+    def last_seen_time(self, metric):
+        """Time of the newest in-order sample where metric was present, or None."""
+        with self.lock:
+            return self.last_seen.get(metric)
+
+    def thresholds(self, now=None, defaults=None):
+        with self.lock:
+            return self.engine.thresholds(now if now is not None else time.time(), defaults)
+
+
+class SensorCache:
+    """Registry of DeviceBuffer objects keyed by device id."""
+
+    def __init__(self, recent_limit=RECENT_LIMIT, history_minutes=HISTORY_MINUTES, hold_max_sec=HOLD_MAX_SEC):
+        self.recent_limit = recent_limit
+        self.history_minutes = history_minutes
+        self.hold_max_sec = hold_max_sec
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def device(self, device_id):
+        buf = self._devices.get(device_id)
+        if buf is None:
+            with self._lock:
+                buf = self._devices.get(device_id)
+                if buf is None:
+                    buf = DeviceBuffer(self.recent_limit, self.history_minutes, self.hold_max_sec)
+                    self._devices[device_id] = buf
+        return buf
+
+    def devices(self):
+        return list(self._devices)
+
+    def append(self, device_id, t, values):
+        return self.device(device_id).append(t, values)
+
+    def recent_values(self, device_id, metric, limit=None):
+        return self.device(device_id).recent_values(metric, limit)
+
+    def last_seen_time(self, device_id, metric):
+        return self.device(device_id).last_seen_time(metric)
+
+    def thresholds(self, device_id, now=None, defaults=None):
+        return self.device(device_id).thresholds(now, defaults)
+
+    def _warm_since(self):
+        # Only the last day or so of partitions is read; older samples are
+        # stale for both the ring buffers and the threshold window
+        return int(time.time()) - self.history_minutes * 60 - partitions.PARTITION_SEC
+
+    def warm_all_from_db(self, db_file):
+        """Warm every device with recent rows in sensor_log. Returns {device_id: rows}."""
+        try:
+            conn = sqlite3.connect(db_file)
+            try:
+                src = partitions.source(conn, self._warm_since())
+                ids = [r[0] for r in conn.execute(f"SELECT DISTINCT device_id FROM {src}")]
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print("Cache warm-up skipped:", e)
+            return {}
+        return {device_id: self.warm_from_db(db_file, device_id) for device_id in ids}
+
+    def warm_from_db(self, db_file, device_id):
+        """
+        Pre-fill one device from sensor.db so the first moving averages and
+        thresholds after a restart match what the DB-backed code returned.
+        Returns the number of rows loaded.
+        """
+        since = int(time.time()) - self.history_minutes * 60
+        try:
+            conn = sqlite3.connect(db_file)
+        except sqlite3.Error as e:
+            print("Cache warm-up failed:", e)
+            return 0
+
+        try:
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    "SELECT time, temperature, humidity, window, co2_ppm, tvoc_ppb "
+                    f"FROM {partitions.source(conn, self._warm_since())} "
+                    "WHERE device_id = ? ORDER BY time DESC LIMIT ?",
+                    (device_id, self.recent_limit)
+                )
+                recent = cur.fetchall()
+                cur.execute(
+                    "SELECT time, temperature, humidity, window, co2_ppm, tvoc_ppb "
+                    f"FROM {partitions.source(conn, since)} WHERE device_id = ? AND time >= ? ORDER BY time",
+                    (device_id, since)
+                )
+                history = cur.fetchall()
+            except sqlite3.OperationalError as e:
+                print("Cache warm-up skipped:", e)
+                return 0
+        finally:
+            conn.close()
+
+        # Older rows that only feed the moving averages go in first, then the
+        # 30 minute window in time order (it also refills the ring buffers).
+        recent = [r for r in reversed(recent) if r[0] < since]
+        buf = self.device(device_id)
+        for row in recent + history:
+            buf.append(row[0], dict(zip(METRICS, row[1:])))
+        return len(recent) + len(history)
@@ -0,0 +1,182 @@
+"""
+Streaming adaptive thresholds (replacement for compute_thresholds(load_recent())).
+
+compute_thresholds() rebuilds NumPy arrays from 30 minutes of rows on every
+message. ThresholdEngine keeps the same window incrementally:
+
+- WindowedMetric holds one metric's samples in event-time order, a running
+  sum for the mean and a sorted copy of the values for quantiles.
+- Adding or expiring a sample costs O(log n) comparisons (bisect) plus a
+  list insert/delete, which is a memmove over at most one window (~1800
+  floats at 1 Hz), so there is no per-message rebuild.
+- Samples expire by their own timestamp, not by arrival time.
+
+Tolerance vs compute_thresholds(): quantiles use the same linear
+interpolation as np.percentile's default method and are exact up to float
+rounding (~1e-12). The mean comes from a running sum that is re-summed from
+scratch every RESYNC_EVERY updates, so drift stays below ~1e-9. Both values
+are rounded to 2 decimals like before, so T_cold / H_dry are identical except
+when the unrounded value sits within 1e-9 of a rounding boundary.
+"""
+import math
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+
+DEFAULT_THRESHOLDS = {
+    "T_cold": 18.0,
+    "H_dry": 30.0,
+    "W_open": 20
+}
+
+WINDOW_MINUTES = 30
+MIN_SAMPLES = 20
+T_COLD_OFFSET = 1.0
+H_DRY_PERCENTILE = 20
+RESYNC_EVERY = 10000
+
+
+def percentile_sorted(values, q):
+    """Linear-interpolated percentile of an already sorted list (np.percentile default)."""
+    n = len(values)
+    if n == 0:
+        return None
+    pos = (n - 1) * (q / 100.0)
+    lo = math.floor(pos)
+    hi = min(lo + 1, n - 1)
+    frac = pos - lo
+    a = values[lo]
+    b = values[hi]
+    # Same lerp form NumPy uses, so results agree to the last bit in practice
+    if frac >= 0.5:
+        return b - (b - a) * (1.0 - frac)
+    return a + (b - a) * frac
+
+
+class WindowedMetric:
+    """Sliding event-time window over a single metric."""
+
+    def __init__(self, window_sec, quantiles=()):
+        self.window_sec = window_sec
+        self.quantiles = tuple(quantiles)
+        self.samples = deque()  # (t, value), oldest first
+        self.sorted = []
+        self.total = 0.0
+        self._updates = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, t, value):
+        if value is None or value != value:
+            return
+        value = float(value)
+        samples = self.samples
+        if not samples or t >= samples[-1][0]:
+            samples.append((t, value))
+        else:
+            # Late sample: keep the deque in event-time order so expiry stays correct
+            idx = bisect_right([s[0] for s in samples], t)
+            samples.insert(idx, (t, value))
+        insort(self.sorted, value)
+        self.total += value
+        self._tick()
+
+    def expire(self, since):
+        samples = self.samples
+        while samples and samples[0][0] < since:
+            _, value = samples.popleft()
+            idx = bisect_left(self.sorted, value)
+            del self.sorted[idx]
+            self.total -= value
+            self._tick()
+
+    def _tick(self):
+        self._updates += 1
+        if self._updates >= RESYNC_EVERY:
+            self._updates = 0
+            self.total = math.fsum(self.sorted)
+
+    def mean(self):
+        n = len(self.sorted)
+        if n == 0:
+            return None
+        return self.total / n
+
+    def quantile(self, q):
+        return percentile_sorted(self.sorted, q)
+
+
+class ThresholdEngine:
+    """
+    Incremental equivalent of compute_thresholds() over the last
+    window_minutes of (temperature, humidity, window) samples.
+
+    extra_quantiles adds more percentiles to track, e.g. {"window": (70,)}
+    for the window-distance P70 the deprecated adaptive_threshold used.
+    """
+
+    def __init__(
+        self,
+        window_minutes=WINDOW_MINUTES,
+        min_samples=MIN_SAMPLES,
+        t_cold_offset=T_COLD_OFFSET,
+        h_dry_percentile=H_DRY_PERCENTILE,
+        extra_quantiles=None,
+    ):
+        self.window_sec = window_minutes * 60
+        self.min_samples = min_samples
+        self.t_cold_offset = t_cold_offset
+        self.h_dry_percentile = h_dry_percentile
+
+        quantiles = {"temperature": (), "humidity": (h_dry_percentile,), "window": ()}
+        for name, qs in (extra_quantiles or {}).items():
+            quantiles[name] = tuple(quantiles.get(name, ())) + tuple(qs)
+        self.metrics = {
+            name: WindowedMetric(self.window_sec, qs) for name, qs in quantiles.items()
+        }
+        self.last_time = None
+
+    def add(self, t, values):
+        """
+        values: dict of metric -> float. Like sensor_log, a sample only counts
+        when temperature, humidity and window are all present.
+        """
+        if any(values.get(m) is None for m in ("temperature", "humidity", "window")):
+            return
+        if self.last_time is not None and t < self.last_time - self.window_sec:
+            # Backlog older than the window would be expired straight away
+            return
+        for name, metric in self.metrics.items():
+            metric.add(t, values.get(name))
+        if self.last_time is None or t > self.last_time:
+            self.last_time = t
+        self.expire(self.last_time - self.window_sec)
+
+    def expire(self, since):
+        for metric in self.metrics.values():
+            metric.expire(since)
+
+    def count(self):
+        return len(self.metrics["temperature"])
+
+    def mean(self, name):
+        return self.metrics[name].mean()
+
+    def quantile(self, name, q):
+        return self.metrics[name].quantile(q)
+
+    def thresholds(self, now=None, defaults=None):
+        """
+        Same result as compute_thresholds(load_recent(window_minutes)).
+        now: wall-clock seconds; rows older than int(now) - window are dropped
+        first, matching load_recent's "time >= since" filter.
+        """
+        base = dict(defaults or DEFAULT_THRESHOLDS)
+        if now is not None:
+            self.expire(int(now) - self.window_sec)
+        if self.count() < self.min_samples:
+            return base
+
+        base["T_cold"] = round(self.mean("temperature") - self.t_cold_offset, 2)
+        base["H_dry"] = round(float(self.quantile("humidity", self.h_dry_percentile)), 2)
+        return base
@@ -0,0 +1,307 @@
+"""
+Parallel parameter sweep over backtest.py.
+
+Loads one device's history once into a shared-memory block, fans parameter
+sets out over a process pool (every worker maps the same block, nothing is
+copied or pickled per task) and writes a ranked CSV:
+
+    python tune.py sensor.db --device iotbox01                 # default grid
+    python tune.py sensor.db --grid window_open_threshold=15,20,25 --grid temp_off_hysteresis=1,2,3
+    python tune.py sensor.db --random 500 --grid co2_alert_threshold=500:1200 --seed 1
+    python tune.py sensor.db --set auto_off_mode=Smart --workers 8 --out tune_results.csv
+
+--grid takes a comma list (grid search) or lo:hi (uniform range, random
+search only). --set fixes other backtest parameters for every run.
+
+Score (lower is better), all in minutes except alerts:
+
+    energy_weight * (heater ON while the window is open
+                     + heater ON while temp >= comfort_high)
+  + comfort_weight * (heater not ON, window shut, temp < comfort_low)
+  + air_weight * (trimmed CO2 / TVOC above air limits with no alert of that
+                  type within its cooldown)
+  + alert_weight * alerts sent
+
+The replay is open loop: recorded temperatures do not react to the heater
+the candidate settings would have switched, so the score compares how each
+setting would have acted on the same room history.
+
+Each worker keeps a small cache of the parameter-independent parts (trimmed
+means, the threshold window per T_cold offset / H_dry percentile); the grid
+is ordered so neighbouring tasks share them.
+"""
+import argparse
+import csv
+import itertools
+import os
+import random
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import backtest
+import schema
+
+# The PC_server knobs this sweep is for
+DEFAULT_GRID = {
+    "window_open_threshold": [15, 20, 25, 30],
+    "temp_off_hysteresis": [1.0, 2.0, 3.0],
+    "co2_alert_threshold": [500, 800, 1000],
+    "tvoc_alert_threshold": [600, 1000],
+    "t_cold_offset": [0.5, 1.0, 1.5],
+    "h_dry_percentile": [10, 20, 30],
+}
+
+# Parameters whose results the workers cache; they go outermost in the grid
+SLOW_KEYS = ("threshold_window_minutes", "min_samples", "t_cold_offset", "h_dry_percentile", "recent_limit")
+
+DEFAULT_BASE = {
+    "auto_off_mode": "Smart",
+    "auto_on_mode": "Smart",
+    "open_window_health_alert": "ON",
+}
+
+WEIGHTS = {
+    "energy": 1.0,
+    "comfort": 2.0,
+    "air": 1.0,
+    "alert": 5.0,
+}
+COMFORT_LOW = 18.0
+COMFORT_HIGH = 23.0
+CO2_LIMIT = 1000.0
+TVOC_LIMIT = 1000.0
+
+CACHE_ENTRIES = 8
+
+_COLUMNS = ("time",) + backtest.METRICS
+
+# Worker state, set by _attach()
+_shm = None
+_samples = None
+_cache = {}
+_scoring = None
+
+
+# ----------------------
+# Shared memory
+# ----------------------
+def share(samples):
+    """Copy samples into one float64 shared-memory block. Returns (shm, shape)."""
+    n = len(samples["time"])
+    shape = (len(_COLUMNS), n)
+    shm = shared_memory.SharedMemory(create=True, size=max(8 * shape[0] * shape[1], 1))
+    block = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    for i, name in enumerate(_COLUMNS):
+        block[i] = samples[name]
+    return shm, shape
+
+
+def _attach(name, shape, scoring):
+    global _shm, _samples, _scoring
+    _shm = shared_memory.SharedMemory(name=name)
+    block = np.ndarray(shape, dtype=np.float64, buffer=_shm.buf)
+    # Metric rows are used in place; time goes back to int64 once per worker
+    _samples = {m: block[i] for i, m in enumerate(_COLUMNS)}
+    _samples["time"] = block[0].astype(np.int64)
+    _scoring = scoring
+
+
+# ----------------------
+# Scoring
+# ----------------------
+def _unalerted(t, bad, fired_idx, cooldown):
+    """Samples where bad holds and no alert fired in the last cooldown seconds."""
+    fired_times = np.concatenate([[-np.inf], t[fired_idx].astype(float)])
+    last = fired_times[np.searchsorted(fired_idx, np.arange(len(t)), side="right")]
+    return bad & ((t - last) >= cooldown)
+
+
+def score(samples, r, scoring):
+    """Score components for one replay() result."""
+    p = r["params"]
+    t = samples["time"]
+    temp = samples["temperature"]
+    dt = backtest._durations(t, float(p["max_gap_sec"])) / 60.0
+    on = r["after"] == backtest.SET_ON
+    open_ = r["window_is_open"]
+    with np.errstate(invalid="ignore"):
+        waste = on & (open_ | (temp >= scoring["comfort_high"]))
+        cold = ~on & ~open_ & (temp < scoring["comfort_low"])
+        bad_air = (
+            _unalerted(t, r["avg_co2"] > scoring["co2_limit"], r["fired"]["co2"], p["co2_alert_cooldown_sec"])
+            | _unalerted(t, r["avg_tvoc"] > scoring["tvoc_limit"], r["fired"]["tvoc"],
+                         p["tvoc_alert_cooldown_sec"])
+        )
+    out = {
+        "energy_waste_min": round(float(dt[waste].sum()), 2),
+        "cold_min": round(float(dt[cold].sum()), 2),
+        "bad_air_unalerted_min": round(float(dt[bad_air].sum()), 2),
+        "alerts": int(sum(r["alerts"].values())),
+        "heater_on_min": round(float(dt[on].sum()), 2),
+        "commands": int(np.count_nonzero(r["after"] != r["before"])),
+    }
+    w = scoring["weights"]
+    out["score"] = round(
+        w["energy"] * out["energy_waste_min"] + w["comfort"] * out["cold_min"]
+        + w["air"] * out["bad_air_unalerted_min"] + w["alert"] * out["alerts"], 3
+    )
+    return out
+
+
+def _evaluate(params):
+    if len(_cache) > CACHE_ENTRIES:
+        _cache.clear()
+    r = backtest.replay(_samples, params, _cache)
+    return params, score(_samples, r, _scoring)
+
+
+# ----------------------
+# Search space
+# ----------------------
+def _parse_values(text):
+    if ":" in text:
+        lo, hi = (backtest._parse_value(x) for x in text.split(":", 1))
+        return (lo, hi)
+    return [backtest._parse_value(x) for x in text.split(",")]
+
+
+def parse_grid(pairs):
+    grid = {}
+    for pair in pairs:
+        key, sep, values = pair.partition("=")
+        if not sep or key not in backtest.DEFAULT_PARAMS:
+            raise SystemExit(f"unknown parameter {key!r}; one of: {', '.join(backtest.DEFAULT_PARAMS)}")
+        grid[key] = _parse_values(values)
+    return grid
+
+
+def _ordered_keys(grid):
+    # Cached (slow) parameters outermost so consecutive tasks share a cache entry
+    return sorted(grid, key=lambda k: (k not in SLOW_KEYS, list(grid).index(k)))
+
+
+def grid_combinations(grid, base):
+    keys = _ordered_keys(grid)
+    for key in keys:
+        if isinstance(grid[key], tuple):
+            raise SystemExit(f"{key}: lo:hi ranges need --random")
+    for values in itertools.product(*(grid[k] for k in keys)):
+        yield {**base, **dict(zip(keys, values))}
+
+
+def random_combinations(grid, base, count, seed=None):
+    rng = random.Random(seed)
+    keys = _ordered_keys(grid)
+    out = []
+    for _ in range(count):
+        params = dict(base)
+        for key in keys:
+            values = grid[key]
+            if isinstance(values, tuple):
+                lo, hi = values
+                params[key] = rng.randint(lo, hi) if isinstance(lo, int) and isinstance(hi, int) \
+                    else round(rng.uniform(lo, hi), 3)
+            else:
+                params[key] = rng.choice(values)
+        out.append(params)
+    # Group by the cached parameters, same reason as the grid order
+    out.sort(key=lambda prm: tuple(str(prm.get(k)) for k in SLOW_KEYS))
+    return out
+
+
+def sweep(samples, combos, scoring, workers=None, chunksize=None):
+    """Run every parameter set; returns [(params, score_dict)] sorted best first."""
+    combos = list(combos)
+    workers = workers or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, len(combos) // (workers * 4))
+    shm, shape = share(samples)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach,
+                                 initargs=(shm.name, shape, scoring)) as pool:
+            results = list(pool.map(_evaluate, combos, chunksize=chunksize))
+    finally:
+        shm.close()
+        shm.unlink()
+    results.sort(key=lambda item: item[1]["score"])
+    return results
+
+
+def write_csv(path, results, keys):
+    metrics = ["score", "energy_waste_min", "cold_min", "bad_air_unalerted_min", "alerts",
+               "heater_on_min", "commands"]
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["rank"] + list(keys) + metrics)
+        for rank, (params, result) in enumerate(results, 1):
+            writer.writerow([rank] + [params.get(k) for k in keys] + [result[m] for m in metrics])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep backtest parameters in parallel and rank them.")
+    parser.add_argument("db_file", nargs="?", default="sensor.db")
+    parser.add_argument("--device", default=schema.DEFAULT_DEVICE_ID)
+    parser.add_argument("--from", dest="t_from", type=int, default=None, help="Epoch seconds")
+    parser.add_argument("--to", dest="t_to", type=int, default=None, help="Epoch seconds")
+    parser.add_argument("--grid", action="append", default=[], metavar="KEY=V1,V2|LO:HI",
+                        help="Search values for a parameter (repeatable; default: " + ", ".join(DEFAULT_GRID) + ")")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Fix a backtest parameter for every run (repeatable)")
+    parser.add_argument("--random", type=int, default=None, metavar="N", help="Random search with N samples")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None, help="Processes (default: all cores)")
+    parser.add_argument("--out", default="tune_results.csv")
+    parser.add_argument("--top", type=int, default=10, help="Rows to print")
+    parser.add_argument("--comfort-low", type=float, default=COMFORT_LOW)
+    parser.add_argument("--comfort-high", type=float, default=COMFORT_HIGH)
+    parser.add_argument("--co2-limit", type=float, default=CO2_LIMIT)
+    parser.add_argument("--tvoc-limit", type=float, default=TVOC_LIMIT)
+    for name, value in WEIGHTS.items():
+        parser.add_argument(f"--{name}-weight", type=float, default=value)
+    args = parser.parse_args()
+
+    grid = parse_grid(args.grid) if args.grid else dict(DEFAULT_GRID)
+    base = {**DEFAULT_BASE, **backtest.parse_params(args.set)}
+    scoring = {
+        "comfort_low": args.comfort_low,
+        "comfort_high": args.comfort_high,
+        "co2_limit": args.co2_limit,
+        "tvoc_limit": args.tvoc_limit,
+        "weights": {name: getattr(args, f"{name}_weight") for name in WEIGHTS},
+    }
+
+    conn = sqlite3.connect(f"file:{args.db_file}?mode=ro", uri=True)
+    try:
+        samples = backtest.load_samples(conn, args.device, args.t_from, args.t_to)
+    finally:
+        conn.close()
+    if not len(samples["time"]):
+        raise SystemExit(f"no samples for {args.device}")
+
+    if args.random:
+        combos = random_combinations(grid, base, args.random, args.seed)
+    else:
+        combos = list(grid_combinations(grid, base))
+    workers = args.workers or os.cpu_count() or 1
+    print(f"{len(samples['time'])} samples, {len(combos)} parameter set(s), {workers} worker(s)")
+
+    t0 = time.perf_counter()
+    results = sweep(samples, combos, scoring, workers)
+    elapsed = time.perf_counter() - t0
+
+    keys = _ordered_keys(grid)
+    write_csv(args.out, results, keys)
+    print(f"Done in {elapsed:.1f}s ({len(combos) / max(elapsed, 1e-9):.1f} sets/s) -> {args.out}")
+    for rank, (params, result) in enumerate(results[:args.top], 1):
+        chosen = ", ".join(f"{k}={params[k]}" for k in keys)
+        print(f"  {rank:3d}. score {result['score']:.1f}  {chosen}  "
+              f"(waste {result['energy_waste_min']} min, cold {result['cold_min']} min, "
+              f"air {result['bad_air_unalerted_min']} min, {result['alerts']} alerts)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+HC-SR04 ranging from kernel GPIO edge events, with burst filtering.
+
+The echo line is requested for both-edge events, so the kernel timestamps
+the rising and falling edge of the echo pulse and the reading thread blocks
+in event_wait() instead of spinning on get_value(). The pulse width comes
+from those kernel timestamps, which removes Python scheduling jitter from
+the measurement.
+
+measure() fires a burst of BURST_PINGS pings and returns a Reading:
+
+- pings that time out or fall outside the sensor's range are discarded;
+- the remaining distances are filtered with median / MAD, so anything
+  further than OUTLIER_MAD_K robust deviations (at least MIN_OUTLIER_CM)
+  from the median is rejected;
+- distance_cm is the median of the inliers, and quality is the fraction
+  of the burst that agreed (0.0 = no usable echo, distance_cm None).
+
+The speed of sound is corrected for air temperature when one is given.
+
+    ranger = HCSR04()
+    reading = ranger.measure(temperature_c=21.5)
+"""
+import time
+from dataclasses import dataclass
+from statistics import median
+
+try:
+    import gpiod
+except ImportError:
+    gpiod = None  # robust_distance() still works, e.g. off the Pi
+
+CHIP = "gpiochip0"
+TRIG = 23  # BCM numbering
+ECHO = 24
+
+BURST_PINGS = 5
+# Datasheet: at least 60 ms between pings so late echoes do not overlap
+PING_GAP_SEC = 0.06
+# 500 cm round trip is ~29 ms; the echo starts ~0.5 ms after the trigger
+ECHO_TIMEOUT_SEC = 0.03
+MIN_RANGE_CM = 2.0
+MAX_RANGE_CM = 400.0
+OUTLIER_MAD_K = 3.0
+MIN_OUTLIER_CM = 1.0
+MAD_TO_SIGMA = 1.4826
+
+
+@dataclass
+class Reading:
+    distance_cm: float | None
+    quality: float
+    pings: int
+    inliers: int
+    spread_cm: float | None = None
+
+
+def speed_of_sound_cm_s(temperature_c=None):
+    if temperature_c is None:
+        return 34300.0
+    return (331.3 + 0.606 * temperature_c) * 100.0
+
+
+def robust_distance(distances, pings):
+    """Median of the distances within OUTLIER_MAD_K robust deviations of the median."""
+    if not distances:
+        return Reading(None, 0.0, pings, 0)
+    med = median(distances)
+    spread = MAD_TO_SIGMA * median(abs(d - med) for d in distances)
+    limit = max(OUTLIER_MAD_K * spread, MIN_OUTLIER_CM)
+    inliers = [d for d in distances if abs(d - med) <= limit]
+    return Reading(
+        distance_cm=round(median(inliers), 3),
+        quality=round(len(inliers) / pings, 3),
+        pings=pings,
+        inliers=len(inliers),
+        spread_cm=round(spread, 3),
+    )
+
+
+def _event_time(event):
+    return event.sec + event.nsec * 1e-9
+
+
+class HCSR04:
+    def __init__(self, chip=CHIP, trig=TRIG, echo=ECHO):
+        if gpiod is None:
+            raise RuntimeError("HCSR04 needs the gpiod bindings")
+        self.chip = gpiod.Chip(chip)
+        self.trig = self.chip.get_line(trig)
+        self.echo = self.chip.get_line(echo)
+        self.trig.request(consumer="hcsr04_trig", type=gpiod.LINE_REQ_DIR_OUT)
+        self.echo.request(consumer="hcsr04_echo", type=gpiod.LINE_REQ_EV_BOTH_EDGES)
+        self.timeouts = 0
+
+    def _drain(self):
+        # Edges from an earlier, timed-out ping must not pair with this one
+        while self.echo.event_wait(sec=0, nsec=0):
+            self.echo.event_read()
+
+    def _wait_edge(self, edge_type, deadline):
+        """Kernel timestamp of the next edge of edge_type, or None at the deadline."""
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if not self.echo.event_wait(sec=int(remaining), nsec=int((remaining % 1.0) * 1e9)):
+                return None
+            event = self.echo.event_read()
+            if event.type == edge_type:
+                return _event_time(event)
+
+    def ping(self, temperature_c=None, timeout=ECHO_TIMEOUT_SEC):
+        """One distance in cm, or None when no complete echo arrived in time."""
+        self._drain()
+        self.trig.set_value(1)
+        time.sleep(0.00001)
+        self.trig.set_value(0)
+
+        deadline = time.monotonic() + timeout
+        rise = self._wait_edge(gpiod.LineEvent.RISING_EDGE, deadline)
+        fall = self._wait_edge(gpiod.LineEvent.FALLING_EDGE, deadline) if rise is not None else None
+        if fall is None:
+            self.timeouts += 1
+            return None
+        return (fall - rise) * speed_of_sound_cm_s(temperature_c) / 2
+
+    def measure(self, pings=BURST_PINGS, temperature_c=None):
+        distances = []
+        for i in range(pings):
+            t0 = time.monotonic()
+            d = self.ping(temperature_c)
+            if d is not None and MIN_RANGE_CM <= d <= MAX_RANGE_CM:
+                distances.append(d)
+            if i < pings - 1:
+                wait = t0 + PING_GAP_SEC - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+        return robust_distance(distances, pings)
+
+    def close(self):
+        self.trig.release()
+        self.echo.release()
+        self.chip.close()
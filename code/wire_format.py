@@ -0,0 +1,149 @@
+"""
+Compact binary payload for cx/<device>/sensors, one or many samples per message.
+
+The JSON RP1_sensor.py has always sent is ~130 bytes per sample and costs a
+json.loads on every consumer. This format is 8 bytes of header plus 19 bytes
+per sample, decoded with one struct.iter_unpack per message:
+
+    header  <BBHI   magic 0xC5, version, sample count, base timestamp (epoch s)
+    sample  <IBBhHIHHB
+            dt              milliseconds after the base (earliest) timestamp
+            present         bit i set = field i below is present (else None)
+            held            bit i set = field i unchanged since the last sample
+                            the device sent (deadband); its value bytes are 0
+            temperature     0.01 degC, signed
+            humidity        0.01 %RH
+            window          0.001 cm (distance)
+            co2_ppm         ppm
+            tvoc_ppb        ppb
+            window_quality  percent of the ultrasonic burst that agreed
+
+In payload dicts (and JSON) a held field is a missing key, while a present
+key with None is a missing reading; decode() returns HELD for held fields.
+
+There is one version; anything else is rejected, and a layout change
+bumps VERSION (which also invalidates RP1's on-disk backlog, see
+backlog.MAGIC). Quantisation is at or below sensor resolution (Si7021 ~0.01,
+HC-SR04 ~0.3 cm, CCS811 integer). Out-of-range values are sent as missing
+rather than wrapped.
+
+The magic byte can never start a JSON document, so consumers tell the two
+apart from the first byte (is_binary) and JSON keeps working unchanged.
+"""
+import math
+import struct
+
+MAGIC = 0xC5
+VERSION = 1
+MAX_BATCH = 0xFFFF
+# Longest span of timestamps one message can carry, in seconds
+MAX_DT = 0xFFFFFFFF // 1000 - 1
+
+HEADER = struct.Struct("<BBHI")
+SAMPLE = struct.Struct("<IBBhHIHHB")
+
+# (payload key, scale, min, max of the stored integer)
+FIELDS = (
+    ("temperature", 100.0, -0x8000, 0x7FFF),
+    ("humidity", 100.0, 0, 0xFFFF),
+    ("window", 1000.0, 0, 0xFFFFFFFF),
+    ("co2_ppm", 1.0, 0, 0xFFFF),
+    ("tvoc_ppb", 1.0, 0, 0xFFFF),
+    ("window_quality", 100.0, 0, 100),
+)
+KEYS = tuple(f[0] for f in FIELDS)
+SCALES = tuple(f[1] for f in FIELDS)
+
+
+class _Held:
+    __slots__ = ()
+
+    def __repr__(self):
+        return "HELD"
+
+
+HELD = _Held()
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+def is_binary(payload) -> bool:
+    return bool(payload) and payload[0] == MAGIC
+
+
+def _quantise(value, scale, lo, hi):
+    if value is None:
+        return None
+    try:
+        q = round(float(value) * scale)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return q if lo <= q <= hi else None
+
+
+def encode(samples) -> bytes:
+    """
+    Pack payload dicts ({"timestamp": ..., "temperature": ..., ...}, the keys
+    RP1_sensor.py sends) into one message, in the given order. Timestamps
+    may be out of order but must span at most MAX_DT seconds.
+    """
+    if not samples:
+        raise WireFormatError("empty batch")
+    if len(samples) > MAX_BATCH:
+        raise WireFormatError(f"batch larger than {MAX_BATCH}")
+    base = math.floor(min(s["timestamp"] for s in samples))
+    out = bytearray(HEADER.pack(MAGIC, VERSION, len(samples), base))
+    for s in samples:
+        dt = round((s["timestamp"] - base) * 1000)
+        if not 0 <= dt <= 0xFFFFFFFF:
+            raise WireFormatError(f"timestamp {s['timestamp']} outside batch window")
+        present = held = 0
+        ints = []
+        for i, (key, scale, lo, hi) in enumerate(FIELDS):
+            if key not in s:
+                held |= 1 << i
+                ints.append(0)
+                continue
+            q = _quantise(s[key], scale, lo, hi)
+            if q is None:
+                ints.append(0)
+            else:
+                present |= 1 << i
+                ints.append(q)
+        out += SAMPLE.pack(dt, present, held, *ints)
+    return bytes(out)
+
+
+def decode(payload) -> list[tuple[int, tuple]]:
+    """
+    [(timestamp, (temperature, humidity, window, co2_ppm, tvoc_ppb, window_quality))] with
+    None for missing and HELD for held fields; timestamps are float seconds. Raises
+    WireFormatError on anything malformed.
+    """
+    if len(payload) < HEADER.size:
+        raise WireFormatError("short header")
+    magic, version, count, base = HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise WireFormatError("not a binary sensor payload")
+    if version != VERSION:
+        raise WireFormatError(f"unsupported version {version}")
+    body = memoryview(payload)[HEADER.size:]
+    if len(body) != count * SAMPLE.size:
+        raise WireFormatError(f"expected {count} samples, got {len(body)} bytes")
+
+    out = []
+    for dt, present, held, t, h, w, c, v, q in SAMPLE.iter_unpack(body):
+        if not held and present & 0x1F == 0x1F:
+            # Common case: every reading present
+            values = (t / 100.0, h / 100.0, w / 1000.0, float(c), float(v),
+                      q / 100.0 if present & 32 else None)
+        else:
+            ints = (t, h, w, c, v, q)
+            values = tuple(
+                HELD if held >> i & 1 else (ints[i] / SCALES[i] if present >> i & 1 else None)
+                for i in range(len(FIELDS))
+            )
+        out.append((base + dt / 1000.0, values))
+    return out
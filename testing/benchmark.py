@@ -0,0 +1,307 @@
+"""
+Micro-benchmarks for the PC_server hot path.
+
+Builds a temporary sensor.db with --rows samples (ending now, 1 Hz), swaps
+PC_server's MQTT client for a fake one that only records publishes, and
+times each function call by call:
+
+    trimmed_mean, compute_thresholds, load_recent+compute_thresholds,
+    heater_decision_local, _parse_json_or_text, decode_samples (JSON /
+    binary / binary batch of 60), publish_heater, on_message (heater topic),
+    on_message (sensor topic, Automatic / Smart, JSON and binary payloads)
+
+on_message runs end to end and synchronously (decode, validate, cache,
+decision, publish); --dispatch keeps the worker pool so only the network
+thread's share is timed, --persist adds the BatchWriter on the temp DB.
+
+Results (p50 / p99 / mean in microseconds, calls per second) are written as
+JSON; --baseline compares against an earlier run and exits 1 when a
+benchmark's p50 got slower, or its throughput dropped, by more than
+--tolerance:
+
+    python testing/benchmark.py --rows 200000 --out bench.json
+    python testing/benchmark.py --baseline bench.json --out bench_new.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "code"))
+sys.path.insert(0, CODE_DIR)
+
+import ingest  # noqa: E402
+import partitions  # noqa: E402
+import schema  # noqa: E402
+import wire_format  # noqa: E402
+
+DEVICE_ID = "iotbox01"
+ROWS = 100_000
+ITERATIONS = 5000
+WARMUP = 200
+TOLERANCE = 0.10
+
+
+class FakeMQTTClient:
+    """Stands in for paho's Client: records publishes, no network."""
+
+    def __init__(self):
+        self.published = 0
+        self.last = None
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+        self.last = (topic, payload)
+
+    def subscribe(self, *args, **kwargs):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload if isinstance(payload, bytes) else payload.encode()
+
+
+def fake_sample(rng, t):
+    return {
+        "timestamp": t,
+        "temperature": round(rng.uniform(16.0, 24.0), 2),
+        "humidity": round(rng.uniform(30.0, 60.0), 2),
+        "window": round(rng.choice((rng.uniform(2.0, 15.0), rng.uniform(25.0, 60.0))), 3),
+        "co2_ppm": round(rng.uniform(400.0, 900.0), 1),
+        "tvoc_ppb": round(rng.uniform(50.0, 700.0), 1),
+    }
+
+
+def build_db(db_file, rows, device_id=DEVICE_ID, seed=0):
+    """Fill a fresh sensor.db with `rows` 1 Hz samples ending now."""
+    schema.ensure_schema(db_file)
+    rng = random.Random(seed)
+    end = int(time.time())
+    start = end - rows
+    conn = sqlite3.connect(db_file, timeout=schema.BUSY_TIMEOUT_SEC)
+    try:
+        batch = []
+        for t in range(start, end):
+            s = fake_sample(rng, t)
+            batch.append((device_id, t, s["temperature"], s["humidity"], s["window"],
+                          s["co2_ppm"], s["tvoc_ppb"]))
+            if len(batch) >= 10000:
+                partitions.insert_rows(conn, batch)
+                batch = []
+        if batch:
+            partitions.insert_rows(conn, batch)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(q / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[idx]
+
+
+def bench(fn, iterations, warmup=WARMUP):
+    """Time fn(i) per call. Returns the stats dict."""
+    for i in range(warmup):
+        fn(i)
+    timings = []
+    clock = time.perf_counter_ns
+    t_start = clock()
+    for i in range(iterations):
+        t0 = clock()
+        fn(i)
+        timings.append(clock() - t0)
+    total_ns = clock() - t_start
+    timings.sort()
+    return {
+        "n": iterations,
+        "p50_us": round(percentile(timings, 50) / 1000.0, 3),
+        "p99_us": round(percentile(timings, 99) / 1000.0, 3),
+        "mean_us": round(sum(timings) / len(timings) / 1000.0, 3),
+        "ops_per_sec": round(iterations / (total_ns / 1e9), 1),
+    }
+
+
+def setup_server(db_file, dispatch=False, persist=False):
+    """Import PC_server and point it at the temp DB and a fake MQTT client."""
+    import PC_server
+    from db_writer import BatchWriter
+    from ingest import IngestPipeline
+
+    PC_server.DB_FILE = db_file
+    PC_server.mqtt_client = FakeMQTTClient()
+    if not dispatch:
+        PC_server.dispatcher = None
+    else:
+        PC_server.dispatcher.start()
+    writer = None
+    if persist:
+        writer = BatchWriter(db_file)
+        writer.start()
+    PC_server.ingest_writer = writer
+    PC_server.ingest = IngestPipeline(writer=writer, decide=PC_server.handle_sample)
+    PC_server.sensor_cache.warm_all_from_db(db_file)
+    return PC_server
+
+
+def run_benchmarks(srv, db_file, iterations, only=None):
+    rng = random.Random(1)
+    results = {}
+    sensor_topic = f"cx/{DEVICE_ID}/sensors"
+    heater_topic = f"cx/{DEVICE_ID}/heater"
+    recent_rows = srv.load_recent(30, db_file=db_file)
+    window_values = [rng.uniform(2.0, 60.0) for _ in range(10)]
+    decisions = [
+        (rng.uniform(14.0, 26.0), rng.uniform(20.0, 70.0), rng.uniform(0.0, 60.0))
+        for _ in range(1024)
+    ]
+    thresholds = srv.compute_thresholds(recent_rows)
+    payload_text = json.dumps(fake_sample(rng, int(time.time())))
+    payload_batch = [fake_sample(rng, int(time.time()) + k) for k in range(60)]
+    payload_binary = wire_format.encode(payload_batch[:1])
+    payload_binary_batch = wire_format.encode(payload_batch)
+    t_next = [int(time.time())]
+
+    def sensor_message(i, encode):
+        t_next[0] += 1
+        return FakeMessage(sensor_topic, encode(fake_sample(rng, t_next[0])))
+
+    def on_message_sensor(encode):
+        # Payloads are built up front so only on_message is timed; timestamps
+        # keep increasing across the rotation
+        messages = [sensor_message(i, encode) for i in range(iterations + WARMUP)]
+        return lambda i: srv.on_message(srv.mqtt_client, None, messages[i % len(messages)])
+
+    cases = {
+        "trimmed_mean": lambda i: srv.trimmed_mean(window_values),
+        "compute_thresholds": lambda i: srv.compute_thresholds(recent_rows),
+        "load_recent+compute_thresholds": lambda i: srv.compute_thresholds(srv.load_recent(30, db_file=db_file)),
+        "heater_decision_local": lambda i: srv.heater_decision_local(
+            *decisions[i % len(decisions)], thresholds=thresholds, last_state="ON" if i & 1 else "OFF"),
+        "_parse_json_or_text": lambda i: srv._parse_json_or_text(payload_text),
+        "decode_samples[json]": lambda i: ingest.decode_samples(sensor_topic, payload_text.encode()),
+        "decode_samples[binary]": lambda i: ingest.decode_samples(sensor_topic, payload_binary),
+        "decode_samples[binary,60]": lambda i: ingest.decode_samples(sensor_topic, payload_binary_batch),
+        # Alternate so the dedup check does not short-circuit every call
+        "publish_heater": lambda i: srv.publish_heater("ON" if i & 1 else "OFF", "bench", DEVICE_ID),
+        "on_message[heater]": lambda i: srv.on_message(
+            srv.mqtt_client, None, FakeMessage(heater_topic, "ON" if i & 1 else "OFF")),
+    }
+    modes = {"Automatic": ("Automatic", "Automatic", "OFF"), "Smart": ("Smart", "Smart", "ON")}
+    for label, (off_mode, on_mode, health) in modes.items():
+        cases[f"on_message[sensors,{label}]"] = (off_mode, on_mode, health, json.dumps)
+    cases["on_message[sensors,Smart,binary]"] = (*modes["Smart"], lambda p: wire_format.encode([p]))
+
+    # DB-backed cases do far more work per call; keep their runtime sane
+    slow = {"load_recent+compute_thresholds": max(1, iterations // 20)}
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name, case in cases.items():
+            if only and not any(o in name for o in only):
+                continue
+            if isinstance(case, tuple):
+                off_mode, on_mode, health, encode = case
+                srv.settings = {
+                    "auto_off_mode": off_mode,
+                    "auto_on_mode": on_mode,
+                    "open_window_health_alert": health,
+                }
+                fn = on_message_sensor(encode)
+            else:
+                fn = case
+            n = slow.get(name, iterations)
+            results[name] = bench(fn, n, warmup=min(WARMUP, n))
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """[(name, message)] for benchmarks that regressed beyond tolerance."""
+    regressions = []
+    for name, new in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        if old["p50_us"] > 0 and new["p50_us"] > old["p50_us"] * (1.0 + tolerance):
+            regressions.append((name, f"p50 {old['p50_us']} -> {new['p50_us']} us"))
+        elif old["ops_per_sec"] > 0 and new["ops_per_sec"] < old["ops_per_sec"] * (1.0 - tolerance):
+            regressions.append((name, f"throughput {old['ops_per_sec']} -> {new['ops_per_sec']} /s"))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the PC_server hot path.")
+    parser.add_argument("--rows", type=int, default=ROWS, help="Samples in the temporary sensor.db")
+    parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    parser.add_argument("--only", action="append", default=None, help="Run benchmarks whose name contains this")
+    parser.add_argument("--dispatch", action="store_true", help="Keep the decision worker pool")
+    parser.add_argument("--persist", action="store_true", help="Persist samples through a BatchWriter")
+    parser.add_argument("--out", default=None, help="Write results JSON here")
+    parser.add_argument("--baseline", default=None, help="Compare against an earlier results JSON")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="Allowed slowdown before flagging a regression (0.10 = 10%%)")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="pc_bench_")
+    db_file = os.path.join(tmp, "sensor.db")
+    try:
+        t0 = time.perf_counter()
+        build_db(db_file, args.rows)
+        print(f"Built {db_file} with {args.rows} rows in {time.perf_counter() - t0:.1f}s")
+
+        srv = setup_server(db_file, args.dispatch, args.persist)
+        try:
+            results = run_benchmarks(srv, db_file, args.iterations, args.only)
+        finally:
+            if srv.ingest_writer is not None:
+                srv.ingest_writer.close(5)
+            if args.dispatch:
+                srv.dispatcher.stop()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"{'benchmark':36s} {'p50 us':>10s} {'p99 us':>10s} {'mean us':>10s} {'ops/s':>12s}")
+    for name, r in results.items():
+        print(f"{name:36s} {r['p50_us']:10.2f} {r['p99_us']:10.2f} {r['mean_us']:10.2f} {r['ops_per_sec']:12.1f}")
+
+    report = {
+        "meta": {
+            "time": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "rows": args.rows,
+            "iterations": args.iterations,
+            "dispatch": args.dispatch,
+            "persist": args.persist,
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline.get("results", {}), args.tolerance)
+        if regressions:
+            print(f"Regressions vs {args.baseline} (tolerance {args.tolerance:.0%}):")
+            for name, message in regressions:
+                print(f"  {name}: {message}")
+            sys.exit(1)
+        print(f"No regressions vs {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Round-trip check for code/chunk_codec.py.
+
+Encodes timestamp series whose delta-of-delta sits on every bucket edge
+(0, +-1, -64/63/64, -256/255/256, -2048/2047/2048, 32-bit) plus random
+gappy series with missing values, decodes them and compares row by row.
+chunk_store.compact() drops a partition only after the same comparison
+passes, so run this after touching the codec:
+
+    python testing/chunk_roundtrip.py
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code"))
+
+import chunk_codec  # noqa: E402
+import chunk_store  # noqa: E402
+
+N_COLUMNS = len(chunk_store.METRICS)
+EDGE_DODS = (0, 1, -1, 63, 64, -64, -65, 255, 256, -256, -257, 2047, 2048, -2048, -2049, 100000, -100000)
+
+
+def rows_from_dods(dods, t0=1_700_000_000, delta0=60):
+    rows = []
+    t, delta = t0, delta0
+    rows.append((t, 20.0, 45.0, 4.0, 600.0, 100.0))
+    t += delta
+    rows.append((t, 20.0, 45.0, 4.0, 600.0, 100.0))
+    for dod in dods:
+        delta += dod
+        t += delta
+        rows.append((t, 20.0 + dod * 1e-4, 45.0, None, 600.0, 100.0))
+    return rows
+
+
+def random_rows(rng, n):
+    rows = []
+    t = 1_700_000_000
+    for _ in range(n):
+        t += rng.randint(60, 300) if rng.random() < 0.5 else rng.randint(1, 3000)
+        row = [t]
+        for _ in range(N_COLUMNS):
+            row.append(None if rng.random() < 0.05 else round(rng.uniform(-10, 500), rng.randint(0, 3)))
+        rows.append(tuple(row))
+    return rows
+
+
+def check(name, rows):
+    blob = chunk_codec.encode(rows, N_COLUMNS)
+    if not chunk_store.round_trips(rows, blob):
+        decoded = list(chunk_codec.decode(blob))
+        bad = next(i for i, (a, b) in enumerate(zip(rows, decoded)) if a != b)
+        print(f"FAIL {name}: row {bad} {rows[bad]} decoded as {decoded[bad]}")
+        return False
+    print(f"ok   {name}: {len(rows)} rows, {len(blob)} bytes")
+    return True
+
+
+def main():
+    rng = random.Random(0)
+    cases = [("delta-of-delta 64 after delta 1", [(t, 1.0, 2.0, 3.0, 4.0, 5.0) for t in (100, 101, 166)])]
+    cases += [(f"dod {d}", rows_from_dods([d, -d, d])) for d in EDGE_DODS]
+    cases.append(("all edges", rows_from_dods(EDGE_DODS)))
+    cases += [(f"random {i}", random_rows(rng, 2000)) for i in range(5)]
+    failed = sum(not check(name, rows) for name, rows in cases)
+
+    # The streaming class used directly, not through encode()
+    enc = chunk_codec.ChunkEncoder(N_COLUMNS)
+    rows = random_rows(rng, 50)
+    for row in rows:
+        enc.append(row[0], row[1:])
+    failed += not chunk_store.round_trips(rows, enc.finish())
+
+    print("all round-trips exact" if not failed else f"{failed} case(s) FAILED")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
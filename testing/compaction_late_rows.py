@@ -0,0 +1,73 @@
+"""
+Late rows for a day that was already compacted, end to end on a temp DB.
+
+RP1's disk backlog can deliver samples for a day long after it closed. The
+late rows land in a new partition for that day; the next compaction pass
+must merge them into the existing chunks and rebuild the archive segment
+from both, not replace the segment with only the late rows:
+
+    python testing/compaction_late_rows.py
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code"))
+
+import archive  # noqa: E402
+import chunk_store  # noqa: E402
+import partitions  # noqa: E402
+import retention  # noqa: E402
+import schema  # noqa: E402
+
+DAY = 1_760_000_000 - 1_760_000_000 % partitions.PARTITION_SEC
+DEVICE = "box01"
+ROWS = 1000
+
+
+def row(t):
+    return (DEVICE, t, 20.0 + (t % 7) * 0.01, 45.0, 4.0, 600.0, 100.0)
+
+
+def chunk_rows(conn):
+    return chunk_store.rows_between(conn, DAY, DAY + partitions.PARTITION_SEC, DEVICE)
+
+
+def main():
+    tmp = tempfile.mkdtemp(prefix="late_rows_")
+    db_file = os.path.join(tmp, "sensor.db")
+    root = os.path.join(tmp, "archive")
+    schema.ensure_schema(db_file)
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    now = DAY + 10 * partitions.PARTITION_SEC
+
+    partitions.immediate(conn, partitions.insert_rows, [row(DAY + 60 * i) for i in range(ROWS)])
+    retention.compact(conn, now, 2, archive_root=root)
+    segment = archive.Archive(root).load(DEVICE)
+    print(f"after first pass:  chunks {len(chunk_rows(conn))}, archive {len(segment['time'])}")
+
+    late_t = DAY + 30  # between two stored samples
+    partitions.immediate(conn, partitions.insert_rows, [row(late_t)])
+    retention.compact(conn, now, 2, archive_root=root)
+    chunked = chunk_rows(conn)
+    segment = archive.Archive(root).load(DEVICE)
+    print(f"after late row:    chunks {len(chunked)}, archive {len(segment['time'])}, "
+          f"partitions left {len(partitions.list_partitions(conn))}")
+
+    expected = sorted([DAY + 60 * i for i in range(ROWS)] + [late_t])
+    failures = []
+    if [r[1] for r in chunked] != expected:
+        failures.append("sensor_chunks does not hold every row")
+    if segment["time"].tolist() != expected:
+        failures.append("archive segment does not hold every row")
+    conn.close()
+
+    for f in failures:
+        print("FAIL", f)
+    print("late rows kept" if not failures else f"{len(failures)} check(s) FAILED")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+QoS 1 resends, end to end on a temp DB.
+
+RP1's BacklogDrain publishes backlog batches at QoS 1; a batch whose PUBACK
+was lost is sent again, so the server sees the same samples twice. Each
+sample must be stored once and counted once in the rollups, also when the
+resend arrives after its day was compacted:
+
+    python testing/duplicate_resend.py
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code"))
+
+import chunk_store  # noqa: E402
+import partitions  # noqa: E402
+import retention  # noqa: E402
+import rollups  # noqa: E402
+import schema  # noqa: E402
+from db_writer import BatchWriter  # noqa: E402
+
+DAY = 1_760_000_000 - 1_760_000_000 % partitions.PARTITION_SEC
+DEVICE = "box01"
+ROWS = 300
+
+
+def row(t):
+    return (DEVICE, t, 20.0 + (t % 7) * 0.01, 45.0, 4.0, 600.0, 100.0)
+
+
+def main():
+    tmp = tempfile.mkdtemp(prefix="resend_")
+    db_file = os.path.join(tmp, "sensor.db")
+    schema.ensure_schema(db_file)
+    rows = [row(DAY + 60 * i) for i in range(ROWS)]
+
+    writer = BatchWriter(db_file, batch_size=50, on_flush=[rollups.apply_rows]).start()
+    for r in rows:
+        writer.submit(r)
+    for r in rows[100:200]:  # one backlog batch sent twice
+        writer.submit(r)
+    writer.close()
+    stats = writer.stats()
+
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    stored = conn.execute("SELECT COUNT(*) FROM sensor_log").fetchone()[0]
+    counted = conn.execute(f"SELECT SUM(samples) FROM {rollups.table_for('1m')}").fetchone()[0]
+    print(f"live:      stored {stored}, rollup samples {counted}, "
+          f"duplicates {stats['rows_duplicate']}")
+
+    retention.compact(conn, DAY + 10 * partitions.PARTITION_SEC, 2)
+    partitions.immediate(conn, partitions.insert_rows, rows[:10])  # resent after compaction
+    retention.compact(conn, DAY + 10 * partitions.PARTITION_SEC, 2)
+    chunked = chunk_store.rows_between(conn, DAY, DAY + partitions.PARTITION_SEC, DEVICE)
+    print(f"compacted: chunk rows {len(chunked)}")
+    conn.close()
+
+    failures = []
+    if stored != ROWS:
+        failures.append(f"sensor_log holds {stored} rows, expected {ROWS}")
+    if counted != ROWS:
+        failures.append(f"rollups counted {counted} samples, expected {ROWS}")
+    if stats["rows_duplicate"] != 100:
+        failures.append(f"writer reported {stats['rows_duplicate']} duplicates, expected 100")
+    if len(chunked) != ROWS:
+        failures.append(f"sensor_chunks holds {len(chunked)} rows, expected {ROWS}")
+
+    for f in failures:
+        print("FAIL", f)
+    print("each sample stored once" if not failures else f"{len(failures)} check(s) FAILED")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+"""
+Synthetic sensor fleet: N virtual rooms publishing RP1_sensor.py payloads.
+
+Each room runs a small physics model, one simulated second per sample:
+
+    temperature  relaxes towards the outside temperature (much faster with
+                 the window open), +HEATER_C_PER_SEC while the heater is on
+    humidity     drifts towards indoor / outdoor levels, dried by the heater
+    CO2 / TVOC   occupants add CO2, ventilation pulls it back to outdoor
+                 levels; TVOC loosely follows
+    window       opens and closes at random (exponential durations)
+
+Readings get sensor noise and the RP1 quirks: distance rounded to 3
+decimals with a window_quality, and no distance at all when the ultrasonic
+burst fails; CCS811 values as ints; some messages simply never sent
+(Si7021 read errors). Heater commands
+the server publishes on cx/<device>/heater are applied to the room, so
+Smart / Automatic modes act on the simulated temperature.
+
+Transports:
+
+    inprocess  call PC_server.on_message directly from the generator
+    loopback   go through an in-process broker stand-in (own delivery
+               thread, + / # wildcards) like paho's network thread
+    mqtt       publish to a real broker with paho (server runs elsewhere)
+
+For inprocess / loopback the server is imported with a fake MQTT client
+and end-to-end latency is measured from publish to the end of
+decide_sample (dispatcher queueing included). --rate 0 sends as fast as
+possible to find the saturation throughput:
+
+    python testing/simulator.py --devices 50 --rate 1 --duration 30
+    python testing/simulator.py --devices 200 --rate 0 --duration 10 --transport loopback
+    python testing/simulator.py --transport mqtt --broker 127.0.0.1 --devices 20 --rate 2
+    python testing/simulator.py --devices 200 --rate 0 --duration 10 --format binary
+"""
+import argparse
+import contextlib
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "code"))
+sys.path.insert(0, CODE_DIR)
+
+import fleet  # noqa: E402
+import wire_format  # noqa: E402
+
+from benchmark import FakeMessage  # noqa: E402
+
+BROKER = "127.0.0.1"
+PORT = 1883
+
+DEVICES = 10
+RATE_HZ = 1.0
+DURATION_SEC = 10.0
+
+# Room model (per simulated second)
+HEATER_C_PER_SEC = 0.003
+LOSS_CLOSED = 0.0002
+LOSS_OPEN = 0.003
+VENT_CLOSED = 0.0003
+VENT_OPEN = 0.006
+CO2_OUTDOOR = 420.0
+CO2_PER_OCCUPANT = 0.25
+WINDOW_CLOSED_MEAN_SEC = 2 * 3600
+WINDOW_OPEN_MEAN_SEC = 10 * 60
+OCCUPANCY_CHANGE_SEC = 3600
+
+# Sensor quirks
+TEMP_NOISE = 0.1
+HUM_NOISE = 0.5
+DISTANCE_CLOSED_CM = 4.0
+DISTANCE_OPEN_CM = 40.0
+DISTANCE_NOISE = 0.4
+P_DISTANCE_MISS = 0.005  # whole burst failed: window sent as missing
+P_DISTANCE_OUTLIER = 0.05  # one ping of the burst rejected
+P_MESSAGE_LOST = 0.002
+P_CCS811_MISSING = 0.0
+
+
+class Room:
+    def __init__(self, device_id, rng, t0):
+        self.device_id = device_id
+        self.rng = rng
+        self.t = t0
+        self.outside = rng.uniform(2.0, 10.0)
+        self.temperature = rng.uniform(17.0, 21.0)
+        self.humidity = rng.uniform(35.0, 55.0)
+        self.co2 = rng.uniform(450.0, 700.0)
+        self.occupants = rng.randint(0, 3)
+        self.window_open = False
+        self.heater_on = False
+
+    def step(self):
+        """Advance one simulated second."""
+        rng = self.rng
+        self.t += 1
+        if rng.random() < 1.0 / (WINDOW_OPEN_MEAN_SEC if self.window_open else WINDOW_CLOSED_MEAN_SEC):
+            self.window_open = not self.window_open
+        if rng.random() < 1.0 / OCCUPANCY_CHANGE_SEC:
+            self.occupants = rng.randint(0, 3)
+
+        loss = LOSS_OPEN if self.window_open else LOSS_CLOSED
+        self.temperature += -loss * (self.temperature - self.outside)
+        if self.heater_on:
+            self.temperature += HEATER_C_PER_SEC
+
+        target_hum = 80.0 if self.window_open else 40.0 + 5.0 * self.occupants
+        self.humidity += 0.001 * (target_hum - self.humidity) - (0.002 if self.heater_on else 0.0)
+        self.humidity = min(100.0, max(5.0, self.humidity))
+
+        vent = VENT_OPEN if self.window_open else VENT_CLOSED
+        self.co2 += CO2_PER_OCCUPANT * self.occupants - vent * (self.co2 - CO2_OUTDOOR)
+
+    def payload(self):
+        """RP1_sensor.py payload for the current state, or None if the message is lost."""
+        rng = self.rng
+        if rng.random() < P_MESSAGE_LOST:
+            return None
+        if rng.random() < P_DISTANCE_MISS:
+            distance, quality = None, 0.0
+        else:
+            base = DISTANCE_OPEN_CM if self.window_open else DISTANCE_CLOSED_CM
+            distance = round(max(2.0, rng.gauss(base, DISTANCE_NOISE)), 3)
+            quality = 0.8 if rng.random() < P_DISTANCE_OUTLIER else 1.0
+        if rng.random() < P_CCS811_MISSING:
+            co2_ppm = tvoc_ppb = None
+        else:
+            co2_ppm = max(400, int(rng.gauss(self.co2, 10.0)))
+            tvoc_ppb = max(0, int(rng.gauss(0.4 * (self.co2 - CO2_OUTDOOR), 8.0)))
+        return {
+            "timestamp": self.t,
+            "window": distance,
+            "window_quality": quality,
+            "temperature": self.temperature + rng.gauss(0.0, TEMP_NOISE),
+            "humidity": min(100.0, max(0.0, self.humidity + rng.gauss(0.0, HUM_NOISE))),
+            "co2_ppm": co2_ppm,
+            "tvoc_ppb": tvoc_ppb,
+        }
+
+    def apply_heater(self, payload):
+        raw = payload.decode(errors="ignore") if isinstance(payload, bytes) else str(payload)
+        cmd = raw.strip().upper()
+        if cmd not in ("ON", "OFF"):
+            try:
+                cmd = str(json.loads(raw).get("command", "")).upper()
+            except (ValueError, AttributeError):
+                return
+        if cmd in ("ON", "OFF"):
+            self.heater_on = cmd == "ON"
+
+
+# ----------------------
+# Loopback broker
+# ----------------------
+def topic_matches(pattern, topic):
+    p_parts = pattern.split("/")
+    t_parts = topic.split("/")
+    for i, p in enumerate(p_parts):
+        if p == "#":
+            return True
+        if i >= len(t_parts) or (p != "+" and p != t_parts[i]):
+            return False
+    return len(p_parts) == len(t_parts)
+
+
+class LoopbackBroker:
+    """In-process publish/subscribe with one delivery thread, like paho's loop."""
+
+    def __init__(self):
+        self._subs = []
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self.delivered = 0
+        self.max_depth = 0
+
+    def subscribe(self, pattern, callback):
+        self._subs = self._subs + [(pattern, callback)]
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self._queue.put((topic, payload))
+        depth = self._queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="loopback-broker", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            topic, payload = item
+            msg = FakeMessage(topic, payload)
+            for pattern, callback in self._subs:
+                if topic_matches(pattern, topic):
+                    callback(msg)
+            self.delivered += 1
+
+
+class RoutingClient:
+    """PC_server.mqtt_client for inprocess mode: heater commands go straight to the rooms."""
+
+    def __init__(self, rooms):
+        self.rooms = rooms
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+        device_id, kind = fleet.parse_topic(topic)
+        room = self.rooms.get(device_id)
+        if room is not None and kind == "heater":
+            room.apply_heater(payload)
+
+
+# ----------------------
+# Latency
+# ----------------------
+class LatencyRecorder:
+    def __init__(self):
+        self.sent_at = {}
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def sent(self, device_id, t):
+        self.sent_at[(device_id, t)] = time.perf_counter()
+
+    def done(self, device_id, t):
+        start = self.sent_at.pop((device_id, t), None)
+        if start is not None:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.samples.append(elapsed)
+
+    def summary(self):
+        with self._lock:
+            values = sorted(self.samples)
+        if not values:
+            return {"count": 0}
+
+        def pct(q):
+            return round(values[min(len(values) - 1, int(q / 100.0 * len(values)))] * 1000.0, 3)
+
+        return {
+            "count": len(values),
+            "p50_ms": pct(50),
+            "p95_ms": pct(95),
+            "p99_ms": pct(99),
+            "max_ms": round(values[-1] * 1000.0, 3),
+        }
+
+
+def setup_server(client, recorder, settings, workers, capacity, policy):
+    """Import PC_server with a fake MQTT client and a timed decision handler."""
+    import PC_server
+    from dispatch import Dispatcher
+    from ingest import IngestPipeline
+
+    def timed_decide(sample):
+        PC_server.decide_sample(sample)
+        recorder.done(sample.device_id, sample.time)
+
+    def timed_inline(sample):
+        # No dispatcher: handle_sample runs decide_sample on this thread
+        PC_server.handle_sample(sample)
+        recorder.done(sample.device_id, sample.time)
+
+    PC_server.mqtt_client = client
+    PC_server.settings = settings
+    PC_server.dispatcher = Dispatcher(timed_decide, workers, capacity, policy).start() if workers > 0 else None
+    decide = PC_server.handle_sample if PC_server.dispatcher is not None else timed_inline
+    PC_server.ingest = IngestPipeline(writer=None, decide=decide)
+    return PC_server
+
+
+def generate(rooms, send, rate_hz, duration_sec, max_messages=None, stop=None):
+    """
+    Round-robin the rooms at rate_hz each (0 = as fast as possible) on
+    absolute deadlines, so a slow send does not shift the schedule.
+    Returns (messages sent, elapsed seconds).
+    """
+    order = list(rooms.values())
+    interval = 1.0 / (rate_hz * len(order)) if rate_hz > 0 else 0.0
+    start = time.perf_counter()
+    end = start + duration_sec
+    sent = 0
+    k = 0
+    while True:
+        now = time.perf_counter()
+        if now >= end or (max_messages is not None and sent >= max_messages) or (stop and stop.is_set()):
+            break
+        if interval:
+            deadline = start + k * interval
+            if deadline > now:
+                time.sleep(deadline - now)
+        room = order[k % len(order)]
+        k += 1
+        room.step()
+        payload = room.payload()
+        if payload is None:
+            continue
+        send(room, payload)
+        sent += 1
+    return sent, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of sensor boxes against PC_server.")
+    parser.add_argument("--devices", type=int, default=DEVICES)
+    parser.add_argument("--rate", type=float, default=RATE_HZ, help="Messages per second per device (0 = max)")
+    parser.add_argument("--duration", type=float, default=DURATION_SEC, help="Seconds to run")
+    parser.add_argument("--messages", type=int, default=None, help="Stop after this many messages")
+    parser.add_argument("--transport", choices=("inprocess", "loopback", "mqtt"), default="inprocess")
+    parser.add_argument("--broker", default=BROKER, help="MQTT broker (mqtt transport)")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--prefix", default="sim", help="Device id prefix")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=("json", "binary"), default="json",
+                        help="Sensor payload encoding (binary = wire_format.py)")
+    parser.add_argument("--off-mode", default="Smart", help="Server auto_off_mode (in-process transports)")
+    parser.add_argument("--on-mode", default="Smart", help="Server auto_on_mode (in-process transports)")
+    parser.add_argument("--workers", type=int, default=4, help="Dispatcher workers (0 = decide inline)")
+    parser.add_argument("--lane-capacity", type=int, default=256)
+    parser.add_argument("--policy", default="coalesce", choices=("coalesce", "drop_oldest"))
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    t0 = int(time.time())
+    rooms = {
+        f"{args.prefix}{i:04d}": Room(f"{args.prefix}{i:04d}", random.Random(rng.random()), t0)
+        for i in range(args.devices)
+    }
+    recorder = LatencyRecorder()
+    settings = {"auto_off_mode": args.off_mode, "auto_on_mode": args.on_mode, "open_window_health_alert": "OFF"}
+    report = {"transport": args.transport, "format": args.format, "devices": args.devices, "rate_hz": args.rate}
+    srv = broker = mqtt_client = None
+    encode = (lambda p: wire_format.encode([p])) if args.format == "binary" else json.dumps
+
+    if args.transport == "mqtt":
+        import paho.mqtt.client as mqtt
+
+        mqtt_client = mqtt.Client()
+        mqtt_client.on_message = lambda c, u, msg: _route_heater(rooms, msg)
+        mqtt_client.connect(args.broker, args.port, 60)
+        mqtt_client.subscribe(fleet.wildcard_topic("heater"))
+        mqtt_client.loop_start()
+
+        def send(room, payload):
+            mqtt_client.publish(fleet.topic_for(room.device_id, "sensors"), encode(payload))
+    elif args.transport == "loopback":
+        broker = LoopbackBroker()
+        srv = setup_server(broker, recorder, settings, args.workers, args.lane_capacity, args.policy)
+        broker.subscribe(fleet.wildcard_topic("sensors"), lambda msg: srv.on_message(broker, None, msg))
+        broker.subscribe(fleet.wildcard_topic("heater"), lambda msg: srv.on_message(broker, None, msg))
+        broker.subscribe(fleet.wildcard_topic("heater"), lambda msg: _route_heater(rooms, msg))
+        broker.start()
+
+        def send(room, payload):
+            recorder.sent(room.device_id, payload["timestamp"])
+            broker.publish(fleet.topic_for(room.device_id, "sensors"), encode(payload))
+    else:
+        srv = setup_server(RoutingClient(rooms), recorder, settings, args.workers, args.lane_capacity, args.policy)
+
+        def send(room, payload):
+            recorder.sent(room.device_id, payload["timestamp"])
+            srv.on_message(srv.mqtt_client, None,
+                           FakeMessage(fleet.topic_for(room.device_id, "sensors"), encode(payload)))
+
+    # The server logs every publish; keep the report readable
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        sent, elapsed = generate(rooms, send, args.rate, args.duration, args.messages)
+        drain_start = time.perf_counter()
+        if broker is not None:
+            broker.stop(30)
+        if srv is not None and srv.dispatcher is not None:
+            srv.dispatcher.stop(30)
+        drain_sec = time.perf_counter() - drain_start
+        if mqtt_client is not None:
+            time.sleep(0.5)
+            mqtt_client.loop_stop()
+            mqtt_client.disconnect()
+
+    report.update({
+        "sent": sent,
+        "elapsed_sec": round(elapsed, 3),
+        "send_rate": round(sent / elapsed, 1) if elapsed else 0.0,
+        "drain_sec": round(drain_sec, 3),
+        "heater_on": sum(1 for r in rooms.values() if r.heater_on),
+        "window_open": sum(1 for r in rooms.values() if r.window_open),
+        "mean_temperature": round(sum(r.temperature for r in rooms.values()) / max(1, len(rooms)), 2),
+    })
+    if srv is not None:
+        decided = recorder.summary()
+        report["latency"] = decided
+        report["decision_rate"] = round(decided["count"] / (elapsed + drain_sec), 1) if decided["count"] else 0.0
+        if srv.dispatcher is not None:
+            report["dispatch"] = srv.dispatcher.stats()
+        report["ingest"] = {k: v for k, v in srv.ingest.stats().items() if k != "stages"}
+    if broker is not None:
+        report["broker"] = {"delivered": broker.delivered, "max_depth": broker.max_depth}
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['transport']}: {sent} messages from {args.devices} device(s) in {elapsed:.1f}s "
+          f"({report['send_rate']}/s), drained in {report['drain_sec']}s")
+    if "latency" in report:
+        lat = report["latency"]
+        if lat["count"]:
+            print(f"  decisions {lat['count']} ({report['decision_rate']}/s), latency p50 {lat['p50_ms']} ms, "
+                  f"p95 {lat['p95_ms']} ms, p99 {lat['p99_ms']} ms, max {lat['max_ms']} ms")
+        if "dispatch" in report:
+            d = report["dispatch"]
+            print(f"  dispatch: dropped {d['dropped']}, coalesced {d['coalesced']}, max lane depth {d['max_lane_depth']}")
+    print(f"  rooms: {report['heater_on']} heater(s) on, {report['window_open']} window(s) open, "
+          f"mean {report['mean_temperature']} °C")
+
+
+def _route_heater(rooms, msg):
+    device_id, kind = fleet.parse_topic(msg.topic)
+    room = rooms.get(device_id)
+    if room is not None and kind == "heater":
+        room.apply_heater(msg.payload)
+
+
+if __name__ == "__main__":
+    main()